@@ -0,0 +1,3 @@
+
+# generated
+__gittag__ = 'UNKNOWN'
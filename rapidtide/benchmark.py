@@ -0,0 +1,743 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Timing benchmarks for the rapidtide processing stages, run on synthetic data with known
+delays.
+"""
+import contextlib
+import copy
+import io
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import rapidtide.corrfit as tide_corrfit
+import rapidtide.corrpass as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.glmpass as tide_glmpass
+import rapidtide.io as tide_io
+import rapidtide.miscmath as tide_math
+import rapidtide.nullcorrpass as tide_nullcorr
+import rapidtide.refine as tide_refine
+import rapidtide.resample as tide_resample
+import rapidtide.stats as tide_stats
+import rapidtide.util as tide_util
+import rapidtide.wiener as tide_wiener
+
+# the stages, in pipeline order
+STAGES = ["correlationpass", "fitcorr", "nulldistribution", "refineregressor", "glmpass", "wienerpass"]
+
+
+def makesyntheticdata(
+    numvoxels,
+    timepoints,
+    tr=1.0,
+    lagmin=-5.0,
+    lagmax=5.0,
+    meanlevel=1000.0,
+    boldpc=2.0,
+    noiselevel=5.0,
+    inputfreq=12.5,
+    seed=None,
+):
+    r"""Make a simulated fMRI dataset with a known delay in every voxel.
+
+    This does the same thing as simdata, without needing template files: a random lfo band
+    regressor is delayed by a different amount in each voxel, scaled to a BOLD percentage of a
+    mean level, and white noise is added.
+
+    Parameters
+    ----------
+    numvoxels : int
+        Number of voxels
+    timepoints : int
+        Number of timepoints
+    tr : float, optional
+        Repetition time, in seconds.  Default is 1.0
+    lagmin, lagmax : float, optional
+        The voxel delays are uniformly distributed over this range, in seconds.  Default is -5 to 5.
+    meanlevel : float, optional
+        Mean value of every voxel.  Default is 1000.0
+    boldpc : float, optional
+        Amplitude of the regressor, in percent of the mean.  Default is 2.0
+    noiselevel : float, optional
+        Standard deviation of the added noise.  Default is 5.0
+    inputfreq : float, optional
+        Sample rate of the regressor, in Hz.  Default is 12.5
+    seed : int, optional
+        Random seed.  Default is None.
+
+    Returns
+    -------
+    fmridata : 2D float array
+        The simulated data (voxels by time)
+    regressor_x, regressor_y : 1D float arrays
+        The time axis and values of the regressor
+    truelags : 1D float array
+        The delay of every voxel, in seconds
+    """
+    rng = np.random.RandomState(seed)
+    padtime = max(-lagmin, lagmax) + 30.0
+    regressor_x = np.arange(-padtime, timepoints * tr + padtime, 1.0 / inputfreq)
+    theprefilter = tide_filt.noncausalfilter(filtertype="lfo")
+    regressor_y = tide_math.stdnormalize(
+        theprefilter.apply(inputfreq, rng.normal(size=len(regressor_x)))
+    )
+    genlagtc = tide_resample.fastresampler(regressor_x, regressor_y, padvalue=padtime)
+
+    fmri_x = np.arange(0.0, timepoints) * tr
+    truelags = rng.uniform(lagmin, lagmax, size=numvoxels)
+    fmridata = np.zeros((numvoxels, timepoints), dtype=np.float64)
+    for vox in range(numvoxels):
+        fmridata[vox, :] = meanlevel * (
+            1.0 + (boldpc / 100.0) * genlagtc.yfromx(fmri_x - truelags[vox])
+        )
+    fmridata += noiselevel * rng.normal(size=fmridata.shape)
+    return fmridata, regressor_x, regressor_y, truelags
+
+
+def defaultoptions():
+    r"""The subset of the rapidtide2x options used by the benchmarked stages, at their
+    rapidtide2x default values.
+
+    Returns
+    -------
+    optiondict : dict
+    """
+    return {
+        "absmaxsigma": 100.0,
+        "addedskip": 0,
+        "ampthresh": 0.3,
+        "bipolar": False,
+        "cleanrefined": False,
+        "corrblocksize": 1000,
+        "corrweighting": "none",
+        "debug": False,
+        "despeckle_thresh": 5.0,
+        "detrendorder": 1,
+        "dispersioncalc_lower": -30.0,
+        "dispersioncalc_step": 2.4,
+        "dispersioncalc_upper": 30.0,
+        "dodispersioncalc": False,
+        "edgebufferfrac": 0.0,
+        "enforcethresh": True,
+        "estimatePCAdims": False,
+        "fastgauss": False,
+        "filterbeforePCA": True,
+        "findmaxtype": "gauss",
+        "fitblocksize": 1000,
+        "fixdelay": False,
+        "fixeddelayvalue": 0.0,
+        "gaussrefine": True,
+        "glmblockmem": 256.0,
+        "hardlimit": True,
+        "internalprecision": "double",
+        "interptype": "univariate",
+        "lagmaskside": "both",
+        "lagmax": 30.0,
+        "lagmaxthresh": 5.0,
+        "lagmin": -30.0,
+        "lagminthresh": 0.5,
+        "lagmod": 1000.0,
+        "lthreshval": 0.0,
+        "mp_chunksize": 50000,
+        "nprocs": 1,
+        "nullblocksize": 1000,
+        "nullcachedir": None,
+        "nullseed": 31415,
+        "numestreps": 1000,
+        "offsettime": 0.0,
+        "outputname": "rapidtidebench",
+        "peakfititers": 30,
+        "peakfitrefine": "gaussnewton",
+        "psdfilter": False,
+        "refineblocksize": 1000,
+        "refineprenorm": "mean",
+        "refinetype": "unweighted_average",
+        "refineweighting": "R2",
+        "searchfrac": 0.5,
+        "shiftall": True,
+        "showprogressbar": False,
+        "sigmathresh": 100.0,
+        "usewindowfunc": True,
+        "uthreshval": 1.0,
+        "widthlimit": 100.0,
+        "windowfunc": "hamming",
+        "zerooutbadfit": True,
+    }
+
+
+def _setup(fmridata, regressor_x, regressor_y, tr, optiondict):
+    # set up the time axes, reference and work arrays the same way rapidtide2x does
+    numvoxels, timepoints = fmridata.shape
+    if optiondict["internalprecision"] == "double":
+        rt_floattype = "float64"
+        rt_floatset = np.float64
+    else:
+        rt_floattype = "float32"
+        rt_floatset = np.float32
+    s = {
+        "fmridata": fmridata.astype(rt_floattype),
+        "tr": tr,
+        "optiondict": optiondict,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+    oversampfactor = int(max(np.ceil(tr // 0.5), 1))
+    optiondict["oversampfactor"] = oversampfactor
+    optiondict["fmrifreq"] = 1.0 / tr
+    oversamptr = tr / oversampfactor
+    s["initial_fmri_x"] = np.arange(0.0, timepoints) * tr
+    s["os_fmri_x"] = (
+        np.arange(0.0, timepoints * oversampfactor - (oversampfactor - 1)) * oversamptr
+    )
+    s["oversampfreq"] = oversampfactor / tr
+    s["theprefilter"] = tide_filt.noncausalfilter(filtertype="lfo")
+
+    resampref_y = tide_fit.detrend(
+        tide_resample.doresample(regressor_x, regressor_y, s["os_fmri_x"]),
+        order=optiondict["detrendorder"],
+        demean=True,
+    )
+    s["referencetc"] = tide_math.corrnormalize(
+        resampref_y,
+        prewindow=optiondict["usewindowfunc"],
+        detrendorder=optiondict["detrendorder"],
+        windowfunc=optiondict["windowfunc"],
+    )
+
+    numccorrlags = 2 * oversampfactor * timepoints - 1
+    s["corrscale"] = (
+        np.arange(0.0, numccorrlags) * oversamptr
+        - (numccorrlags * oversamptr) / 2.0
+        + (oversampfactor - 0.5) * oversamptr
+    )
+    s["corrorigin"] = numccorrlags // 2 + 1
+    s["lagmininpts"] = int((-optiondict["lagmin"] / oversamptr) - 0.5)
+    s["lagmaxinpts"] = int((optiondict["lagmax"] / oversamptr) + 0.5)
+    corroutlen = s["lagmininpts"] + s["lagmaxinpts"]
+    optiondict["edgebufferfrac"] = max([optiondict["edgebufferfrac"], 2.0 / numccorrlags])
+
+    padvalue = max((-optiondict["lagmin"], optiondict["lagmax"])) + 30.0
+    s["numpadtrs"] = int(padvalue // tr)
+    padvalue = tr * s["numpadtrs"]
+    s["genlagtc"] = tide_resample.fastresampler(regressor_x, regressor_y, padvalue=padvalue)
+    s["threshval"] = tide_stats.getfracval(fmridata, 0.98) / 25.0
+
+    spaceshape = (numvoxels,)
+    fmrishape = (numvoxels, timepoints)
+    for thename in ["meanval", "lagtimes", "lagstrengths", "lagsigma", "R2"]:
+        s[thename] = np.zeros(spaceshape, dtype=rt_floattype)
+    for thename in ["lagmask", "failimage"]:
+        s[thename] = np.zeros(spaceshape, dtype="uint16")
+    for thename in ["corrout", "gaussout", "windowout"]:
+        s[thename] = np.zeros((numvoxels, corroutlen), dtype=rt_floattype)
+    for thename in ["lagtc", "shiftedtcs", "weights", "datatoremove", "filtereddata"]:
+        s[thename] = np.zeros(fmrishape, dtype=rt_floattype)
+    for thename in ["glmmean", "rvalue", "r2value", "fitcoff", "fitNorm"]:
+        s[thename] = np.zeros(spaceshape, dtype=rt_floattype)
+    return s
+
+
+def _runcorrelationpass(s):
+    volumetotal, theglobalmaxlist = tide_corrpass.correlationpass(
+        s["fmridata"],
+        None,
+        s["referencetc"],
+        s["initial_fmri_x"],
+        s["os_fmri_x"],
+        s["tr"],
+        s["corrorigin"],
+        s["lagmininpts"],
+        s["lagmaxinpts"],
+        s["corrout"],
+        s["meanval"],
+        s["theprefilter"],
+        s["optiondict"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+    return volumetotal
+
+
+def _runfitcorr(s):
+    return tide_corrfit.fitcorrx(
+        s["genlagtc"],
+        s["initial_fmri_x"],
+        s["lagtc"],
+        1,
+        s["corrscale"][s["corrorigin"] - s["lagmininpts"] : s["corrorigin"] + s["lagmaxinpts"]],
+        s["lagmask"],
+        s["failimage"],
+        s["lagtimes"],
+        s["lagstrengths"],
+        s["lagsigma"],
+        s["corrout"],
+        s["meanval"],
+        s["gaussout"],
+        s["windowout"],
+        s["R2"],
+        s["optiondict"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+
+
+def _runnulldistribution(s):
+    tide_nullcorr.getNullDistributionDatax(
+        s["referencetc"],
+        s["corrscale"],
+        s["theprefilter"],
+        s["oversampfreq"],
+        s["corrorigin"],
+        s["lagmininpts"],
+        s["lagmaxinpts"],
+        s["optiondict"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+    return s["optiondict"]["numestreps"]
+
+
+def _runrefineregressor(s):
+    voxelsprocessed, outputdata, refinemask = tide_refine.refineregressor(
+        s["fmridata"],
+        s["tr"],
+        s["shiftedtcs"],
+        s["weights"],
+        1,
+        s["lagstrengths"],
+        s["lagtimes"],
+        s["lagsigma"],
+        s["R2"],
+        s["theprefilter"],
+        s["optiondict"],
+        padtrs=s["numpadtrs"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+    return int(voxelsprocessed)
+
+
+def _runglmpass(s):
+    return tide_glmpass.glmpass(
+        s["fmridata"].shape[0],
+        s["fmridata"],
+        s["threshval"],
+        s["lagtc"],
+        s["glmmean"],
+        s["rvalue"],
+        s["r2value"],
+        s["fitcoff"],
+        s["fitNorm"],
+        s["datatoremove"],
+        s["filtereddata"],
+        nprocs=s["optiondict"]["nprocs"],
+        showprogressbar=False,
+        mp_chunksize=s["optiondict"]["mp_chunksize"],
+        blockmem=s["optiondict"]["glmblockmem"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+
+
+def _runwienerpass(s):
+    return tide_wiener.wienerpass(
+        s["fmridata"].shape[0],
+        1000,
+        s["fmridata"],
+        s["threshval"],
+        s["lagtc"],
+        s["optiondict"],
+        s["glmmean"],
+        s["rvalue"],
+        s["r2value"],
+        s["fitcoff"],
+        s["fitNorm"],
+        s["datatoremove"],
+        s["filtereddata"],
+        rt_floatset=s["rt_floatset"],
+        rt_floattype=s["rt_floattype"],
+    )
+
+
+_stagefuncs = {
+    "correlationpass": _runcorrelationpass,
+    "fitcorr": _runfitcorr,
+    "nulldistribution": _runnulldistribution,
+    "refineregressor": _runrefineregressor,
+    "glmpass": _runglmpass,
+    "wienerpass": _runwienerpass,
+}
+
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def benchmarkcase(
+    numvoxels,
+    timepoints,
+    nprocs=1,
+    stages=None,
+    repeats=1,
+    tr=1.0,
+    optiondict=None,
+    seed=12345,
+    verbose=False,
+):
+    r"""Time the processing stages on one synthetic dataset.
+
+    Stages always run in pipeline order, since each one works on the output of the stages
+    before it.  Stages that are needed as input but were not requested are run once, untimed.
+
+    Parameters
+    ----------
+    numvoxels : int
+        Number of voxels in the synthetic dataset
+    timepoints : int
+        Number of timepoints in the synthetic dataset
+    nprocs : int, optional
+        Number of worker processes.  Default is 1.
+    stages : list of str, optional
+        Stages to time (a subset of STAGES).  Default is all of them.
+    repeats : int, optional
+        Number of times to run each timed stage.  Default is 1.
+    tr : float, optional
+        Repetition time of the synthetic data, in seconds.  Default is 1.0
+    optiondict : dict, optional
+        Options to use in place of the defaults from defaultoptions().
+    seed : int, optional
+        Random seed for the synthetic data.  Default is 12345.
+    verbose : bool, optional
+        If False (the default), the progress output of the stages is suppressed.
+
+    Returns
+    -------
+    records : list of dict
+        One record per timed stage, with the case description, the elapsed time of every
+        repeat, the fastest time, and the number of items processed per second.
+    """
+    if stages is None:
+        stages = STAGES
+    for thestage in stages:
+        if thestage not in STAGES:
+            print("unknown stage", thestage, "- valid stages are", ", ".join(STAGES))
+            sys.exit()
+    if optiondict is None:
+        optiondict = defaultoptions()
+    else:
+        optiondict = copy.deepcopy(optiondict)
+    optiondict["nprocs"] = nprocs
+
+    fmridata, regressor_x, regressor_y, truelags = makesyntheticdata(
+        numvoxels, timepoints, tr=tr, seed=seed
+    )
+    s = _setup(fmridata, regressor_x, regressor_y, tr, optiondict)
+
+    laststage = max([STAGES.index(thestage) for thestage in stages])
+    records = []
+    for thestage in STAGES[: laststage + 1]:
+        if thestage == "nulldistribution" and thestage not in stages:
+            # nothing downstream depends on it
+            continue
+        if thestage in stages:
+            numruns = repeats
+        else:
+            numruns = 1
+        elapsed = []
+        for therepeat in range(numruns):
+            starttime = time.time()
+            with _quiet(verbose):
+                numitems = _stagefuncs[thestage](s)
+            elapsed.append(time.time() - starttime)
+        if thestage in stages:
+            therecord = {
+                "stage": thestage,
+                "numvoxels": numvoxels,
+                "timepoints": timepoints,
+                "nprocs": nprocs,
+                "precision": optiondict["internalprecision"],
+                "items": int(numitems),
+                "times": elapsed,
+                "best": min(elapsed),
+                "itemspersec": int(numitems) / max(min(elapsed), 1e-9),
+            }
+            if thestage == "fitcorr":
+                # check that the delays came out right
+                therecord["lagerror"] = float(
+                    np.median(np.fabs(s["lagtimes"] - truelags)[np.where(s["lagmask"] > 0)])
+                )
+            records.append(therecord)
+    return records
+
+
+# the largest difference from a double precision run that is acceptable in a single precision
+# run, for each map checked by precisionreport ("lagmask" is the fraction of voxels whose fit
+# succeeded in one run but not the other)
+PRECISIONTOLERANCES = {
+    "lagtimes": 0.01,
+    "lagstrengths": 0.001,
+    "lagsigma": 0.01,
+    "R2": 0.001,
+    "rvalue": 0.001,
+    "lagmask": 0.001,
+}
+
+
+def precisionreport(
+    numvoxels=2000,
+    timepoints=300,
+    tr=1.0,
+    optiondict=None,
+    seed=12345,
+    tolerances=None,
+    verbose=False,
+):
+    r"""Check that a single precision run gives the same maps as a double precision one.
+
+    The correlation, fitting, refinement and GLM stages are run on the same synthetic dataset in
+    both precisions, and the maps are compared over the voxels that were fit successfully in
+    both.  To check a real dataset, run rapidtide2x with and without --usesp and compare the
+    outputs with tide_util.comparerapidtideruns.
+
+    Parameters
+    ----------
+    numvoxels : int, optional
+        Number of voxels in the synthetic dataset.  Default is 2000.
+    timepoints : int, optional
+        Number of timepoints in the synthetic dataset.  Default is 300.
+    tr : float, optional
+        Repetition time of the synthetic data, in seconds.  Default is 1.0
+    optiondict : dict, optional
+        Options to use in place of the defaults from defaultoptions().
+    seed : int, optional
+        Random seed for the synthetic data.  Default is 12345.
+    tolerances : dict, optional
+        Tolerances to use in place of the ones in PRECISIONTOLERANCES.
+    verbose : bool, optional
+        If False (the default), the progress output of the stages is suppressed.
+
+    Returns
+    -------
+    report : dict
+        "maps" has the difference statistics (from tide_util.comparemap), the largest absolute
+        difference, the tolerance and the verdict for each map, "times" has the elapsed time of
+        each stage in each precision, and "pass" is True if every map is within tolerance.
+    """
+    thetolerances = copy.deepcopy(PRECISIONTOLERANCES)
+    if tolerances is not None:
+        thetolerances.update(tolerances)
+    fmridata, regressor_x, regressor_y, truelags = makesyntheticdata(
+        numvoxels, timepoints, tr=tr, seed=seed
+    )
+    states = {}
+    times = {}
+    for theprecision in ["double", "single"]:
+        if optiondict is None:
+            theoptions = defaultoptions()
+        else:
+            theoptions = copy.deepcopy(optiondict)
+        theoptions["internalprecision"] = theprecision
+        s = _setup(fmridata, regressor_x, regressor_y, tr, theoptions)
+        times[theprecision] = {}
+        for thestage in ["correlationpass", "fitcorr", "refineregressor", "glmpass"]:
+            starttime = time.time()
+            with _quiet(verbose):
+                _stagefuncs[thestage](s)
+            times[theprecision][thestage] = time.time() - starttime
+        states[theprecision] = s
+
+    doubleresults = states["double"]
+    singleresults = states["single"]
+    mismatch = np.sum((doubleresults["lagmask"] > 0) != (singleresults["lagmask"] > 0))
+    mask = np.int64((doubleresults["lagmask"] > 0) & (singleresults["lagmask"] > 0))
+    maps = {
+        "lagmask": {
+            "mismatched": int(mismatch),
+            "maxabsdiff": mismatch / numvoxels,
+            "tolerance": thetolerances["lagmask"],
+        }
+    }
+    for themap in ["lagtimes", "lagstrengths", "lagsigma", "R2", "rvalue"]:
+        mindiff, maxdiff, meandiff, mse, minreldiff, maxreldiff, meanreldiff, relmse = tide_util.comparemap(
+            np.asarray(doubleresults[themap], dtype=np.float64),
+            np.asarray(singleresults[themap], dtype=np.float64),
+            mask=mask,
+        )
+        maps[themap] = {
+            "mindiff": float(mindiff),
+            "maxdiff": float(maxdiff),
+            "meandiff": float(meandiff),
+            "mse": float(mse),
+            "maxabsdiff": float(max(np.fabs(mindiff), np.fabs(maxdiff))),
+            "tolerance": thetolerances[themap],
+        }
+    for themap in maps:
+        maps[themap]["pass"] = bool(maps[themap]["maxabsdiff"] <= maps[themap]["tolerance"])
+    return {
+        "numvoxels": numvoxels,
+        "timepoints": timepoints,
+        "maps": maps,
+        "times": times,
+        "pass": all([maps[themap]["pass"] for themap in maps]),
+    }
+
+
+def _gitrevision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "UNKNOWN"
+
+
+def runbenchmarks(
+    voxelcounts=(1000, 10000),
+    timepointcounts=(200, 400),
+    nproclist=(1,),
+    stages=None,
+    repeats=1,
+    tr=1.0,
+    optiondict=None,
+    seed=12345,
+    verbose=False,
+):
+    r"""Time the processing stages over a grid of problem sizes and process counts.
+
+    Parameters
+    ----------
+    voxelcounts : list of int, optional
+        Numbers of voxels to test.  Default is (1000, 10000).
+    timepointcounts : list of int, optional
+        Numbers of timepoints to test.  Default is (200, 400).
+    nproclist : list of int, optional
+        Numbers of worker processes to test.  Default is (1,).
+    stages, repeats, tr, optiondict, seed, verbose
+        Passed to benchmarkcase.
+
+    Returns
+    -------
+    results : dict
+        "metadata" describes the software and machine, "results" is the list of records from
+        every call to benchmarkcase.
+    """
+    with _quiet(False):
+        releaseversion = tide_util.version()[0]
+    metadata = {
+        "git_revision": _gitrevision(),
+        "release_version": releaseversion,
+        "python_version": platform.python_version(),
+        "numpy_version": np.__version__,
+        "platform": platform.platform(),
+        "hostname": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "jitkernels": tide_util.jitkernelstatus(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "repeats": repeats,
+        "tr": tr,
+        "seed": seed,
+    }
+    records = []
+    for timepoints in timepointcounts:
+        for numvoxels in voxelcounts:
+            for nprocs in nproclist:
+                print("benchmarking", numvoxels, "voxels,", timepoints, "timepoints,", nprocs, "processes")
+                caserecords = benchmarkcase(
+                    numvoxels,
+                    timepoints,
+                    nprocs=nprocs,
+                    stages=stages,
+                    repeats=repeats,
+                    tr=tr,
+                    optiondict=optiondict,
+                    seed=seed,
+                    verbose=verbose,
+                )
+                for therecord in caserecords:
+                    print("\t{:<18s}{:10.3f} s".format(therecord["stage"], therecord["best"]))
+                records += caserecords
+    return {"metadata": metadata, "results": records}
+
+
+def comparebenchmarks(oldresults, newresults):
+    r"""Match up the records of two benchmark runs.
+
+    Parameters
+    ----------
+    oldresults, newresults : dict
+        Results from runbenchmarks (or read back from its json output)
+
+    Returns
+    -------
+    comparison : list of tuple
+        (stage, numvoxels, timepoints, nprocs, old best time, new best time, new/old) for every
+        case present in both runs.
+    """
+    oldtimes = {}
+    for therecord in oldresults["results"]:
+        oldtimes[
+            (therecord["stage"], therecord["numvoxels"], therecord["timepoints"], therecord["nprocs"])
+        ] = therecord["best"]
+    comparison = []
+    for therecord in newresults["results"]:
+        thekey = (
+            therecord["stage"],
+            therecord["numvoxels"],
+            therecord["timepoints"],
+            therecord["nprocs"],
+        )
+        if thekey in oldtimes:
+            comparison.append(
+                thekey
+                + (
+                    oldtimes[thekey],
+                    therecord["best"],
+                    therecord["best"] / max(oldtimes[thekey], 1e-9),
+                )
+            )
+    return comparison
+
+
+def writebenchmarks(results, filename):
+    r"""Save benchmark results as json.
+
+    Parameters
+    ----------
+    results : dict
+        Results from runbenchmarks
+    filename : str
+        The name of the json file (with extension)
+    """
+    tide_io.writedicttojson(results, filename)
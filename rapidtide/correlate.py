@@ -20,76 +20,32 @@
 #
 
 import numpy as np
-import pylab as pl
 import scipy as sp
 from numpy.fft import irfftn, rfftn
-from scipy import fftpack, signal
 
 import rapidtide.fit as tide_fit
 import rapidtide.miscmath as tide_math
 import rapidtide.resample as tide_resample
 import rapidtide.util as tide_util
 
+signal = tide_util.lazymodule("scipy.signal")
+pl = tide_util.lazymodule("pylab")
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
+memprofilerexists = tide_util.memprofilerexists
+nibabelexists = tide_util.nibabelexists
 
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
-
-    return resdec
+pyfftwexists = tide_util.pyfftwexists
+fftpack = tide_util.fftpack
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- Correlation functions -------------------------------------------------
@@ -198,6 +154,14 @@ def quickcorr(data1, data2, windowfunc="hamming"):
     return thepcorr
 
 
+def _normalizedsegments(thedata, centers, halfwindow, thenormalizer):
+    # gather the window around each center into one row of a block, and normalize them all at once
+    thesegments = np.asarray(thedata, dtype=thenormalizer.dtype)[
+        centers[:, None] + np.arange(-halfwindow, halfwindow)[None, :]
+    ]
+    return thenormalizer.apply(thesegments, inplace=True)
+
+
 def shorttermcorr_1D(
     data1,
     data2,
@@ -227,23 +191,17 @@ def shorttermcorr_1D(
     """
     windowsize = int(windowtime // sampletime)
     halfwindow = int((windowsize + 1) // 2)
+    thenormalizer = tide_math.getcorrnormalizer(
+        2 * halfwindow, prewindow=prewindow, detrendorder=detrendorder, windowfunc=windowfunc
+    )
+    centers = np.arange(halfwindow, np.shape(data1)[0] - halfwindow, samplestep)
+    segments1 = _normalizedsegments(data1, centers, halfwindow, thenormalizer)
+    segments2 = _normalizedsegments(data2, centers, halfwindow, thenormalizer)
     times = []
     corrpertime = []
     ppertime = []
-    for i in range(halfwindow, np.shape(data1)[0] - halfwindow, samplestep):
-        dataseg1 = tide_math.corrnormalize(
-            data1[i - halfwindow : i + halfwindow],
-            prewindow=prewindow,
-            detrendorder=detrendorder,
-            windowfunc=windowfunc,
-        )
-        dataseg2 = tide_math.corrnormalize(
-            data2[i - halfwindow : i + halfwindow],
-            prewindow=prewindow,
-            detrendorder=detrendorder,
-            windowfunc=windowfunc,
-        )
-        thepcorr = sp.stats.stats.pearsonr(dataseg1, dataseg2)
+    for segnum, i in enumerate(centers):
+        thepcorr = sp.stats.stats.pearsonr(segments1[segnum, :], segments2[segnum, :])
         times.append(i * sampletime)
         corrpertime.append(thepcorr[0])
         ppertime.append(thepcorr[1])
@@ -293,18 +251,11 @@ def shorttermcorr_2D(
     if laglimit is None:
         laglimit = windowtime / 2.0
 
-    dataseg1 = tide_math.corrnormalize(
-        data1[0 : 2 * halfwindow],
-        prewindow=prewindow,
-        detrendorder=detrendorder,
-        windowfunc=windowfunc,
-    )
-    dataseg2 = tide_math.corrnormalize(
-        data2[0 : 2 * halfwindow],
-        prewindow=prewindow,
-        detrendorder=detrendorder,
-        windowfunc=windowfunc,
+    thenormalizer = tide_math.getcorrnormalizer(
+        2 * halfwindow, prewindow=prewindow, detrendorder=detrendorder, windowfunc=windowfunc
     )
+    dataseg1 = thenormalizer.apply(data1[0 : 2 * halfwindow])
+    dataseg2 = thenormalizer.apply(data2[0 : 2 * halfwindow])
     thexcorr = fastcorrelate(dataseg1, dataseg2, weighting=weighting)
     xcorrlen = np.shape(thexcorr)[0]
     xcorr_x = (
@@ -318,21 +269,14 @@ def shorttermcorr_2D(
     Rvals = []
     delayvals = []
     valid = []
-    for i in range(halfwindow, np.shape(data1)[0] - halfwindow, samplestep):
-        dataseg1 = tide_math.corrnormalize(
-            data1[i - halfwindow : i + halfwindow],
-            prewindow=prewindow,
-            detrendorder=detrendorder,
-            windowfunc=windowfunc,
-        )
-        dataseg2 = tide_math.corrnormalize(
-            data2[i - halfwindow : i + halfwindow],
-            prewindow=prewindow,
-            detrendorder=detrendorder,
-            windowfunc=windowfunc,
-        )
+    centers = np.arange(halfwindow, np.shape(data1)[0] - halfwindow, samplestep)
+    segments1 = _normalizedsegments(data1, centers, halfwindow, thenormalizer)
+    segments2 = _normalizedsegments(data2, centers, halfwindow, thenormalizer)
+    for segnum, i in enumerate(centers):
         times.append(i * sampletime)
-        xcorrpertime.append(fastcorrelate(dataseg1, dataseg2, weighting=weighting))
+        xcorrpertime.append(
+            fastcorrelate(segments1[segnum, :], segments2[segnum, :], weighting=weighting)
+        )
         maxindex, thedelayval, theRval, maxsigma, maskval, failreason, peakstart, peakend = tide_fit.findmaxlag_gauss(
             xcorr_x,
             xcorrpertime[-1],
@@ -199,6 +199,184 @@ def _procOneVoxelFitcorrx(
     )
 
 
+def _procVoxelBlockFitcorrx(
+    corrtcs,
+    corrscale,
+    genlagtc,
+    initial_fmri_x,
+    optiondict,
+    zerooutbadfit=True,
+    initiallags=None,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+):
+    # block version of _procOneVoxelFitcorrx for gaussian peak fitting - each row of corrtcs is a voxel
+    if initiallags is not None:
+        widthlimit = optiondict["despeckle_thresh"]
+    else:
+        widthlimit = optiondict["widthlimit"]
+    # the peak fits are always done in double precision - the block is small, and the fit
+    # iterations lose accuracy quickly in single precision
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend = tide_fit.findmaxlag_gauss_block(
+        corrscale,
+        np.asarray(corrtcs, dtype=np.float64),
+        optiondict["lagmin"],
+        optiondict["lagmax"],
+        widthlimit,
+        absmaxsigma=optiondict["absmaxsigma"],
+        edgebufferfrac=optiondict["edgebufferfrac"],
+        threshval=optiondict["lthreshval"],
+        uthreshval=optiondict["uthreshval"],
+        refine=optiondict["gaussrefine"],
+        refinetype=optiondict["peakfitrefine"],
+        fititers=optiondict["peakfititers"],
+        bipolar=optiondict["bipolar"],
+        maxguess=initiallags,
+        useguess=(initiallags is not None),
+        searchfrac=optiondict["searchfrac"],
+        fastgauss=optiondict["fastgauss"],
+        enforcethresh=optiondict["enforcethresh"],
+        zerooutbadfit=zerooutbadfit,
+        lagmod=optiondict["lagmod"],
+        hardlimit=optiondict["hardlimit"],
+    )
+    numvoxels, numlags = np.shape(corrtcs)
+
+    thelagtcs = genlagtc.yfromx(initial_fmri_x[None, :] - maxlag[:, None]).astype(
+        rt_floattype
+    )
+
+    # now tuck everything away, the same way _procOneVoxelFitcorrx does
+    thegood = np.logical_not((maskval == 0) & optiondict["zerooutbadfit"])
+    lagindices = np.arange(numlags)[None, :]
+    thewindowouts = np.where(
+        (lagindices >= peakstart[:, None])
+        & (lagindices <= peakend[:, None])
+        & np.logical_not(thegood)[:, None],
+        1.0,
+        0.0,
+    ).astype(rt_floattype)
+    thetimes = np.where(thegood, np.fmod(maxlag, optiondict["lagmod"]), 0.0).astype(
+        rt_floattype
+    )
+    thestrengths = np.where(thegood, maxval, 0.0).astype(rt_floattype)
+    thesigmas = np.where(thegood, maxsigma, 0.0).astype(rt_floattype)
+    theR2s = (thestrengths * thestrengths).astype(rt_floattype)
+    thegaussouts = np.zeros((numvoxels, numlags), dtype=rt_floattype)
+    hasgauss = np.where(thegood & (maxsigma != 0.0))[0]
+    if len(hasgauss) > 0:
+        thegaussouts[hasgauss, :] = maxval[hasgauss, None] * np.exp(
+            -((corrscale[None, :] - maxlag[hasgauss, None]) ** 2)
+            / (2.0 * maxsigma[hasgauss, None] * maxsigma[hasgauss, None])
+        )
+    return (
+        np.int64(thegood),
+        thelagtcs,
+        thetimes,
+        thestrengths,
+        thesigmas,
+        thegaussouts,
+        thewindowouts,
+        theR2s,
+        maskval,
+        failreason,
+    )
+
+
+def _countfailures(failreasons):
+    # returns ampfails, lagfails, windowfails, widthfails, edgefails, fitfails
+    return [
+        np.sum(((tide_fit.FML_BADAMPLOW | tide_fit.FML_BADAMPHIGH) & failreasons) > 0),
+        np.sum((tide_fit.FML_BADLAG & failreasons) > 0),
+        np.sum((tide_fit.FML_BADSEARCHWINDOW & failreasons) > 0),
+        np.sum((tide_fit.FML_BADWIDTH & failreasons) > 0),
+        np.sum((tide_fit.FML_HITEDGE & failreasons) > 0),
+        np.sum(((tide_fit.FML_FITFAIL | tide_fit.FML_INITFAIL) & failreasons) > 0),
+    ]
+
+
+def _fitcorrstage(voxels, arrays, params, showprogressbar=False):
+    corrout = arrays["corrout"]
+    initiallags = arrays["initiallags"]
+    lagtc = arrays["lagtc"]
+    lagtimes = arrays["lagtimes"]
+    lagstrengths = arrays["lagstrengths"]
+    lagsigma = arrays["lagsigma"]
+    gaussout = arrays["gaussout"]
+    windowout = arrays["windowout"]
+    R2 = arrays["R2"]
+    lagmask = arrays["lagmask"]
+    failimage = arrays["failimage"]
+    reportstep = 1000
+
+    # returns volumetotal, ampfails, lagfails, windowfails, widthfails, edgefails, fitfails
+    thecounts = np.zeros(7, dtype=np.int64)
+    blocksize = params["blocksize"]
+    if blocksize > 0:
+        for blockstart in range(0, len(voxels), blocksize):
+            blockend = np.min([blockstart + blocksize, len(voxels)])
+            thevoxels = np.asarray(voxels[blockstart:blockend])
+            if showprogressbar:
+                tide_util.progressbar(blockend, len(voxels), label="Percent complete")
+            if initiallags is None:
+                theselags = None
+            else:
+                theselags = initiallags[thevoxels]
+            thecorrtcs = corrout[thevoxels, :]
+            volumetotalincs, lagtc[thevoxels, :], lagtimes[thevoxels], lagstrengths[
+                thevoxels
+            ], lagsigma[thevoxels], gaussout[thevoxels, :], windowout[
+                thevoxels, :
+            ], R2[thevoxels], lagmask[
+                thevoxels
+            ], failreasons = _procVoxelBlockFitcorrx(
+                thecorrtcs,
+                params["corrscale"],
+                params["genlagtc"],
+                params["initial_fmri_x"],
+                params["optiondict"],
+                zerooutbadfit=params["zerooutbadfit"],
+                initiallags=theselags,
+                rt_floatset=params["rt_floatset"],
+                rt_floattype=params["rt_floattype"],
+            )
+            if params["optiondict"]["bipolar"]:
+                # the peak finder flips negative peaks in place, just as it does one voxel at a time
+                corrout[thevoxels, :] = thecorrtcs
+            failimage[thevoxels] = failreasons & 0x3F
+            thecounts[0] += np.sum(volumetotalincs)
+            thecounts[1:] += _countfailures(failreasons)
+        return thecounts
+    for i, vox in enumerate(voxels):
+        if (i % reportstep == 0 or i == len(voxels) - 1) and showprogressbar:
+            tide_util.progressbar(i + 1, len(voxels), label="Percent complete")
+        if initiallags is None:
+            thislag = None
+        else:
+            thislag = initiallags[vox]
+        dummy, volumetotalinc, lagtc[vox, :], lagtimes[vox], lagstrengths[
+            vox
+        ], lagsigma[vox], gaussout[vox, :], windowout[vox, :], R2[vox], lagmask[
+            vox
+        ], failreason = _procOneVoxelFitcorrx(
+            vox,
+            corrout[vox, :],
+            params["corrscale"],
+            params["genlagtc"],
+            params["initial_fmri_x"],
+            params["optiondict"],
+            zerooutbadfit=params["zerooutbadfit"],
+            displayplots=False,
+            initiallag=thislag,
+            rt_floatset=params["rt_floatset"],
+            rt_floattype=params["rt_floattype"],
+        )
+        failimage[vox] = failreason & 0x3F
+        thecounts[0] += volumetotalinc
+        thecounts[1:] += _countfailures(np.uint16(failreason))
+    return thecounts
+
+
 def fitcorrx(
     genlagtc,
     initial_fmri_x,
@@ -220,151 +398,79 @@ def fitcorrx(
     initiallags=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
+    pool=None,
 ):
-    displayplots = False
-    inputshape = np.shape(corrout)
+    if (
+        optiondict["fitblocksize"] > 0
+        and optiondict["findmaxtype"] == "gauss"
+        and not optiondict["fixdelay"]
+    ):
+        blocksize = optiondict["fitblocksize"]
+    else:
+        blocksize = 0
+    params = {
+        "blocksize": blocksize,
+        "corrscale": corrscale,
+        "genlagtc": genlagtc,
+        "initial_fmri_x": initial_fmri_x,
+        "optiondict": optiondict,
+        "zerooutbadfit": zerooutbadfit,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+    inputs = {"corrout": corrout, "initiallags": initiallags}
+    outputs = {
+        "lagtc": lagtc,
+        "lagtimes": lagtimes,
+        "lagstrengths": lagstrengths,
+        "lagsigma": lagsigma,
+        "gaussout": gaussout,
+        "windowout": windowout,
+        "R2": R2,
+        "lagmask": lagmask,
+        "failimage": failimage,
+    }
+    nprocs = optiondict["nprocs"]
     if initiallags is None:
-        themask = None
+        stageinputs = inputs
+        stageoutputs = outputs
     else:
-        themask = np.where(initiallags > -1000000.0, 1, 0)
-    reportstep = 1000
-    volumetotal, ampfails, lagfails, windowfails, widthfails, edgefails, fitfails = (
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
+        # despeckling - usually only a few percent of the voxels are refit, so gather them into
+        # compact arrays rather than sending (and copying) the whole volume through the stage
+        refitvoxels = np.where(initiallags > -1000000.0)[0]
+        stageinputs = {
+            "corrout": corrout[refitvoxels, :],
+            "initiallags": initiallags[refitvoxels],
+        }
+        stageoutputs = {}
+        for key, thearray in outputs.items():
+            stageoutputs[key] = thearray[refitvoxels]
+        pool = None
+        if len(refitvoxels) <= max(blocksize, 1):
+            # one vectorized block - not worth starting workers for
+            nprocs = 1
+    data_out = tide_multiproc.run_multiproc_stage(
+        _fitcorrstage,
+        stageinputs,
+        stageoutputs,
+        params,
+        np.shape(stageinputs["corrout"]),
+        None,
+        nprocs=nprocs,
+        pool=pool,
+        showprogressbar=optiondict["showprogressbar"],
+        chunksize=optiondict["mp_chunksize"],
     )
-    FML_BADAMPLOW = np.uint16(0x01)
-    FML_BADAMPHIGH = np.uint16(0x02)
-    FML_BADSEARCHWINDOW = np.uint16(0x04)
-    FML_BADWIDTH = np.uint16(0x08)
-    FML_BADLAG = np.uint16(0x10)
-    FML_HITEDGE = np.uint16(0x20)
-    FML_FITFAIL = np.uint16(0x40)
-    FML_INITFAIL = np.uint16(0x80)
-    zerolagtc = rt_floatset(genlagtc.yfromx(initial_fmri_x))
-    sliceoffsettime = 0.0
-
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def fitcorr_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    if initiallags is None:
-                        thislag = None
-                    else:
-                        thislag = initiallags[val]
-                    outQ.put(
-                        _procOneVoxelFitcorrx(
-                            val,
-                            corrout[val, :],
-                            corrscale,
-                            genlagtc,
-                            initial_fmri_x,
-                            optiondict,
-                            zerooutbadfit=zerooutbadfit,
-                            displayplots=displayplots,
-                            initiallag=thislag,
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            fitcorr_consumer,
-            inputshape,
-            themask,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
-        )
-
-        # unpack the data
-        volumetotal = 0
-        for voxel in data_out:
-            volumetotal += voxel[1]
-            lagtc[voxel[0], :] = voxel[2]
-            lagtimes[voxel[0]] = voxel[3]
-            lagstrengths[voxel[0]] = voxel[4]
-            lagsigma[voxel[0]] = voxel[5]
-            gaussout[voxel[0], :] = voxel[6]
-            windowout[voxel[0], :] = voxel[7]
-            R2[voxel[0]] = voxel[8]
-            lagmask[voxel[0]] = voxel[9]
-            failimage[voxel[0]] = voxel[10] & 0x3F
-        if (FML_BADAMPLOW | FML_BADAMPHIGH) & voxel[10]:
-            ampfails += 1
-        if FML_BADSEARCHWINDOW & voxel[10]:
-            windowfails += 1
-        if FML_BADWIDTH & voxel[10]:
-            widthfails += 1
-        if FML_BADLAG & voxel[10]:
-            lagfails += 1
-        if FML_HITEDGE & voxel[10]:
-            edgefails += 1
-        if (FML_FITFAIL | FML_INITFAIL) & voxel[10]:
-            fitfails += 1
-        del data_out
-    else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and optiondict[
-                "showprogressbar"
-            ]:
-                tide_util.progressbar(vox + 1, inputshape[0], label="Percent complete")
-            if themask is None:
-                dothisone = True
-                thislag = None
-            elif themask[vox] > 0:
-                dothisone = True
-                thislag = initiallags[vox]
-            else:
-                dothisone = False
-                thislag = None
-            if dothisone:
-                dummy, volumetotalinc, lagtc[vox, :], lagtimes[vox], lagstrengths[
-                    vox
-                ], lagsigma[vox], gaussout[vox, :], windowout[vox, :], R2[vox], lagmask[
-                    vox
-                ], failreason = _procOneVoxelFitcorrx(
-                    vox,
-                    corrout[vox, :],
-                    corrscale,
-                    genlagtc,
-                    initial_fmri_x,
-                    optiondict,
-                    zerooutbadfit=zerooutbadfit,
-                    displayplots=displayplots,
-                    initiallag=thislag,
-                    rt_floatset=rt_floatset,
-                    rt_floattype=rt_floattype,
-                )
-                volumetotal += volumetotalinc
-                if (FML_BADAMPLOW | FML_BADAMPHIGH) & failreason:
-                    ampfails += 1
-                if FML_BADSEARCHWINDOW & failreason:
-                    windowfails += 1
-                if FML_BADWIDTH & failreason:
-                    widthfails += 1
-                if FML_BADLAG & failreason:
-                    lagfails += 1
-                if FML_HITEDGE & failreason:
-                    edgefails += 1
-                if (FML_FITFAIL | FML_INITFAIL) & failreason:
-                    fitfails += 1
+    if initiallags is not None:
+        # put the refit values back
+        for key, thearray in outputs.items():
+            thearray[refitvoxels] = stageoutputs[key]
+        if optiondict["bipolar"]:
+            corrout[refitvoxels, :] = stageinputs["corrout"]
+    thecounts = np.sum(np.asarray(data_out).reshape((-1, 7)), axis=0)
+    volumetotal, ampfails, lagfails, windowfails, widthfails, edgefails, fitfails = [
+        int(thecount) for thecount in thecounts
+    ]
     print("\nCorrelation fitted in " + str(volumetotal) + " voxels")
     print(
         "\tampfails=",
@@ -26,8 +26,10 @@
 import gc
 
 import numpy as np
+from scipy import fftpack
 
 import rapidtide.correlate as tide_corr
+import rapidtide.filter as tide_filt
 import rapidtide.miscmath as tide_math
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.resample as tide_resample
@@ -110,6 +112,113 @@ def _procOneVoxelCorrelation(
     return vox, np.mean(thetc), thexcorr, theglobalmax
 
 
+def _procVoxelBlockCorrelation(
+    startvox,
+    endvox,
+    fmridata,
+    resampmatrix,
+    oversampfreq,
+    corrorigin,
+    lagmininpts,
+    lagmaxinpts,
+    ncprefilter,
+    reffft,
+    fftlen,
+    optiondict,
+    rt_floattype="float64",
+):
+    # resample the whole block at once (resampmatrix is already in the working precision)
+    if resampmatrix is not None:
+        theblock = np.dot(
+            np.asarray(fmridata[startvox:endvox, :], dtype=rt_floattype), np.transpose(resampmatrix)
+        )
+    else:
+        theblock = np.array(fmridata[startvox:endvox, :], dtype=rt_floattype)
+    themeans = np.mean(theblock, axis=1, dtype=np.float64)
+
+    # filter, then normalize, detrend, and window every timecourse in the block
+    theblock = ncprefilter.apply(oversampfreq, theblock)
+    preppedblock = tide_math.getcorrnormalizer(
+        np.shape(theblock)[1],
+        prewindow=optiondict["usewindowfunc"],
+        detrendorder=optiondict["detrendorder"],
+        windowfunc=optiondict["windowfunc"],
+        dtype=theblock.dtype,
+    ).apply(theblock, inplace=True)
+
+    # correlate against the reference in a single pair of transforms
+    numpoints = np.shape(preppedblock)[1]
+    thexcorrs = tide_filt.inverserealfft(
+        tide_filt.realfft(preppedblock, n=fftlen, axis=1) * reffft, n=fftlen, axis=1
+    )[:, : 2 * numpoints - 1]
+    theglobalmaxes = np.argmax(thexcorrs, axis=1)
+    return (
+        themeans,
+        thexcorrs[:, corrorigin - lagmininpts : corrorigin + lagmaxinpts],
+        theglobalmaxes,
+    )
+
+
+def _correlationstage(voxels, arrays, params, showprogressbar=False):
+    fmridata = arrays["fmridata"]
+    corrout = arrays["corrout"]
+    meanval = arrays["meanval"]
+    optiondict = params["optiondict"]
+    blocksize = params["blocksize"]
+    globalmaxes = np.zeros(len(voxels), dtype=np.int64)
+    reportstep = 1000
+    if blocksize > 0:
+        # transform the reference once, then process blocks of voxels as 2D arrays
+        for blockstart in range(0, len(voxels), blocksize):
+            # voxels is always a contiguous range here
+            blockend = np.min([blockstart + blocksize, len(voxels)])
+            startvox = voxels[blockstart]
+            endvox = voxels[blockend - 1] + 1
+            if showprogressbar:
+                tide_util.progressbar(blockend, len(voxels), label="Percent complete")
+            meanval[startvox:endvox], corrout[
+                startvox:endvox, :
+            ], globalmaxes[blockstart:blockend] = _procVoxelBlockCorrelation(
+                startvox,
+                endvox,
+                fmridata,
+                params["resampmatrix"],
+                params["oversampfreq"],
+                params["corrorigin"],
+                params["lagmininpts"],
+                params["lagmaxinpts"],
+                params["ncprefilter"],
+                params["reffft"],
+                params["fftlen"],
+                optiondict,
+                rt_floattype=params["rt_floattype"],
+            )
+    else:
+        thetc = np.zeros(np.shape(params["os_fmri_x"]), dtype=params["rt_floattype"])
+        for i, vox in enumerate(voxels):
+            if (i % reportstep == 0 or i == len(voxels) - 1) and showprogressbar:
+                tide_util.progressbar(i + 1, len(voxels), label="Percent complete")
+            dummy, meanval[vox], corrout[
+                vox, :
+            ], globalmaxes[i] = _procOneVoxelCorrelation(
+                vox,
+                thetc,
+                optiondict,
+                params["fmri_x"],
+                fmridata[vox, :],
+                params["os_fmri_x"],
+                params["oversampfreq"],
+                params["corrorigin"],
+                params["lagmininpts"],
+                params["lagmaxinpts"],
+                params["ncprefilter"],
+                params["referencetc"],
+                rt_floatset=params["rt_floatset"],
+                rt_floattype=params["rt_floattype"],
+            )
+    return voxels, globalmaxes
+
+
 def correlationpass(
     fmridata,
     fmrifftdata,
@@ -126,6 +235,7 @@ def correlationpass(
     optiondict,
     rt_floatset=np.float64,
     rt_floattype="float64",
+    pool=None,
 ):
     """
 
@@ -146,97 +256,67 @@ def correlationpass(
     optiondict
     rt_floatset
     rt_floattype
+    pool
 
     Returns
     -------
 
     """
-    oversampfreq = optiondict["oversampfactor"] / tr
     inputshape = np.shape(fmridata)
-    volumetotal = 0
-    reportstep = 1000
-    thetc = np.zeros(np.shape(os_fmri_x), dtype=rt_floattype)
-    theglobalmaxlist = []
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def correlation_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    outQ.put(
-                        _procOneVoxelCorrelation(
-                            val,
-                            thetc,
-                            optiondict,
-                            fmri_x,
-                            fmridata[val, :],
-                            os_fmri_x,
-                            oversampfreq,
-                            corrorigin,
-                            lagmininpts,
-                            lagmaxinpts,
-                            ncprefilter,
-                            referencetc,
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
-
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            correlation_consumer,
-            inputshape,
-            None,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
-        )
+    params = {
+        "optiondict": optiondict,
+        "fmri_x": fmri_x,
+        "os_fmri_x": os_fmri_x,
+        "oversampfreq": optiondict["oversampfactor"] / tr,
+        "corrorigin": corrorigin,
+        "lagmininpts": lagmininpts,
+        "lagmaxinpts": lagmaxinpts,
+        "ncprefilter": ncprefilter,
+        "referencetc": referencetc,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+        "blocksize": 0,
+    }
 
-        # unpack the data
-        volumetotal = 0
-        for voxel in data_out:
-            # corrmask[voxel[0]] = 1
-            meanval[voxel[0]] = voxel[1]
-            corrout[voxel[0], :] = voxel[2]
-            theglobalmaxlist.append(voxel[3] + 0)
-            volumetotal += 1
-        del data_out
-    else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and optiondict[
-                "showprogressbar"
-            ]:
-                tide_util.progressbar(vox + 1, inputshape[0], label="Percent complete")
-            dummy, meanval[vox], corrout[
-                vox, :
-            ], theglobalmax = _procOneVoxelCorrelation(
-                vox,
-                thetc,
-                optiondict,
-                fmri_x,
-                fmridata[vox, :],
-                os_fmri_x,
-                oversampfreq,
-                corrorigin,
-                lagmininpts,
-                lagmaxinpts,
-                ncprefilter,
-                referencetc,
-                rt_floatset=rt_floatset,
-                rt_floattype=rt_floattype,
+    # set up the batched version if we can use it
+    if optiondict["corrblocksize"] > 0 and optiondict["corrweighting"] == "none":
+        if optiondict["oversampfactor"] >= 1:
+            resampmatrix = tide_resample.resamplingmatrix(
+                fmri_x, os_fmri_x, method=optiondict["interptype"]
             )
-            theglobalmaxlist.append(theglobalmax + 0)
-            volumetotal += 1
+            # the far tails of the interpolation kernels are denormal in single precision, which
+            # makes the matrix product many times slower without changing the result
+            resampmatrix[np.fabs(resampmatrix) < np.finfo(rt_floattype).tiny] = 0.0
+            params["resampmatrix"] = resampmatrix.astype(rt_floattype)
+        else:
+            params["resampmatrix"] = None
+        numpoints = np.shape(os_fmri_x)[0]
+        params["fftlen"] = fftpack.next_fast_len(2 * numpoints - 1)
+        params["reffft"] = tide_filt.realfft(
+            np.asarray(referencetc[::-1], dtype=rt_floattype), n=params["fftlen"]
+        )
+        params["blocksize"] = optiondict["corrblocksize"]
+
+    data_out = tide_multiproc.run_multiproc_stage(
+        _correlationstage,
+        {"fmridata": fmridata},
+        {"corrout": corrout, "meanval": meanval},
+        params,
+        inputshape,
+        None,
+        nprocs=optiondict["nprocs"],
+        pool=pool,
+        showprogressbar=optiondict["showprogressbar"],
+        chunksize=optiondict["mp_chunksize"],
+    )
+
+    # gather up the locations of the global maxima
+    volumetotal = 0
+    globalmaxes = np.zeros(inputshape[0], dtype=np.int64)
+    for voxels, chunkmaxes in data_out:
+        globalmaxes[voxels] = chunkmaxes
+        volumetotal += len(voxels)
+    theglobalmaxlist = [theglobalmax + 0 for theglobalmax in globalmaxes]
     print("\nCorrelation performed on " + str(volumetotal) + " voxels")
 
     # garbage collect
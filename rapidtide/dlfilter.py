@@ -28,18 +28,12 @@ import os
 import sys
 from statsmodels.robust.scale import mad
 import glob
-from scipy import fftpack
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
 
 import rapidtide.io as tide_io
+import rapidtide.util as tide_util
+
+pyfftwexists = tide_util.pyfftwexists
+fftpack = tide_util.fftpack
 
 try:
     import plaidml.keras
@@ -25,56 +25,25 @@ package.
 
 
 import numpy as np
-from scipy import fftpack, ndimage, signal
-import pylab as pl
 import sys
 
+import rapidtide.util as tide_util
 
-try:
-    from memory_profiler import profile
+ndimage = tide_util.lazymodule("scipy.ndimage")
+scipyfft = tide_util.lazymodule("scipy.fft")
+signal = tide_util.lazymodule("scipy.signal")
+pl = tide_util.lazymodule("pylab")
 
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
 
-try:
-    from numba import jit
+memprofilerexists = tide_util.memprofilerexists
+nibabelexists = tide_util.nibabelexists
 
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
+pyfftwexists = tide_util.pyfftwexists
+fftpack = tide_util.fftpack
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- Filtering functions -------------------------------------------------
@@ -88,8 +57,9 @@ def padvec(inputdata, padlen=20):
 
     Parameters
     ----------
-    inputdata : 1D array
-        An array of any numerical type.
+    inputdata : array
+        An array of any numerical type.  Padding is applied along the last axis, so a
+        2D array of timecourses is padded row by row.
         :param inputdata:
     padlen : int, optional
         The number of points to remove from each end.  Default is 20.
@@ -103,7 +73,12 @@ def padvec(inputdata, padlen=20):
     """
     if padlen > 0:
         return np.concatenate(
-            (inputdata[::-1][-padlen:], inputdata, inputdata[::-1][0:padlen])
+            (
+                inputdata[..., ::-1][..., -padlen:],
+                inputdata,
+                inputdata[..., ::-1][..., 0:padlen],
+            ),
+            axis=-1,
         )
     else:
         return inputdata
@@ -115,8 +90,9 @@ def unpadvec(inputdata, padlen=20):
 
     Parameters
     ----------
-    inputdata : 1D array
-        An array of any numerical type.
+    inputdata : array
+        An array of any numerical type.  Padding is applied along the last axis, so a
+        2D array of timecourses is padded row by row.
         :param inputdata:
     padlen : int, optional
         The number of points to remove from each end.  Default is 20.
@@ -130,11 +106,57 @@ def unpadvec(inputdata, padlen=20):
 
     """
     if padlen > 0:
-        return inputdata[padlen:-padlen]
+        return inputdata[..., padlen:-padlen]
     else:
         return inputdata
 
 
+def realfft(inputdata, n=None, axis=-1):
+    r"""Real FFT that keeps single precision data in single precision.
+
+    numpy always transforms in double precision, so single precision data are transformed
+    with scipy.fft instead, which returns complex64.  Double precision data still go through
+    numpy, so their results don't change.
+
+    Parameters
+    ----------
+    inputdata : array
+        Real data
+    n : int, optional
+        Length of the transform (the data is zero padded or truncated to this length)
+    axis : int, optional
+        Axis to transform.  Default is the last.
+
+    Returns
+    -------
+    transformeddata : complex array
+    """
+    if inputdata.dtype == np.float32:
+        return scipyfft.rfft(inputdata, n=n, axis=axis)
+    return np.fft.rfft(inputdata, n=n, axis=axis)
+
+
+def inverserealfft(inputdata, n=None, axis=-1):
+    r"""Inverse of realfft.  complex64 data gives a float32 result.
+
+    Parameters
+    ----------
+    inputdata : complex array
+        Transformed data
+    n : int, optional
+        Length of the output
+    axis : int, optional
+        Axis to transform.  Default is the last.
+
+    Returns
+    -------
+    outputdata : real array
+    """
+    if inputdata.dtype == np.complex64:
+        return scipyfft.irfft(inputdata, n=n, axis=axis)
+    return np.fft.irfft(inputdata, n=n, axis=axis)
+
+
 def ssmooth(xsize, ysize, zsize, sigma, inputdata):
     r"""Applies an isotropic gaussian spatial filter to a 3D array
 
@@ -336,8 +358,8 @@ def transferfuncfilt(inputdata, transferfunc):
 
     Parameters
     ----------
-    inputdata : 1D float array
-        Input data to be filtered
+    inputdata : 1D or 2D float array
+        Input data to be filtered.  For 2D input, each row is filtered.
         :param inputdata:
 
     transferfunc : 1D float array
@@ -346,7 +368,7 @@ def transferfuncfilt(inputdata, transferfunc):
 
     Returns
     -------
-    filtereddata : 1D float array
+    filtereddata : 1D or 2D float array
         Filtered input data
     """
     inputdata_trans = transferfunc * fftpack.fft(inputdata)
@@ -380,14 +402,14 @@ def getlpfftfunc(Fs, upperpass, inputdata, debug=False):
     transferfunc : 1D float array
         The transfer function
     """
-    transferfunc = np.ones(np.shape(inputdata), dtype=np.float64)
+    transferfunc = np.ones(np.shape(inputdata)[-1], dtype=np.float64)
     cutoffbin = int((upperpass / Fs) * np.shape(transferfunc)[0])
     if debug:
         print(
             "getlpfftfunc - Fs, upperpass, len(inputdata):",
             Fs,
             upperpass,
-            np.shape(inputdata)[0],
+            np.shape(inputdata)[-1],
         )
     transferfunc[cutoffbin:-cutoffbin] = 0.0
     return transferfunc
@@ -544,7 +566,7 @@ def getlptrapfftfunc(Fs, upperpass, upperstop, inputdata, debug=False):
     transferfunc : 1D float array
         The transfer function
     """
-    transferfunc = np.ones(np.shape(inputdata), dtype="float64")
+    transferfunc = np.ones(np.shape(inputdata)[-1], dtype="float64")
     passbin = int((upperpass / Fs) * np.shape(transferfunc)[0])
     cutoffbin = int((upperstop / Fs) * np.shape(transferfunc)[0])
     transitionlength = cutoffbin - passbin
@@ -555,7 +577,7 @@ def getlptrapfftfunc(Fs, upperpass, upperstop, inputdata, debug=False):
             passbin,
             transitionlength,
             cutoffbin,
-            len(inputdata),
+            np.shape(inputdata)[-1],
         )
     if transitionlength > 0:
         transitionvector = np.arange(1.0 * transitionlength) / transitionlength
@@ -932,7 +954,6 @@ def csdfilter(obsdata, commondata, padlen=20, debug=False):
     return unpadvec(fftpack.ifft(obsdata_trans).real, padlen=padlen)
 
 
-@conditionaljit()
 def arb_pass(
     Fs,
     inputdata,
@@ -1059,7 +1080,6 @@ def arb_pass(
                 )
 
 
-@conditionaljit()
 def getarbpassfunc(
     Fs,
     inputdata,
@@ -1256,6 +1276,7 @@ class noncausalfilter:
         self.correctfreq = correctfreq
         self.padtime = padtime
         self.debug = debug
+        self.transferfuncs = {}
         self.VLF_UPPERPASS = 0.009
         self.VLF_UPPERSTOP = 0.010
         self.LF_LOWERSTOP = self.VLF_UPPERPASS
@@ -1357,24 +1378,31 @@ class noncausalfilter:
         self.upperpass = 1.0 * self.arb_upperpass
         self.upperstop = 1.0 * self.arb_upperstop
 
-    def apply(self, Fs, data):
-        r"""Apply the filter to a dataset.
-
-        Parameters
-        ----------
-        Fs : float
-            Sample frequency
-        data : 1D float array
-            The data to filter
+    def _cachekey(self, Fs, datalen):
+        # everything that the transfer function depends on
+        return (
+            Fs,
+            datalen,
+            self.filtertype,
+            self.lowerstop,
+            self.lowerpass,
+            self.upperpass,
+            self.upperstop,
+            self.arb_lowerstop,
+            self.arb_lowerpass,
+            self.arb_upperpass,
+            self.arb_upperstop,
+            self.usebutterworth,
+            self.butterworthorder,
+            self.usetrapfftfilt,
+            self.correctfreq,
+            self.padtime,
+        )
 
-        Returns
-        -------
-        filtereddata : 1D float array
-            The filtered data
-        """
+    def _checklimits(self, Fs, datalen):
         # do some bounds checking
         nyquistlimit = 0.5 * Fs
-        lowestfreq = 2.0 * Fs / np.shape(data)[0]
+        lowestfreq = 2.0 * Fs / datalen
 
         # first see if entire range is out of bounds
         if self.lowerpass >= nyquistlimit:
@@ -1456,99 +1484,120 @@ class noncausalfilter:
                 )
                 sys.exit()
 
-        if self.padtime < 0.0:
-            padlen = int(len(data) // 2)
-        else:
-            padlen = int(self.padtime * Fs)
-        if self.debug:
-            print("Fs=", Fs)
-            print("lowerstop=", self.lowerstop)
-            print("lowerpass=", self.lowerpass)
-            print("upperpass=", self.upperpass)
-            print("upperstop=", self.upperstop)
-            print("usebutterworth=", self.usebutterworth)
-            print("butterworthorder=", self.butterworthorder)
-            print("usetrapfftfilt=", self.usetrapfftfilt)
-            print("padtime=", self.padtime)
-            print("padlen=", padlen)
-
-        # now do the actual filtering
-        if self.filtertype == "none":
-            return data
-        elif self.filtertype == "ringstop":
-            return arb_pass(
-                Fs,
-                data,
-                0.0,
-                0.0,
-                Fs / 4.0,
-                1.1 * Fs / 4.0,
-                usebutterworth=self.usebutterworth,
-                butterorder=self.butterworthorder,
-                usetrapfftfilt=self.usetrapfftfilt,
-                padlen=padlen,
-                debug=self.debug,
-            )
-        elif (
-            self.filtertype == "vlf"
-            or self.filtertype == "lfo"
-            or self.filtertype == "resp"
-            or self.filtertype == "cardiac"
-        ):
-            return arb_pass(
-                Fs,
-                data,
-                self.lowerstop,
-                self.lowerpass,
-                self.upperpass,
-                self.upperstop,
-                usebutterworth=self.usebutterworth,
-                butterorder=self.butterworthorder,
-                usetrapfftfilt=self.usetrapfftfilt,
-                padlen=padlen,
-                debug=self.debug,
-            )
-        elif (
-            self.filtertype == "vlf_stop"
-            or self.filtertype == "lfo_stop"
-            or self.filtertype == "resp_stop"
-            or self.filtertype == "cardiac_stop"
-        ):
-            return data - arb_pass(
-                Fs,
-                data,
-                self.lowerstop,
-                self.lowerpass,
-                self.upperpass,
-                self.upperstop,
-                usebutterworth=self.usebutterworth,
-                butterorder=self.butterworthorder,
-                usetrapfftfilt=self.usetrapfftfilt,
-                padlen=padlen,
-                debug=self.debug,
-            )
-        elif self.filtertype == "arb":
-            return arb_pass(
-                Fs,
-                data,
+    def _getbandedges(self, Fs):
+        if self.filtertype == "ringstop":
+            return 0.0, 0.0, Fs / 4.0, 1.1 * Fs / 4.0
+        elif self.filtertype in [
+            "vlf",
+            "lfo",
+            "resp",
+            "cardiac",
+            "vlf_stop",
+            "lfo_stop",
+            "resp_stop",
+            "cardiac_stop",
+        ]:
+            return self.lowerstop, self.lowerpass, self.upperpass, self.upperstop
+        elif self.filtertype == "arb" or self.filtertype == "arb_stop":
+            return (
                 self.arb_lowerstop,
                 self.arb_lowerpass,
                 self.arb_upperpass,
                 self.arb_upperstop,
-                usebutterworth=self.usebutterworth,
-                butterorder=self.butterworthorder,
-                usetrapfftfilt=self.usetrapfftfilt,
-                padlen=padlen,
-                debug=self.debug,
             )
-        elif self.filtertype == "arb_stop":
-            return data - arb_pass(
+        else:
+            print("bad filter type")
+            sys.exit()
+
+    def _gettransferfunc(self, Fs, datalen, padlen):
+        # the FFT transfer function for padded data, laid out the same way as in arb_pass
+        lowerstop, lowerpass, upperpass, upperstop = self._getbandedges(Fs)
+        padinputdata = padvec(np.zeros(datalen, dtype=np.float64), padlen=padlen)
+        if lowerpass <= 0.0:
+            # lowpass
+            if self.usetrapfftfilt:
+                return getlptrapfftfunc(Fs, upperpass, upperstop, padinputdata)
+            else:
+                return getlpfftfunc(Fs, upperpass, padinputdata)
+        elif (upperpass >= Fs / 2.0) or (upperpass <= 0.0):
+            # highpass
+            if self.usetrapfftfilt:
+                return 1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata)
+            else:
+                return 1.0 - getlpfftfunc(Fs, lowerpass, padinputdata)
+        else:
+            # bandpass
+            if self.usetrapfftfilt:
+                return getlptrapfftfunc(Fs, upperpass, upperstop, padinputdata) * (
+                    1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata)
+                )
+            else:
+                return getlpfftfunc(Fs, upperpass, padinputdata) * (
+                    1.0 - getlpfftfunc(Fs, lowerpass, padinputdata)
+                )
+
+    def apply(self, Fs, data):
+        r"""Apply the filter to a dataset.
+
+        The limit checks and the FFT transfer function only depend on the filter settings, the
+        sample frequency and the length of the data, so they are done once and cached - repeated
+        calls with the same parameters (for example, once per voxel) only do the FFTs.
+
+        Parameters
+        ----------
+        Fs : float
+            Sample frequency
+        data : float array
+            The data to filter.  Filtering is done along the last axis, so a 2D array
+            with one timecourse per row is filtered in a single pass.
+
+        Returns
+        -------
+        filtereddata : float array
+            The filtered data
+        """
+        datalen = np.shape(data)[-1]
+        thekey = self._cachekey(Fs, datalen)
+        if thekey in self.transferfuncs:
+            padlen, transferfunc = self.transferfuncs[thekey]
+        else:
+            self._checklimits(Fs, datalen)
+            if self.padtime < 0.0:
+                padlen = int(datalen // 2)
+            else:
+                padlen = int(self.padtime * Fs)
+            if self.debug:
+                print("Fs=", Fs)
+                print("lowerstop=", self.lowerstop)
+                print("lowerpass=", self.lowerpass)
+                print("upperpass=", self.upperpass)
+                print("upperstop=", self.upperstop)
+                print("usebutterworth=", self.usebutterworth)
+                print("butterworthorder=", self.butterworthorder)
+                print("usetrapfftfilt=", self.usetrapfftfilt)
+                print("padtime=", self.padtime)
+                print("padlen=", padlen)
+            if (self.filtertype == "none") or self.usebutterworth:
+                transferfunc = None
+            else:
+                transferfunc = self._gettransferfunc(Fs, datalen, padlen)
+
+            # the limit checks may have moved the band edges, so file it under both keys
+            self.transferfuncs[thekey] = (padlen, transferfunc)
+            self.transferfuncs[self._cachekey(Fs, datalen)] = (padlen, transferfunc)
+
+        # now do the actual filtering
+        if self.filtertype == "none":
+            return data
+        if transferfunc is None:
+            lowerstop, lowerpass, upperpass, upperstop = self._getbandedges(Fs)
+            filtereddata = arb_pass(
                 Fs,
                 data,
-                self.arb_lowerstop,
-                self.arb_lowerpass,
-                self.arb_upperpass,
-                self.arb_upperstop,
+                lowerstop,
+                lowerpass,
+                upperpass,
+                upperstop,
                 usebutterworth=self.usebutterworth,
                 butterorder=self.butterworthorder,
                 usetrapfftfilt=self.usetrapfftfilt,
@@ -1556,8 +1605,13 @@ class noncausalfilter:
                 debug=self.debug,
             )
         else:
-            print("bad filter type")
-            sys.exit()
+            inputdata_trans = fftpack.fft(padvec(data, padlen=padlen))
+            inputdata_trans *= transferfunc
+            filtereddata = unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+        if self.filtertype.endswith("_stop"):
+            return data - filtereddata
+        else:
+            return filtereddata
 
 
 # --------------------------- Window functions -------------------------------------------------
@@ -19,74 +19,40 @@
 # $Id: tide_funcs.py,v 1.4 2016/07/12 13:50:29 frederic Exp $
 #
 
+import warnings
+
 import numpy as np
-import pylab as pl
 import scipy as sp
 import scipy.special as sps
-from scipy.signal import hilbert
 
 import rapidtide.util as tide_util
 
+pl = tide_util.lazymodule("pylab")
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder: int = 6
 MAXLINES: int = 10000000
 donotbeaggressive: bool = True
 
-# ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
+# fit failure flags from findmaxlag_gauss_rev and findmaxlag_gauss_block
+FML_BADAMPLOW = np.uint16(0x01)
+FML_BADAMPHIGH = np.uint16(0x02)
+FML_BADSEARCHWINDOW = np.uint16(0x04)
+FML_BADWIDTH = np.uint16(0x08)
+FML_BADLAG = np.uint16(0x10)
+FML_HITEDGE = np.uint16(0x20)
+FML_FITFAIL = np.uint16(0x40)
+FML_INITFAIL = np.uint16(0x80)
 
+# ----------------------------------------- Conditional imports ---------------------------------------
+memprofilerexists = tide_util.memprofilerexists
+nibabelexists = tide_util.nibabelexists
 
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
-
-    return resdec
+pyfftwexists = tide_util.pyfftwexists
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- Fitting functions -------------------------------------------------
@@ -123,7 +89,7 @@ def gaussskresiduals(p, y, x):
     return y - gausssk_eval(x, p)
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def gaussresiduals(p, y, x):
     """
 
@@ -189,7 +155,6 @@ def gausssk_eval(x: float, p):
     return p[0] * sp.stats.norm.pdf(t) * sp.stats.norm.cdf(p[3] * t)
 
 
-@conditionaljit()
 def kaiserbessel_eval(x, p):
     """
 
@@ -213,7 +178,7 @@ def kaiserbessel_eval(x, p):
     )
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def gauss_eval(x, p):
     """
 
@@ -229,6 +194,7 @@ def gauss_eval(x, p):
     return p[0] * np.exp(-(x - p[1]) ** 2 / (2.0 * p[2] * p[2]))
 
 
+@tide_util.numbakernel()
 def trapezoid_eval_loop(x, toplength, p):
     """
 
@@ -242,12 +208,20 @@ def trapezoid_eval_loop(x, toplength, p):
     -------
 
     """
-    r = np.zeros(len(x), dtype="float64")
+    # the body of trapezoid_eval is repeated here so the loop compiles as a single kernel
+    r = np.zeros(len(x), dtype=np.float64)
     for i in range(0, len(x)):
-        r[i] = trapezoid_eval(x[i], toplength, p)
+        corrx = x[i] - p[0]
+        if corrx < 0.0:
+            r[i] = 0.0
+        elif corrx < toplength:
+            r[i] = p[1] * (1.0 - np.exp(-corrx / p[2]))
+        else:
+            r[i] = p[1] * (np.exp(-(corrx - toplength) / p[3]))
     return r
 
 
+@tide_util.numbakernel()
 def risetime_eval_loop(x, p):
     """
 
@@ -260,13 +234,18 @@ def risetime_eval_loop(x, p):
     -------
 
     """
-    r = np.zeros(len(x), dtype="float64")
+    # the body of risetime_eval is repeated here so the loop compiles as a single kernel
+    r = np.zeros(len(x), dtype=np.float64)
     for i in range(0, len(x)):
-        r[i] = risetime_eval(x[i], p)
+        corrx = x[i] - p[0]
+        if corrx < 0.0:
+            r[i] = 0.0
+        else:
+            r[i] = p[1] * (1.0 - np.exp(-corrx / p[2]))
     return r
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def trapezoid_eval(x, toplength, p):
     """
 
@@ -289,7 +268,7 @@ def trapezoid_eval(x, toplength, p):
         return p[1] * (np.exp(-(corrx - toplength) / p[3]))
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def risetime_eval(x, p):
     """
 
@@ -373,7 +352,7 @@ def locpeak(
 
 
 # generate the polynomial fit timecourse from the coefficients
-@conditionaljit()
+@tide_util.numbakernel()
 def trendgen(thexvals, thefitcoffs, demean):
     """
 
@@ -400,27 +379,57 @@ def trendgen(thexvals, thefitcoffs, demean):
     return thefit
 
 
-@conditionaljit()
+# the detrending basis only depends on the length, order, and demean flag, so keep it around
+_detrendbasiscache = {}
+
+
+def _detrendbasis(numpoints, order, demean):
+    # returns (thetrend, theprojection), such that the trend that detrend removes from a timecourse
+    # y is np.dot(thetrend, np.dot(theprojection, y)).  theprojection gives the same polynomial
+    # coefficients as np.polyfit, computed once from a QR factorization of the (column scaled)
+    # Vandermonde matrix.
+    thekey = (numpoints, order, demean)
+    if thekey not in _detrendbasiscache:
+        thetimepoints = np.arange(0.0, numpoints, 1.0) - numpoints / 2.0
+        thevander = np.vander(thetimepoints, order + 1)
+        thescale = np.sqrt(np.sum(thevander * thevander, axis=0))
+        theq, ther = np.linalg.qr(thevander / thescale)
+        theprojection = np.linalg.solve(ther, np.transpose(theq)) / thescale[:, None]
+        if demean:
+            _detrendbasiscache[thekey] = (thevander, theprojection)
+        else:
+            # leave the constant term in, just as trendgen does
+            _detrendbasiscache[thekey] = (thevander[:, :-1], theprojection[:-1, :])
+    return _detrendbasiscache[thekey]
+
+
 def detrend(inputdata, order=1, demean=False):
-    """
+    """Remove a polynomial trend from a timecourse, or from every row of a 2D array at once.
 
     Parameters
     ----------
-    inputdata
-    order
-    demean
+    inputdata : 1D or 2D float array
+        The timecourse(s).  For 2D input, each row is detrended separately.
+    order : int, optional
+        Order of the polynomial trend.  Default is 1.
+    demean : bool, optional
+        If True, remove the constant term of the fit as well.  Default is False.
 
     Returns
     -------
-
+    detrended : float array
+        inputdata with the trend removed
     """
-    thetimepoints = np.arange(0.0, len(inputdata), 1.0) - len(inputdata) / 2.0
-    thecoffs = np.polyfit(thetimepoints, inputdata, order)
-    thefittc = trendgen(thetimepoints, thecoffs, demean)
-    return inputdata - thefittc
+    inputdata = np.asarray(inputdata)
+    thetrend, theprojection = _detrendbasis(np.shape(inputdata)[-1], order, demean)
+    if inputdata.ndim == 1:
+        return inputdata - np.dot(thetrend, np.dot(theprojection, inputdata))
+    return inputdata - np.dot(
+        np.dot(inputdata, np.transpose(theprojection)), np.transpose(thetrend)
+    )
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def findfirstabove(theyvals, thevalue):
     """
 
@@ -563,7 +572,7 @@ def findrisetimefunc(
         return 0.0, 0.0, 0.0, 0
 
 
-@conditionaljit2()
+@tide_util.numbakernel(aggressive=True)
 def findmaxlag_gauss(
     thexcorr_x,
     thexcorr_y,
@@ -639,14 +648,6 @@ def findmaxlag_gauss(
             upperlim - 1
         ) > lowerlim:
             upperlim -= 1
-    FML_BADAMPLOW = np.uint16(0x01)
-    FML_BADAMPHIGH = np.uint16(0x02)
-    FML_BADSEARCHWINDOW = np.uint16(0x04)
-    FML_BADWIDTH = np.uint16(0x08)
-    FML_BADLAG = np.uint16(0x10)
-    FML_HITEDGE = np.uint16(0x20)
-    FML_FITFAIL = np.uint16(0x40)
-    FML_INITFAIL = np.uint16(0x80)
 
     # make an initial guess at the fit parameters for the gaussian
     # start with finding the maximum value
@@ -807,7 +808,7 @@ def findmaxlag_gauss(
     return maxindex, maxlag, maxval, maxsigma, maskval, failreason, fitstart, fitend
 
 
-@conditionaljit2()
+@tide_util.numbakernel(aggressive=True)
 def maxindex_noedge(thexcorr_x, thexcorr_y, bipolar=False):
     """
 
@@ -851,7 +852,7 @@ def maxindex_noedge(thexcorr_x, thexcorr_y, bipolar=False):
 
 
 # disabled conditionaljit on 11/8/16.  This causes crashes on some machines (but not mine, strangely enough)
-@conditionaljit2()
+@tide_util.numbakernel(aggressive=True)
 def findmaxlag_gauss_rev(
     thexcorr_x,
     thexcorr_y,
@@ -927,14 +928,6 @@ def findmaxlag_gauss_rev(
 
     # define error values
     failreason = np.uint16(0)
-    FML_BADAMPLOW = np.uint16(0x01)
-    FML_BADAMPHIGH = np.uint16(0x02)
-    FML_BADSEARCHWINDOW = np.uint16(0x04)
-    FML_BADWIDTH = np.uint16(0x08)
-    FML_BADLAG = np.uint16(0x10)
-    FML_HITEDGE = np.uint16(0x20)
-    FML_FITFAIL = np.uint16(0x40)
-    FML_INITFAIL = np.uint16(0x80)
 
     # set the search range
     lowerlim = 0
@@ -1163,7 +1156,346 @@ def findmaxlag_gauss_rev(
     )
 
 
-@conditionaljit2()
+def _gaussfitblock(thexcorr_x, thexcorr_y, peakstart, peakend, p0, numiters=30):
+    # damped Gauss-Newton fit of a gaussian to thexcorr_y[peakstart:peakend] in every row, with a fixed
+    # iteration count.  Pull the windows out into a compact array first, since they are much shorter than
+    # the correlation functions.
+    numrows = np.shape(thexcorr_y)[0]
+    windowlen = np.maximum(peakend - peakstart, 0)
+    maxlen = int(np.max([1, np.max(windowlen)]))
+    windowindices = np.minimum(
+        peakstart[:, None] + np.arange(maxlen)[None, :], len(thexcorr_x) - 1
+    )
+    thewindow = np.float64(np.arange(maxlen)[None, :] < windowlen[:, None])
+    X = thexcorr_x[windowindices]
+    thedata = thexcorr_y[np.arange(numrows)[:, None], windowindices].astype("float64")
+    thep = np.array(p0, dtype=np.float64)
+    lam = np.full(numrows, 1e-3)
+
+    def blocksse(p):
+        with np.errstate(all="ignore"):
+            resid = (
+                thedata
+                - p[:, 0:1] * np.exp(-((X - p[:, 1:2]) ** 2) / (2.0 * p[:, 2:3] ** 2))
+            ) * thewindow
+        return resid, np.sum(resid * resid, axis=1)
+
+    resid, sse = blocksse(thep)
+    for i in range(numiters):
+        with np.errstate(all="ignore"):
+            xoffset = X - thep[:, 1:2]
+            sigsq = thep[:, 2:3] ** 2
+            expterm = np.exp(-(xoffset ** 2) / (2.0 * sigsq)) * thewindow
+            thejac = np.stack(
+                (
+                    expterm,
+                    thep[:, 0:1] * expterm * xoffset / sigsq,
+                    thep[:, 0:1] * expterm * xoffset ** 2 / (sigsq * thep[:, 2:3]),
+                ),
+                axis=2,
+            )
+            jtj = np.einsum("nki,nkj->nij", thejac, thejac)
+            jtr = np.einsum("nki,nk->ni", thejac, resid)
+            damped = jtj + lam[:, None, None] * (jtj * np.eye(3)[None, :, :])
+            good = np.all(np.isfinite(damped.reshape((numrows, 9))), axis=1) & np.all(
+                np.isfinite(jtr), axis=1
+            )
+            good[good] = np.fabs(np.linalg.det(damped[good])) > 0.0
+        thestep = np.zeros((numrows, 3), dtype=np.float64)
+        if np.any(good):
+            thestep[good] = np.linalg.solve(damped[good], jtr[good][:, :, None])[:, :, 0]
+        newresid, newsse = blocksse(thep + thestep)
+        improved = good & (newsse < sse)
+        thep[improved] += thestep[improved]
+        resid[improved] = newresid[improved]
+        sse[improved] = newsse[improved]
+        lam = np.where(improved, lam / 10.0, lam * 10.0)
+    thep[:, 2] = np.fabs(thep[:, 2])
+    return thep
+
+
+def findmaxlag_gauss_block(
+    thexcorr_x,
+    thexcorr_y,
+    lagmin,
+    lagmax,
+    widthlimit,
+    absmaxsigma=1000.0,
+    hardlimit=True,
+    bipolar=False,
+    edgebufferfrac=0.0,
+    threshval=0.0,
+    uthreshval=1.0,
+    zerooutbadfit=True,
+    refine=False,
+    refinetype="gaussnewton",
+    fititers=30,
+    maxguess=None,
+    useguess=False,
+    searchfrac=0.5,
+    fastgauss=False,
+    lagmod=1000.0,
+    enforcethresh=True,
+):
+    """Fit the peaks of a block of correlation functions at once.
+
+    This applies the same rules as findmaxlag_gauss_rev to every row of thexcorr_y, and returns
+    identical values (and failure codes) if refine is False or fastgauss is True.  Otherwise the
+    least squares fit is replaced by a vectorized refinement of the initial estimate.
+
+    Parameters
+    ----------
+    thexcorr_x:  1D float array
+        The time axis of the correlation functions
+    thexcorr_y: 2D float array
+        The correlation functions, one per row.  As in findmaxlag_gauss_rev, rows are flipped in place
+        if bipolar is True and their peak is negative.
+    refinetype: {'gaussnewton', 'logparabola'}, optional
+        How to refine the peak if refine is True and fastgauss is False.  'gaussnewton' does a damped
+        Gauss-Newton fit of a gaussian over the peak with fititers iterations (fits that do not settle
+        on an acceptable answer are redone with leastsq, so failure codes match); 'logparabola' fits a
+        parabola to the log of the three points around the maximum, which is exact for a gaussian.
+    fititers: int, optional
+        Number of iterations for the 'gaussnewton' refinement.
+    maxguess: 1D float array, optional
+        The starting lag for every row, used if useguess is True.
+
+    The remaining parameters are the same as for findmaxlag_gauss_rev.
+
+    Returns
+    -------
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend: 1D arrays
+        One entry for each row of thexcorr_y.
+    """
+    numrows, numlagbins = np.shape(thexcorr_y)
+    binwidth = thexcorr_x[1] - thexcorr_x[0]
+    rowindices = np.arange(numrows)
+    failreason = np.zeros(numrows, dtype=np.uint16)
+
+    # find the maximum value and its location, the same way maxindex_noedge does
+    flipfac = np.ones(numrows, dtype=np.float64)
+    if useguess:
+        maxindex = np.array(
+            [tide_util.valtoindex(thexcorr_x, theguess) for theguess in maxguess], dtype=int
+        )
+    else:
+        for lowerlim in [0, 1]:
+            if lowerlim == 0:
+                todo = rowindices
+            else:
+                todo = np.where(maxindex == 0)[0]
+                if len(todo) == 0:
+                    break
+            thesection = thexcorr_y[todo, lowerlim : numlagbins - 1]
+            newmaxindex = np.argmax(thesection, axis=1) + lowerlim
+            newflipfac = np.ones(len(todo), dtype=np.float64)
+            if bipolar:
+                minindex = np.argmax(np.fabs(thesection), axis=1) + lowerlim
+                useminindex = np.fabs(thexcorr_y[todo, minindex]) > np.fabs(
+                    thexcorr_y[todo, newmaxindex]
+                )
+                newmaxindex = np.where(useminindex, minindex, newmaxindex)
+                newflipfac[useminindex] = -1.0
+            if lowerlim == 0:
+                maxindex = newmaxindex
+                flipfac = newflipfac
+            else:
+                maxindex[todo] = newmaxindex
+                flipfac[todo] = newflipfac
+        flipped = np.where(flipfac < 0.0)[0]
+        if len(flipped) > 0:
+            thexcorr_y[flipped, :] *= -1.0
+    maxlag_init = (1.0 * thexcorr_x[maxindex]).astype("float64")
+    maxval_init = thexcorr_y[rowindices, maxindex].astype("float64")
+
+    # walk out from the maximum to find the extent of the peak
+    thegrad = np.gradient(thexcorr_y, axis=1).astype("float64")
+    peakpoints = thexcorr_y > searchfrac * maxval_init[:, None]
+    peakpoints[:, 0] = False
+    peakpoints[:, -1] = False
+    binindices = np.arange(numlagbins)
+    canextend = (thegrad < 0.0) & peakpoints
+    canextend[:, numlagbins - 1 :] = False
+    stopabove = np.minimum.accumulate(
+        np.where(canextend, numlagbins, binindices)[:, ::-1], axis=1
+    )[:, ::-1]
+    stopabove = np.hstack((stopabove, np.full((numrows, 1), numlagbins)))
+    peakend = np.where(
+        maxindex < numlagbins - 2,
+        stopabove[rowindices, np.minimum(maxindex + 1, numlagbins)] - 1,
+        maxindex,
+    )
+    canextend = (thegrad > 0.0) & peakpoints
+    canextend[:, 0] = False
+    stopbelow = np.maximum.accumulate(np.where(canextend, -1, binindices), axis=1)
+    peakstart = np.where(
+        maxindex > 1, stopbelow[rowindices, np.maximum(maxindex - 1, 0)] + 1, maxindex
+    )
+    maxsigma_init = np.float64(
+        ((peakend - peakstart + 1) * binwidth / (2.0 * np.sqrt(-np.log(searchfrac))))
+        / np.sqrt(2.0)
+    )
+
+    # now check the values for errors
+    if hardlimit:
+        rangeextension = 0.0
+    else:
+        rangeextension = (lagmax - lagmin) * 0.75
+    badlag = np.logical_not(
+        ((lagmin - rangeextension - binwidth) <= maxlag_init)
+        & (maxlag_init <= (lagmax + rangeextension + binwidth))
+    )
+    failreason[badlag] |= FML_INITFAIL | FML_BADLAG
+    maxlag_init = np.where(
+        badlag & ((lagmin - rangeextension - binwidth) <= maxlag_init),
+        lagmin - rangeextension - binwidth,
+        np.where(badlag, lagmax + rangeextension + binwidth, maxlag_init),
+    )
+    badwidth = maxsigma_init > absmaxsigma
+    failreason[badwidth] |= FML_INITFAIL | FML_BADWIDTH
+    maxsigma_init[badwidth] = absmaxsigma
+    badwindow = (peakend - peakstart) < 2
+    failreason[badwindow] |= FML_INITFAIL | FML_BADSEARCHWINDOW
+    maxsigma_init[badwindow] = np.float64(
+        ((2 + 1) * binwidth / (2.0 * np.sqrt(-np.log(searchfrac)))) / np.sqrt(2.0)
+    )
+    if enforcethresh:
+        badamp = np.logical_not((threshval <= maxval_init) & (maxval_init <= uthreshval))
+        failreason[badamp] |= FML_INITFAIL | FML_BADAMPLOW
+    lowamp = maxval_init < 0.0
+    failreason[lowamp] |= FML_INITFAIL | FML_BADAMPLOW
+    maxval_init[lowamp] = 0.0
+    highamp = maxval_init > 1.0
+    failreason[highamp] |= FML_INITFAIL | FML_BADAMPHIGH
+    maxval_init[highamp] = 1.0
+
+    maskval = np.ones(numrows, dtype=np.uint16)
+    if refine:
+        windowlen = peakend - peakstart
+        with np.errstate(all="ignore"):
+            if fastgauss:
+                thewindow = np.float64(
+                    (binindices[None, :] >= peakstart[:, None])
+                    & (binindices[None, :] < peakend[:, None])
+                )
+                # do a non-iterative fit over the top of the peak
+                windowsums = np.sum(thexcorr_y * thewindow, axis=1)
+                maxlag = np.float64(
+                    np.sum(thexcorr_x[None, :] * thexcorr_y * thewindow, axis=1) / windowsums
+                )
+                maxsigma = np.float64(
+                    np.sqrt(
+                        np.abs(
+                            np.sum(
+                                (thexcorr_x[None, :] - maxlag[:, None]) ** 2 * thexcorr_y * thewindow,
+                                axis=1,
+                            )
+                            / windowsums
+                        )
+                    )
+                )
+                maxval = np.float64(
+                    np.max(np.where(thewindow > 0.0, thexcorr_y, -np.inf), axis=1)
+                )
+                maxval[windowlen < 1] = np.nan
+            else:
+                if refinetype == "logparabola":
+                    leftindex = np.maximum(maxindex - 1, 0)
+                    rightindex = np.minimum(maxindex + 1, numlagbins - 1)
+                    logleft = np.log(thexcorr_y[rowindices, leftindex].astype("float64"))
+                    logcenter = np.log(thexcorr_y[rowindices, maxindex].astype("float64"))
+                    logright = np.log(thexcorr_y[rowindices, rightindex].astype("float64"))
+                    thecurve = logleft - 2.0 * logcenter + logright
+                    theoffset = 0.5 * (logleft - logright) / thecurve
+                    maxval = np.exp(logcenter - 0.25 * (logleft - logright) * theoffset)
+                    maxlag = np.fmod(thexcorr_x[maxindex] + theoffset * binwidth, lagmod)
+                    maxsigma = np.sqrt(-(binwidth * binwidth) / thecurve)
+                    maxsigma[thecurve >= 0.0] = np.nan
+                else:
+                    p0 = np.transpose(np.vstack((maxval_init, maxlag_init, maxsigma_init)))
+                    plsq = _gaussfitblock(
+                        thexcorr_x, thexcorr_y, peakstart, peakend, p0, numiters=fititers
+                    )
+                    # fits to very short windows, and fits that don't settle, are ill conditioned, so
+                    # where they end up depends on the optimizer - redo those with leastsq, exactly as
+                    # findmaxlag_gauss_rev does
+                    fitlags = np.fmod(plsq[:, 1], lagmod)
+                    unsettled = np.where(
+                        (windowlen >= 3)
+                        & np.logical_not(
+                            (windowlen >= 5)
+                            & np.all(np.isfinite(plsq), axis=1)
+                            & (np.fabs(plsq[:, 0]) <= 1.0)
+                            & (lagmin <= fitlags)
+                            & (fitlags <= lagmax)
+                            & (0.0 < plsq[:, 2])
+                            & (plsq[:, 2] <= absmaxsigma)
+                        )
+                    )[0]
+                    with warnings.catch_warnings():
+                        warnings.filterwarnings("ignore", "Number*")
+                        for i in unsettled:
+                            try:
+                                plsq[i, :], dummy = sp.optimize.leastsq(
+                                    gaussresiduals,
+                                    p0[i, :],
+                                    args=(
+                                        thexcorr_y[i, peakstart[i] : peakend[i]],
+                                        thexcorr_x[peakstart[i] : peakend[i]],
+                                    ),
+                                    maxfev=5000,
+                                )
+                            except:
+                                plsq[i, :] = 0.0
+                    maxval = plsq[:, 0]
+                    maxlag = np.fmod((1.0 * plsq[:, 1]), lagmod)
+                    maxsigma = plsq[:, 2]
+                # leastsq refuses to fit three parameters to fewer than three points
+                toofew = windowlen < 3
+                maxval[toofew] = 0.0
+                maxlag[toofew] = 0.0
+                maxsigma[toofew] = 0.0
+
+            # check for errors in fit
+            failreason = np.zeros(numrows, dtype=np.uint16)
+            badamp = np.logical_not((0.0 <= np.fabs(maxval)) & (np.fabs(maxval) <= 1.0))
+            failreason[badamp] |= FML_FITFAIL + FML_BADAMPLOW
+            lowlag = lagmin > maxlag
+            highlag = maxlag > lagmax
+            failreason[lowlag | highlag] |= FML_FITFAIL + FML_BADLAG
+            maxlag[lowlag] = lagmin
+            maxlag[highlag & np.logical_not(lowlag)] = lagmax
+            badwidth = maxsigma > absmaxsigma
+            failreason[badwidth] |= FML_FITFAIL + FML_BADWIDTH
+            maxsigma[badwidth] = absmaxsigma
+            badwindow = np.logical_not(0.0 < maxsigma)
+            failreason[badwindow] |= FML_FITFAIL + FML_BADSEARCHWINDOW
+            maxsigma[badwindow] = 0.0
+        fitfail = failreason > 0
+        if zerooutbadfit:
+            maxval[fitfail] = 0.0
+            maxlag[fitfail] = 0.0
+            maxsigma[fitfail] = 0.0
+        maskval[fitfail] = 0
+    else:
+        maxval = np.float64(maxval_init)
+        maxlag = np.float64(np.fmod(maxlag_init, lagmod))
+        maxsigma = np.float64(maxsigma_init)
+        maskval[failreason > 0] = 0
+
+    return (
+        maxindex,
+        maxlag,
+        flipfac * maxval,
+        maxsigma,
+        maskval,
+        failreason,
+        peakstart,
+        peakend,
+    )
+
+
+@tide_util.numbakernel(aggressive=True)
 def findmaxlag_quad(
     thexcorr_x,
     thexcorr_y,
@@ -1234,14 +1566,6 @@ def findmaxlag_quad(
             upperlim - 1
         ) > lowerlim:
             upperlim -= 1
-    FML_BADAMPLOW = np.uint16(0x01)
-    FML_BADAMPHIGH = np.uint16(0x02)
-    FML_BADSEARCHWINDOW = np.uint16(0x04)
-    FML_BADWIDTH = np.uint16(0x08)
-    FML_BADLAG = np.uint16(0x10)
-    FML_HITEDGE = np.uint16(0x20)
-    FML_FITFAIL = np.uint16(0x40)
-    FML_INITFAIL = np.uint16(0x80)
 
     # make an initial guess at the fit parameters for the gaussian
     # start with finding the maximum value
@@ -1652,6 +1976,8 @@ def peakdetect(y_axis, x_axis=None, lookahead=200, delta=0.0):
 
 
 def phaseanalysis(firstharmonic):
+    from scipy.signal import hilbert
+
     analytic_signal = hilbert(firstharmonic)
     amplitude_envelope = np.abs(analytic_signal)
     instantaneous_phase = np.angle(analytic_signal / amplitude_envelope)
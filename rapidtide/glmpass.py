@@ -48,6 +48,111 @@ def _procOneItemGLM(vox, lagtc, inittc, rt_floatset=np.float64, rt_floattype="fl
     )
 
 
+def _procItemBlockGLM(lagtcs, inittcs, rt_floatset=np.float64, rt_floattype="float64"):
+    # with one regressor and an intercept, the least squares fit has a closed form, so
+    # every row of the block can be fit at once.  The sums are accumulated in double precision
+    # even when the timecourses are single precision.
+    lagmeans = np.mean(lagtcs, axis=1, dtype=np.float64)
+    initmeans = np.mean(inittcs, axis=1, dtype=np.float64)
+    lagdemeaned = lagtcs - lagmeans.astype(np.result_type(lagtcs.dtype, np.float32))[:, None]
+    initdemeaned = inittcs - initmeans.astype(np.result_type(inittcs.dtype, np.float32))[:, None]
+    sxy = np.einsum("ij,ij->i", lagdemeaned, initdemeaned, dtype=np.float64)
+    sxx = np.einsum("ij,ij->i", lagdemeaned, lagdemeaned, dtype=np.float64)
+    syy = np.einsum("ij,ij->i", initdemeaned, initdemeaned, dtype=np.float64)
+    del lagdemeaned, initdemeaned
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # a flat regressor gets the same answer as lstsq (no slope) and corrcoef (nan R)
+        slopes = np.where(sxx > 0.0, sxy / sxx, 0.0)
+        intercepts = initmeans - slopes * lagmeans
+        R = np.fabs(sxy) / np.sqrt(sxx * syy)
+        fitNorms = slopes / intercepts
+    datatoremove = slopes.astype(np.result_type(lagtcs.dtype, np.float32))[:, None] * lagtcs
+    return (
+        intercepts.astype(rt_floattype),
+        R.astype(rt_floattype),
+        (R * R).astype(rt_floattype),
+        slopes.astype(rt_floattype),
+        fitNorms.astype(rt_floattype),
+        datatoremove.astype(rt_floattype),
+        (inittcs - datatoremove).astype(rt_floattype),
+    )
+
+
+def _glmstage(items, arrays, params, showprogressbar=False):
+    fmri_data = arrays["fmri_data"]
+    lagtc = arrays["lagtc"]
+    meanvalue = arrays["meanvalue"]
+    rvalue = arrays["rvalue"]
+    r2value = arrays["r2value"]
+    fitcoff = arrays["fitcoff"]
+    fitNorm = arrays["fitNorm"]
+    datatoremove = arrays["datatoremove"]
+    filtereddata = arrays["filtereddata"]
+    addedskip = params["addedskip"]
+    reportstep = params["reportstep"]
+    blocksize = params["blocksize"]
+    if blocksize > 0:
+        for blockstart in range(0, len(items), blocksize):
+            blockend = np.min([blockstart + blocksize, len(items)])
+            theitems = np.asarray(items[blockstart:blockend])
+            if showprogressbar:
+                tide_util.progressbar(blockend, len(items), label="Percent complete")
+            if params["procbyvoxel"]:
+                meanvalue[theitems], rvalue[theitems], r2value[theitems], fitcoff[
+                    theitems
+                ], fitNorm[theitems], datatoremove[theitems, :], filtereddata[
+                    theitems, :
+                ] = _procItemBlockGLM(
+                    lagtc[theitems, :],
+                    fmri_data[theitems, addedskip:],
+                    rt_floatset=params["rt_floatset"],
+                    rt_floattype=params["rt_floattype"],
+                )
+            else:
+                blockmean, blockr, blockr2, blockcoff, blocknorm, blockremove, blockfiltered = _procItemBlockGLM(
+                    np.transpose(lagtc[:, theitems]),
+                    np.transpose(fmri_data[:, addedskip + theitems]),
+                    rt_floatset=params["rt_floatset"],
+                    rt_floattype=params["rt_floattype"],
+                )
+                meanvalue[theitems] = blockmean
+                rvalue[theitems] = blockr
+                r2value[theitems] = blockr2
+                fitcoff[theitems] = blockcoff
+                fitNorm[theitems] = blocknorm
+                datatoremove[:, theitems] = np.transpose(blockremove)
+                filtereddata[:, theitems] = np.transpose(blockfiltered)
+        return len(items)
+    for i, item in enumerate(items):
+        if (i % reportstep == 0 or i == len(items) - 1) and showprogressbar:
+            tide_util.progressbar(i + 1, len(items), label="Percent complete")
+        if params["procbyvoxel"]:
+            dummy, meanvalue[item], rvalue[item], r2value[item], fitcoff[
+                item
+            ], fitNorm[item], datatoremove[item, :], filtereddata[
+                item, :
+            ] = _procOneItemGLM(
+                item,
+                lagtc[item, :],
+                fmri_data[item, addedskip:].copy(),
+                rt_floatset=params["rt_floatset"],
+                rt_floattype=params["rt_floattype"],
+            )
+        else:
+            dummy, meanvalue[item], rvalue[item], r2value[item], fitcoff[
+                item
+            ], fitNorm[item], datatoremove[:, item], filtereddata[
+                :, item
+            ] = _procOneItemGLM(
+                item,
+                lagtc[:, item],
+                fmri_data[:, addedskip + item].copy(),
+                rt_floatset=params["rt_floatset"],
+                rt_floattype=params["rt_floattype"],
+            )
+    return len(items)
+
+
 def glmpass(
     numprocitems,
     fmri_data,
@@ -68,132 +173,78 @@ def glmpass(
     mp_chunksize=1000,
     rt_floatset=np.float64,
     rt_floattype="float64",
+    pool=None,
+    blockmem=0.0,
 ):
-    inputshape = np.shape(fmri_data)
-    if threshval is None:
-        themask = None
-    else:
-        themask = np.where(np.mean(fmri_data, axis=1) > threshval, 1, 0)
-    if nprocs > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def GLM_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    if procbyvoxel:
-                        outQ.put(
-                            _procOneItemGLM(
-                                val,
-                                lagtc[val, :],
-                                fmri_data[val, addedskip:],
-                                rt_floatset=rt_floatset,
-                                rt_floattype=rt_floattype,
-                            )
-                        )
-                    else:
-                        outQ.put(
-                            _procOneItemGLM(
-                                val,
-                                lagtc[:, val],
-                                fmri_data[:, addedskip + val],
-                                rt_floatset=rt_floatset,
-                                rt_floattype=rt_floattype,
-                            )
-                        )
+    r"""Regress a voxel specific lagged timecourse out of every item in a dataset.
 
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            GLM_consumer,
-            inputshape,
-            themask,
-            nprocs=nprocs,
-            procbyvoxel=procbyvoxel,
-            showprogressbar=True,
-            chunksize=mp_chunksize,
-        )
+    Parameters
+    ----------
+    numprocitems : int
+        Number of items (voxels if procbyvoxel is True, timepoints otherwise) to process
+    fmri_data : 2D numpy array
+        The data (voxels by time)
+    threshval : float or None
+        Items whose mean is not above threshval are skipped.  If None, process everything.
+    lagtc : 2D numpy array
+        The lagged regressor for each item
+    meanvalue, rvalue, r2value, fitcoff, fitNorm : 1D numpy arrays
+        Output arrays for the fit parameters
+    datatoremove, filtereddata : 2D numpy arrays
+        Output arrays for the fitted regressor and the filtered data
+    blockmem : float, optional
+        Memory budget, in megabytes per process, for fitting a block of items at once
+        with a vectorized closed form solution.  If 0 (the default), fit one item at a time.
 
-        # unpack the data
-        itemstotal = 0
+    Returns
+    -------
+    itemstotal : int
+        The number of items processed
+    """
+    inputshape = np.shape(fmri_data)
+    if blockmem > 0.0:
+        # the block fit keeps about 6 item by time float64 arrays alive at once
         if procbyvoxel:
-            for voxel in data_out:
-                meanvalue[voxel[0]] = voxel[1]
-                rvalue[voxel[0]] = voxel[2]
-                r2value[voxel[0]] = voxel[3]
-                fitcoff[voxel[0]] = voxel[4]
-                fitNorm[voxel[0]] = voxel[5]
-                datatoremove[voxel[0], :] = voxel[6]
-                filtereddata[voxel[0], :] = voxel[7]
-                itemstotal += 1
+            numpoints = inputshape[1] - addedskip
         else:
-            for timepoint in data_out:
-                meanvalue[timepoint[0]] = timepoint[1]
-                rvalue[timepoint[0]] = timepoint[2]
-                r2value[timepoint[0]] = timepoint[3]
-                fitcoff[timepoint[0]] = timepoint[4]
-                fitNorm[timepoint[0]] = timepoint[5]
-                datatoremove[:, timepoint[0]] = timepoint[6]
-                filtereddata[:, timepoint[0]] = timepoint[7]
-                itemstotal += 1
-
-        del data_out
+            numpoints = inputshape[0]
+        blocksize = int(np.max([1, (blockmem * 1024 * 1024) // (6 * 8 * numpoints)]))
     else:
-        itemstotal = 0
-        if procbyvoxel:
-            for vox in range(0, numprocitems):
-                if (
-                    vox % reportstep == 0 or vox == numprocitems - 1
-                ) and showprogressbar:
-                    tide_util.progressbar(
-                        vox + 1, numprocitems, label="Percent complete"
-                    )
-                inittc = fmri_data[vox, addedskip:].copy()
-                if themask[vox] > 0:
-                    dummy, meanvalue[vox], rvalue[vox], r2value[vox], fitcoff[
-                        vox
-                    ], fitNorm[vox], datatoremove[vox, :], filtereddata[
-                        vox, :
-                    ] = _procOneItemGLM(
-                        vox,
-                        lagtc[vox, :],
-                        inittc,
-                        rt_floatset=rt_floatset,
-                        rt_floattype=rt_floattype,
-                    )
-                    itemstotal += 1
-        else:
-            for timepoint in range(0, numprocitems):
-                if (
-                    timepoint % reportstep == 0 or timepoint == numprocitems - 1
-                ) and showprogressbar:
-                    tide_util.progressbar(
-                        timepoint + 1, numprocitems, label="Percent complete"
-                    )
-                inittc = fmri_data[:, addedskip + timepoint].copy()
-                if themask[timepoint] > 0:
-                    dummy, meanvalue[timepoint], rvalue[timepoint], r2value[
-                        timepoint
-                    ], fitcoff[timepoint], fitNorm[timepoint], datatoremove[
-                        :, timepoint
-                    ], filtereddata[
-                        :, timepoint
-                    ] = _procOneItemGLM(
-                        timepoint,
-                        lagtc[:, timepoint],
-                        inittc,
-                        rt_floatset=rt_floatset,
-                        rt_floattype=rt_floattype,
-                    )
-                    itemstotal += 1
+        blocksize = 0
+    if threshval is None:
+        themask = np.ones(numprocitems, dtype=np.int64)
+    else:
+        themask = np.where(np.mean(fmri_data, axis=1) > threshval, 1, 0)[:numprocitems]
+    params = {
+        "addedskip": addedskip,
+        "reportstep": reportstep,
+        "procbyvoxel": procbyvoxel,
+        "blocksize": blocksize,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+    data_out = tide_multiproc.run_multiproc_stage(
+        _glmstage,
+        {"fmri_data": fmri_data, "lagtc": lagtc},
+        {
+            "meanvalue": meanvalue,
+            "rvalue": rvalue,
+            "r2value": r2value,
+            "fitcoff": fitcoff,
+            "fitNorm": fitNorm,
+            "datatoremove": datatoremove,
+            "filtereddata": filtereddata,
+        },
+        params,
+        inputshape,
+        themask,
+        nprocs=nprocs,
+        pool=pool,
+        procbyvoxel=procbyvoxel,
+        showprogressbar=showprogressbar,
+        chunksize=mp_chunksize,
+    )
+    itemstotal = int(np.sum(data_out))
     return itemstotal
 
 
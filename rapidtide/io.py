@@ -23,30 +23,30 @@
 import numpy as np
 import sys
 import os
-import pandas as pd
+import gzip
+import importlib.util
 import json
-
-# ---------------------------------------- Global constants -------------------------------------------
-MAXLINES = 10000000
+import warnings
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
+# nibabel and pandas are imported in the functions that use them, so that importing this module stays fast
+nibabelexists = importlib.util.find_spec("nibabel") is not None
 
 # ---------------------------------------- NIFTI file manipulation ---------------------------
 if nibabelexists:
 
-    def readfromnifti(inputfile):
+    def readfromnifti(inputfile, lazy=False):
         r"""Open a nifti file and read in the various important parts
 
         Parameters
         ----------
         inputfile : str
             The name of the nifti file.
+        lazy : bool, optional
+            If True, do not read the data into memory.  For an uncompressed, unscaled file nim_data
+            is a read only memory map of the file; otherwise it is a nibabel array proxy, which
+            reads only the parts that are sliced out of it.  Use niftichunks or readniftivoxels to
+            get at the data a piece at a time.  Default is False.
 
         Returns
         -------
@@ -57,6 +57,7 @@ if nibabelexists:
         thesizes : float array
 
         """
+        import nibabel as nib
         if os.path.isfile(inputfile):
             inputfilename = inputfile
         elif os.path.isfile(inputfile + ".nii.gz"):
@@ -66,13 +67,98 @@ if nibabelexists:
         else:
             print("nifti file", inputfile, "does not exist")
             sys.exit()
-        nim = nib.load(inputfilename)
-        nim_data = nim.get_data()
+        if lazy:
+            nim = nib.load(inputfilename, mmap="r")
+            theproxy = nim.dataobj
+            if (
+                (not inputfilename.endswith(".gz"))
+                and (theproxy.slope == 1.0)
+                and (theproxy.inter == 0.0)
+            ):
+                nim_data = np.asanyarray(theproxy)
+            else:
+                nim_data = theproxy
+        else:
+            nim = nib.load(inputfilename)
+            nim_data = nim.get_data()
         nim_hdr = nim.get_header()
         thedims = nim_hdr["dim"].copy()
         thesizes = nim_hdr["pixdim"].copy()
         return nim, nim_data, nim_hdr, thedims, thesizes
 
+    def niftichunks(nim_data, starttime=0, endtime=None, dtype="float64"):
+        r"""Step through a 4D dataset one slice at a time.
+
+        Parameters
+        ----------
+        nim_data : array-like
+            The 4D data, as returned by readfromnifti (possibly with lazy=True)
+        starttime, endtime : int, optional
+            Range of timepoints to return (endtime is exclusive).  Default is all timepoints.
+        dtype : str, optional
+            Data type of the returned chunks.  Default is float64.
+
+        Yields
+        ------
+        thevoxels : int array
+            Indices of the voxels in this chunk, numbered the same way as the rows of
+            nim_data.reshape((numspatiallocs, timepoints))
+        thedata : 2D float array
+            The timecourses of those voxels
+        """
+        xsize, ysize, numslices = nim_data.shape[0:3]
+        if endtime is None:
+            endtime = nim_data.shape[3]
+        for theslice in range(numslices):
+            thevoxels = (
+                np.arange(xsize * ysize, dtype=np.int64) * numslices + theslice
+            )
+            thedata = np.asarray(
+                nim_data[:, :, theslice, starttime:endtime], dtype=dtype
+            ).reshape((xsize * ysize, endtime - starttime))
+            yield thevoxels, thedata
+
+    def readniftivoxels(
+        nim_data, voxels, starttime=0, endtime=None, dtype="float64", out=None
+    ):
+        r"""Read the timecourses of a subset of voxels from a 4D dataset, one slice at a time.
+
+        Parameters
+        ----------
+        nim_data : array-like
+            The 4D data, as returned by readfromnifti (possibly with lazy=True)
+        voxels : int array
+            The voxels to read, numbered the same way as the rows of
+            nim_data.reshape((numspatiallocs, timepoints))
+        starttime, endtime : int, optional
+            Range of timepoints to return (endtime is exclusive).  Default is all timepoints.
+        dtype : str, optional
+            Data type of the returned array.  Default is float64.
+        out : 2D array, optional
+            If given, the timecourses are written into this array (which may be a memory map)
+            rather than a new one, so no more than one slice of data is ever held in memory.
+            Default is None.
+
+        Returns
+        -------
+        thedata : 2D float array
+            The timecourses, one row for each entry in voxels
+        """
+        xsize, ysize, numslices = nim_data.shape[0:3]
+        if endtime is None:
+            endtime = nim_data.shape[3]
+        voxels = np.asarray(voxels)
+        xindex, yindex, sliceindex = np.unravel_index(voxels, (xsize, ysize, numslices))
+        if out is None:
+            thedata = np.zeros((len(voxels), endtime - starttime), dtype=dtype)
+        else:
+            thedata = out
+        for theslice in np.unique(sliceindex):
+            inslice = np.where(sliceindex == theslice)[0]
+            slicedata = np.asarray(nim_data[:, :, theslice, starttime:endtime])
+            thedata[inslice, :] = slicedata[xindex[inslice], yindex[inslice], :]
+        return thedata
+
     # dims are the array dimensions along each axis
     def parseniftidims(thedims):
         r"""Split the dims array into individual elements
@@ -123,6 +209,7 @@ if nibabelexists:
         -------
 
         """
+        import nibabel as nib
         outputaffine = theheader.get_best_affine()
         qaffine, qcode = theheader.get_qform(coded=True)
         saffine, scode = theheader.get_sform(coded=True)
@@ -170,6 +257,78 @@ if nibabelexists:
         output_nifti.to_filename(thename + suffix)
         output_nifti = None
 
+    def savevoxelstonifti(
+        thedata, voxels, theheader, thename, nativeshape, blocksize=10000
+    ):
+        r"""Write the timecourses of a subset of voxels out to a 4D nifti file a block at a time.
+
+        Unlike savetonifti, the full sized output array is never assembled in memory - an
+        uncompressed nifti file is created on disk and the voxels are copied into it in blocks,
+        so thedata can itself be a memory map of a file that is larger than RAM.  Voxels that
+        are not in the list are zero.
+
+        Parameters
+        ----------
+        thedata : 2D array
+            The timecourses, one row for each entry in voxels
+        voxels : int array
+            The voxels to write, numbered the same way as the rows of
+            thearray.reshape((numspatiallocs, timepoints))
+        theheader : nifti header
+            A valid nifti header
+        thename : str
+            The name of the nifti file to save (".nii" is added)
+        nativeshape : tuple
+            The (xsize, ysize, numslices, timepoints) shape of the output file
+        blocksize : int, optional
+            Number of voxels to copy at a time.  Default is 10000.
+
+        Returns
+        -------
+
+        """
+        theheader = theheader.copy()
+        qaffine, qcode = theheader.get_qform(coded=True)
+        saffine, scode = theheader.get_sform(coded=True)
+        theheader.set_qform(qaffine, code=int(qcode))
+        theheader.set_sform(saffine, code=int(scode))
+        theheader.set_data_shape(nativeshape)
+        theheader.set_data_dtype(thedata.dtype)
+        theheader.set_slope_inter(1.0, 0.0)
+        if theheader["magic"] == b"n+2":
+            theheader["vox_offset"] = 544
+        else:
+            theheader["magic"] = b"n+1"
+            theheader["vox_offset"] = 352
+        dataoffset = int(theheader["vox_offset"])
+        datasize = int(np.prod(nativeshape)) * thedata.dtype.itemsize
+
+        # write the header, then extend the file to full size (zero filled)
+        with open(thename + ".nii", "wb") as thefile:
+            theheader.write_to(thefile)
+            thefile.write(b"\x00" * (dataoffset - thefile.tell()))
+            thefile.seek(dataoffset + datasize - 1)
+            thefile.write(b"\x00")
+
+        # nifti data is stored with the first axis varying fastest
+        outmap = np.memmap(
+            thename + ".nii",
+            dtype=thedata.dtype,
+            mode="r+",
+            offset=dataoffset,
+            shape=tuple(nativeshape),
+            order="F",
+        )
+        voxels = np.asarray(voxels)
+        for blockstart in range(0, len(voxels), blocksize):
+            blockend = min(blockstart + blocksize, len(voxels))
+            xindex, yindex, sliceindex = np.unravel_index(
+                voxels[blockstart:blockend], nativeshape[0:3]
+            )
+            outmap[xindex, yindex, sliceindex, :] = thedata[blockstart:blockend, :]
+        outmap.flush()
+        del outmap
+
     def checkifnifti(filename):
         r"""Check to see if a file name is a valid nifti name.
 
@@ -245,6 +404,7 @@ if nibabelexists:
             The number of points along the time axis
 
         """
+        import nibabel as nib
         nim = nib.load(niftifilename)
         hdr = nim.get_header()
         thedims = hdr["dim"]
@@ -600,6 +760,7 @@ def readfmriprepconfounds(inputfilename):
     NOTE:  If file does not exist or is not valid, return an empty dictionary
 
     """
+    import pandas as pd
     confounddict = {}
     df = pd.read_csv(inputfilename + ".tsv", sep="\t", quotechar='"')
     for thecolname, theseries in df.items():
@@ -629,6 +790,7 @@ def readbidstsv(inputfilename):
     NOTE:  If file does not exist or is not valid, all return values are None
 
     """
+    import pandas as pd
     thefileroot, theext = os.path.splitext(inputfilename)
     if os.path.exists(thefileroot + ".json") and os.path.exists(
         thefileroot + ".tsv.gz"
@@ -736,42 +898,59 @@ def colspectolist(colspec):
     return sorted(collist)
 
 
+def _countcolumns(inputfilename):
+    # the number of columns on the first nonblank line of a (possibly gzipped) text file
+    if inputfilename.endswith(".gz"):
+        thefile = gzip.open(inputfilename, "rt")
+    else:
+        thefile = open(inputfilename, "r")
+    with thefile:
+        for line in thefile:
+            thetokens = line.split()
+            if len(thetokens) > 0:
+                return len(thetokens)
+    return 0
+
+
+def _loadtext(inputfilename, usecols=None, ndmin=1):
+    # bulk parse a text file of floats.  Blank lines are skipped, and the output is sized from the
+    # data.  Files ending in .gz are decompressed on the fly.
+    with warnings.catch_warnings():
+        # an empty file just gives an empty array
+        warnings.filterwarnings("ignore", message="loadtxt: input contained no data")
+        return np.loadtxt(inputfilename, dtype=np.float64, usecols=usecols, ndmin=ndmin)
+
+
 def readvecs(inputfilename, colspec=None):
-    r"""
+    r"""Read one or more columns of floats in from a text file.
 
     Parameters
     ----------
-    inputfilename
+    inputfilename : str
+        The name of the text file (may be gzipped)
+    colspec : str, optional
+        The columns to read, as a comma separated list of columns and ranges, e.g. "0,2-4".
+        Default is all columns.
 
     Returns
     -------
-
+    inputdata : 2D numpy float array
+        One row per column in the file
     """
-    with open(inputfilename, "r") as thefile:
-        lines = thefile.readlines()
+    numcols = _countcolumns(inputfilename)
     if colspec is None:
-        numvecs = len(lines[0].split())
-        collist = list(range(0, numvecs))
+        collist = list(range(0, numcols))
     else:
         collist = colspectolist(colspec)
-        if collist[-1] > len(lines[0].split()):
+        if collist[-1] > numcols:
             print("READVECS: too many columns requested - exiting")
             sys.exit()
-        if max(collist) > len(lines[0].split()) - 1:
+        if max(collist) > numcols - 1:
             print("READVECS: requested column", max(collist), "too large - exiting")
             sys.exit()
-        numvecs = len(collist)
-    inputvec = np.zeros((numvecs, MAXLINES), dtype="float64")
-    numvals = 0
-    for line in lines:
-        if len(line) > 1:
-            numvals += 1
-            thetokens = line.split()
-            outloc = 0
-            for vecnum in collist:
-                inputvec[outloc, numvals - 1] = np.float64(thetokens[vecnum])
-                outloc += 1
-    return 1.0 * inputvec[:, 0:numvals]
+    if len(collist) == 0:
+        return np.zeros((0, 0), dtype="float64")
+    return np.ascontiguousarray(np.transpose(_loadtext(inputfilename, usecols=collist, ndmin=2)))
 
 
 def readvec(inputfilename):
@@ -780,7 +959,7 @@ def readvec(inputfilename):
     Parameters
     ----------
     inputfilename : str
-        The name of the text file
+        The name of the text file (may be gzipped)
 
     Returns
     -------
@@ -788,15 +967,11 @@ def readvec(inputfilename):
         The data from the file
 
     """
-    inputvec = np.zeros(MAXLINES, dtype="float64")
-    numvals = 0
-    with open(inputfilename, "r") as thefile:
-        lines = thefile.readlines()
-        for line in lines:
-            if len(line) > 1:
-                numvals += 1
-                inputvec[numvals - 1] = np.float64(line)
-    return 1.0 * inputvec[0:numvals]
+    inputvec = _loadtext(inputfilename, ndmin=1)
+    if inputvec.ndim > 1:
+        print("READVEC:", inputfilename, "has more than one value per line - exiting")
+        sys.exit()
+    return inputvec
 
 
 def readlabels(inputfilename):
@@ -20,74 +20,33 @@
 #
 
 
+import sys
+
 import numpy as np
-from scipy import fftpack
-import matplotlib.pyplot as plt
 
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
-from statsmodels.robust import mad
+import rapidtide.util as tide_util
+
+plt = tide_util.lazymodule("matplotlib.pyplot")
+spatial = tide_util.lazymodule("scipy.spatial")
 
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
+MAXENTROPYWINDOWPTS = 301
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
+memprofilerexists = tide_util.memprofilerexists
+nibabelexists = tide_util.nibabelexists
 
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
-
-    return resdec
+pyfftwexists = tide_util.pyfftwexists
+fftpack = tide_util.fftpack
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- Spectral analysis functions ---------------------------------------
@@ -252,7 +211,6 @@ def znormalize(vector):
     return stdnormalize(vector)
 
 
-@conditionaljit()
 def madnormalize(vector):
     """
 
@@ -264,6 +222,8 @@ def madnormalize(vector):
     -------
 
     """
+    from statsmodels.robust import mad
+
     demedianed = vector - np.median(vector)
     sigmad = mad(demedianed)
     if sigmad > 0.0:
@@ -272,7 +232,7 @@ def madnormalize(vector):
         return demedianed
 
 
-@conditionaljit()
+@tide_util.numbakernel()
 def stdnormalize(vector):
     """
 
@@ -348,36 +308,162 @@ def ppnormalize(vector):
         return demeaned
 
 
-@conditionaljit()
-def corrnormalize(thedata, prewindow=True, detrendorder=1, windowfunc="hamming"):
-    """
+_corrnormalizercache = {}
+
+
+class corrnormalizer:
+    r"""Precomputed form of corrnormalize for timecourses of a fixed length.
+
+    The window and the detrending basis are computed once, when the plan is made, and apply
+    then normalizes a single timecourse, or every row of a 2D block of timecourses, optionally
+    in place.  Use getcorrnormalizer to share plans between callers.
+
+    Parameters
+    ----------
+    length : int
+        Number of timepoints in each timecourse
+    prewindow : bool, optional
+        Apply the window function after detrending.  Default is True.
+    detrendorder : int, optional
+        Order of the polynomial trend to remove (0 just removes the mean).  Default is 1.
+    windowfunc : str, optional
+        Window function to use (see tide_filt.windowfunction).  Default is "hamming".
+    dtype : dtype, optional
+        Precision of the window, the detrending basis, and the output.  Means and standard
+        deviations are always accumulated in double precision.  Default is np.float64.
+    """
+
+    def __init__(
+        self, length, prewindow=True, detrendorder=1, windowfunc="hamming", dtype=np.float64
+    ):
+        self.length = length
+        self.prewindow = prewindow
+        self.detrendorder = detrendorder
+        self.windowfunc = windowfunc
+        self.dtype = np.dtype(dtype)
+        if self.prewindow:
+            self.window = tide_filt.windowfunction(self.length, type=self.windowfunc).astype(
+                self.dtype
+            )
+        else:
+            self.window = None
+        if self.detrendorder > 0:
+            thetrend, theprojection = tide_fit._detrendbasis(self.length, self.detrendorder, True)
+            self.trend = np.transpose(thetrend).astype(self.dtype)
+            self.projection = np.transpose(theprojection).astype(self.dtype)
+        else:
+            self.trend = None
+            self.projection = None
+        self.scale = self.dtype.type(1.0 / np.sqrt(self.length))
+
+    def _stdnormalize(self, theblock):
+        # remove the row means and scale each row to unit standard deviation, in place
+        theblock -= np.mean(theblock, axis=1, dtype=np.float64).astype(theblock.dtype)[:, None]
+        sigstd = np.sqrt(np.einsum("ij,ij->i", theblock, theblock, dtype=np.float64) / self.length)
+        sigstd[np.where(sigstd <= 0.0)] = 1.0
+        theblock /= sigstd.astype(theblock.dtype)[:, None]
+
+    def apply(self, thedata, inplace=False):
+        r"""Detrend, window, and normalize timecourses so their correlation is a dot product.
+
+        Parameters
+        ----------
+        thedata : 1D or 2D float array
+            The timecourse, or a block with one timecourse per row.  The last axis must
+            have the length the plan was made for.
+        inplace : bool, optional
+            Overwrite thedata with the result instead of allocating a new array.  thedata
+            must then be a floating point array.  Default is False.
+
+        Returns
+        -------
+        normalized : float array
+            The normalized timecourse(s), the same shape as thedata.  This is thedata itself
+            if inplace is True.
+        """
+        if inplace:
+            theoutput = thedata
+        else:
+            theoutput = np.array(thedata, dtype=self.dtype)
+        if np.shape(theoutput)[-1] != self.length:
+            print(
+                "corrnormalizer: data length",
+                np.shape(theoutput)[-1],
+                "does not match plan length",
+                self.length,
+            )
+            sys.exit()
+        if theoutput.ndim == 1:
+            theblock = theoutput[None, :]
+        else:
+            theblock = theoutput
+
+        # detrend first
+        if self.detrendorder > 0:
+            theblock -= np.dot(np.dot(theblock, self.projection), self.trend)
+        self._stdnormalize(theblock)
+
+        # then window
+        if self.prewindow:
+            theblock *= self.window
+        self._stdnormalize(theblock)
+        theblock *= self.scale
+        return theoutput
+
+
+def getcorrnormalizer(
+    length, prewindow=True, detrendorder=1, windowfunc="hamming", dtype=np.float64
+):
+    r"""Return a corrnormalizer plan for the given settings, making it only the first time.
 
     Parameters
     ----------
-    thedata
-    prewindow
-    detrendorder
-    windowfunc
+    length : int
+        Number of timepoints in each timecourse
+    prewindow, detrendorder, windowfunc, dtype : optional
+        As for corrnormalizer
 
     Returns
     -------
-
-    """
-    # detrend first
-    if detrendorder > 0:
-        intervec = stdnormalize(
-            tide_fit.detrend(thedata, order=detrendorder, demean=True)
+    theplan : corrnormalizer
+    """
+    thekey = (length, prewindow, detrendorder, windowfunc, np.dtype(dtype).str)
+    if thekey not in _corrnormalizercache:
+        _corrnormalizercache[thekey] = corrnormalizer(
+            length,
+            prewindow=prewindow,
+            detrendorder=detrendorder,
+            windowfunc=windowfunc,
+            dtype=dtype,
         )
-    else:
-        intervec = stdnormalize(thedata)
+    return _corrnormalizercache[thekey]
 
-    # then window
-    if prewindow:
-        return stdnormalize(
-            tide_filt.windowfunction(np.shape(thedata)[0], type=windowfunc) * intervec
-        ) / np.sqrt(np.shape(thedata)[0])
-    else:
-        return stdnormalize(intervec) / np.sqrt(np.shape(thedata)[0])
+
+def corrnormalize(thedata, prewindow=True, detrendorder=1, windowfunc="hamming"):
+    """Detrend, window, and normalize a timecourse so its correlation is a dot product.
+
+    Parameters
+    ----------
+    thedata : 1D or 2D float array
+        The timecourse, or a block with one timecourse per row
+    prewindow : bool, optional
+        Apply the window function after detrending.  Default is True.
+    detrendorder : int, optional
+        Order of the polynomial trend to remove.  Default is 1.
+    windowfunc : str, optional
+        Window function to use.  Default is "hamming".
+
+    Returns
+    -------
+    normalized : float array
+        The normalized timecourse(s), in double precision
+    """
+    return getcorrnormalizer(
+        np.shape(thedata)[-1],
+        prewindow=prewindow,
+        detrendorder=detrendorder,
+        windowfunc=windowfunc,
+    ).apply(thedata)
 
 
 def rms(vector):
@@ -448,10 +534,8 @@ def trendfilt(inputdata, order=3, ndevs=3.0, debug=False):
     patched : array-like
         The input data with the impulsive noise removed
     """
-    thetimepoints = np.arange(0.0, len(inputdata), 1.0) - len(inputdata) / 2.0
-    thecoffs = np.polyfit(thetimepoints, inputdata, order)
-    thefittc = tide_fit.trendgen(thetimepoints, thecoffs, True)
-    detrended = inputdata - thefittc
+    detrended = tide_fit.detrend(inputdata, order=order, demean=True)
+    thefittc = inputdata - detrended
     if debug:
         plt.figure()
         plt.plot(detrended)
@@ -460,3 +544,326 @@ def trendfilt(inputdata, order=3, ndevs=3.0, debug=False):
         plt.plot(detrended)
         plt.show()
     return detrended + thefittc
+
+
+# --------------------------- Entropy functions -------------------------------------------------
+def _templatedistances(windows, m):
+    # Chebyshev distances between every pair of templates of length m (and of length m + 1) within
+    # each row of windows, built up one template element at a time
+    numwindows, numpoints = np.shape(windows)
+    numtemplates = numpoints - m + 1
+    distances = np.zeros((numwindows, numtemplates, numtemplates), dtype=windows.dtype)
+    for k in range(m):
+        thecolumn = windows[:, k : k + numtemplates]
+        np.maximum(
+            distances, np.fabs(thecolumn[:, :, None] - thecolumn[:, None, :]), out=distances
+        )
+    thecolumn = windows[:, m:]
+    distances_m1 = np.maximum(
+        distances[:, :-1, :-1], np.fabs(thecolumn[:, :, None] - thecolumn[:, None, :])
+    )
+    return distances, distances_m1
+
+
+def _templatecounts(waveform, m, r, excludeself=False):
+    # for each template of length m, and each template of length m + 1, the number of templates of
+    # the same length within r, found with a Chebyshev distance KD tree so the pairwise distances
+    # never have to be held in memory.  For sample entropy, only the first N - m templates of length
+    # m are used, and self matches are not counted.
+    numpoints = len(waveform)
+    if excludeself:
+        numtemplates = [numpoints - m, numpoints - m]
+        selfmatches = 1
+    else:
+        numtemplates = [numpoints - m + 1, numpoints - m]
+        selfmatches = 0
+    thecounts = []
+    for thelength, thenumtemplates in zip([m, m + 1], numtemplates):
+        thetemplates = waveform[
+            np.arange(thenumtemplates)[:, None] + np.arange(thelength)[None, :]
+        ]
+        thetree = spatial.cKDTree(thetemplates)
+        thecounts.append(
+            thetree.query_ball_point(thetemplates, r, p=np.inf, return_length=True) - selfmatches
+        )
+    return thecounts[0], thecounts[1]
+
+
+def _entropyblock(windows, m, r, entropytype):
+    # approximate or sample entropy of every row of windows, each with its own tolerance
+    numpoints = np.shape(windows)[1]
+    distances, distances_m1 = _templatedistances(windows, m)
+    if entropytype == "approximate":
+        phi_m = np.mean(
+            np.log(np.sum(distances <= r[:, None, None], axis=2) / (numpoints - m + 1.0)), axis=1
+        )
+        phi_m1 = np.mean(
+            np.log(np.sum(distances_m1 <= r[:, None, None], axis=2) / (numpoints - m + 0.0)),
+            axis=1,
+        )
+        return phi_m - phi_m1
+    else:
+        # self matches are on the diagonal, and are not counted
+        B = np.sum(distances[:, :-1, :-1] <= r[:, None, None], axis=(1, 2)) - (numpoints - m)
+        A = np.sum(distances_m1 <= r[:, None, None], axis=(1, 2)) - (numpoints - m)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -np.log(A / B)
+
+
+def _singleentropy(waveform, m, r, entropytype, blocksize):
+    # approximate or sample entropy of one waveform - all template pairs at once if they fit in
+    # blocksize, otherwise with a KD tree, which never holds the pairwise distances in memory
+    numpoints = len(waveform)
+    if numpoints * numpoints <= blocksize:
+        return _entropyblock(waveform[None, :], m, np.array([r]), entropytype)[0]
+    if entropytype == "approximate":
+        counts_m, counts_m1 = _templatecounts(waveform, m, r)
+        return np.mean(np.log(counts_m / (numpoints - m + 1.0))) - np.mean(
+            np.log(counts_m1 / (numpoints - m + 0.0))
+        )
+    else:
+        B, A = _templatecounts(waveform, m, r, excludeself=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -np.log(np.sum(A) / np.sum(B))
+
+
+def _lagmatches(waveform, q, r, firsttemplate, numtemplates, maxlag, direction):
+    # for templates of length q starting at firsttemplate, the running number of templates within r
+    # at lags 1 to maxlag ahead (direction 1) or behind (direction -1).  thecounts[i, k] is the
+    # number of matches among the k nearest templates on that side, so any range of neighbors can
+    # be counted with a lookup.
+    numvalid = len(waveform) - q + 1
+    thetemplates = firsttemplate + np.arange(numtemplates)
+    theneighbors = thetemplates[:, None] + direction * np.arange(1, maxlag + 1)[None, :]
+    outofrange = (theneighbors < 0) | (theneighbors >= numvalid)
+    theneighbors = np.clip(theneighbors, 0, numvalid - 1)
+    distances = np.zeros((numtemplates, maxlag), dtype=waveform.dtype)
+    for k in range(q):
+        np.maximum(
+            distances,
+            np.fabs(waveform[theneighbors + k] - waveform[thetemplates + k][:, None]),
+            out=distances,
+        )
+    thematches = (distances <= r) & ~outofrange
+    thecounts = np.zeros((numtemplates, maxlag + 1), dtype=np.int64)
+    np.cumsum(thematches, axis=1, out=thecounts[:, 1:])
+    return thecounts
+
+
+def _windowedmatches(waveform, q, r, firsttemplates, numtemplates, uselog, blocksize):
+    # for every window, the sum over its templates (those of length q starting at firsttemplates[p],
+    # numtemplates[p] of them) of the number of templates in the window within r, or of its log.
+    # Rather than comparing every pair of templates again for each window, the matches at each lag
+    # are counted once, and the count for each template in each window containing it is looked up
+    # from running sums, so the cost is proportional to the number of points times the window
+    # length rather than to the number of points times the window length squared.
+    numwindows = len(firsttemplates)
+    lasttemplates = firsttemplates + numtemplates - 1
+    maxlag = int(np.max([1, np.max(numtemplates) - 1]))
+    numvalid = len(waveform) - q + 1
+    thesums = np.zeros(numwindows, dtype=np.float64)
+    templatesperblock = int(np.max([1, blocksize // (maxlag + 1)]))
+    for blockstart in range(0, numvalid, templatesperblock):
+        thesetemplates = np.arange(blockstart, np.min([blockstart + templatesperblock, numvalid]))
+        ahead = _lagmatches(waveform, q, r, blockstart, len(thesetemplates), maxlag, 1)
+        behind = _lagmatches(waveform, q, r, blockstart, len(thesetemplates), maxlag, -1)
+
+        # the windows containing each template are a contiguous range, since the window bounds
+        # never decrease from one window to the next (except for windows with no templates at all,
+        # which are dropped below)
+        firstwindow = np.searchsorted(
+            np.maximum.accumulate(lasttemplates), thesetemplates, side="left"
+        )
+        lastwindow = np.searchsorted(firsttemplates, thesetemplates, side="right")
+        numcontaining = np.clip(lastwindow - firstwindow, 0, None)
+        therows = np.repeat(np.arange(len(thesetemplates)), numcontaining)
+        rangestarts = np.cumsum(numcontaining) - numcontaining
+        thewindows = np.repeat(firstwindow - rangestarts, numcontaining) + np.arange(
+            np.sum(numcontaining)
+        )
+        thetemplates = thesetemplates[therows]
+        inwindow = thetemplates <= lasttemplates[thewindows]
+        therows, thewindows, thetemplates = (
+            therows[inwindow],
+            thewindows[inwindow],
+            thetemplates[inwindow],
+        )
+        thecounts = (
+            1
+            + ahead[therows, lasttemplates[thewindows] - thetemplates]
+            + behind[therows, thetemplates - firsttemplates[thewindows]]
+        )
+        if uselog:
+            thesums += np.bincount(thewindows, weights=np.log(thecounts), minlength=numwindows)
+        else:
+            thesums += np.bincount(thewindows, weights=thecounts, minlength=numwindows)
+    return thesums
+
+
+def _slidingentropy(waveform, m, r, startpts, endpts, entropytype, blocksize):
+    # approximate or sample entropy of waveform[startpts[p]:endpts[p]] for every p, with one fixed
+    # tolerance
+    windowlens = endpts - startpts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if entropytype == "approximate":
+            phi = []
+            for q in [m, m + 1]:
+                numtemplates = np.clip(windowlens - q + 1, 0, None)
+                thesums = _windowedmatches(
+                    waveform, q, r, startpts, numtemplates, True, blocksize
+                )
+                phi.append(thesums / numtemplates - np.log(numtemplates))
+            return phi[0] - phi[1]
+        else:
+            # only the first N - m templates of length m are used, and self matches are not counted
+            numtemplates = np.clip(windowlens - m, 0, None)
+            B = _windowedmatches(waveform, m, r, startpts, numtemplates, False, blocksize)
+            A = _windowedmatches(waveform, m + 1, r, startpts, numtemplates, False, blocksize)
+            return -np.log((A - numtemplates) / (B - numtemplates))
+
+
+def _entropy(waveform, m, r, rfac, windowpts, entropytype, blocksize, debug):
+    waveform = np.asarray(waveform, dtype=np.float64)
+    numpoints = len(waveform)
+
+    if windowpts is None:
+        if r is None:
+            r = rfac * np.std(waveform)
+        return _singleentropy(waveform, m, r, entropytype, blocksize)
+
+    # windowed mode - a window of windowpts points centered on each point, truncated at the ends
+    halfwindow = windowpts // 2
+    startpts = np.clip(np.arange(numpoints) - halfwindow, 0, numpoints)
+    endpts = np.clip(np.arange(numpoints) + halfwindow + 1, 0, numpoints)
+    if r is not None:
+        # with a fixed tolerance, the matches are counted once and shared between windows
+        theentropy = _slidingentropy(waveform, m, r, startpts, endpts, entropytype, blocksize)
+        if debug:
+            for i in range(numpoints):
+                print(i, startpts[i], endpts[i], theentropy[i])
+        return theentropy
+
+    # each window has its own tolerance, so every window has to compare all of its templates
+    if windowpts > MAXENTROPYWINDOWPTS:
+        raise ValueError(
+            "windowpts is limited to "
+            + str(MAXENTROPYWINDOWPTS)
+            + " when each window has its own tolerance - pass a fixed r for longer windows"
+        )
+    theentropy = np.zeros(numpoints, dtype=np.float64)
+    fullwindows = np.where(endpts - startpts == windowpts)[0]
+    if windowpts * windowpts > blocksize:
+        # even one window doesn't fit in blocksize, so every window goes through the KD tree
+        fullwindows = []
+    if len(fullwindows) > 0:
+        # all the full length windows are done together, as many at a time as fit in blocksize
+        windowsperblock = blocksize // (windowpts * windowpts)
+        for blockstart in range(0, len(fullwindows), windowsperblock):
+            thesepoints = fullwindows[blockstart : blockstart + windowsperblock]
+            windows = waveform[startpts[thesepoints][:, None] + np.arange(windowpts)[None, :]]
+            if r is None:
+                ther = rfac * np.std(windows, axis=1)
+            else:
+                ther = np.full(len(thesepoints), r)
+            theentropy[thesepoints] = _entropyblock(windows, m, ther, entropytype)
+    for i in np.setdiff1d(np.arange(numpoints), fullwindows):
+        thewindow = waveform[startpts[i] : endpts[i]]
+        if r is None:
+            ther = rfac * np.std(thewindow)
+        else:
+            ther = r
+        theentropy[i] = _singleentropy(thewindow, m, ther, entropytype, blocksize)
+    if debug:
+        for i in range(numpoints):
+            print(i, startpts[i], endpts[i], theentropy[i])
+    return theentropy
+
+
+def approximateentropy(
+    waveform, m=2, r=None, rfac=0.2, windowpts=None, blocksize=1000000, debug=False
+):
+    r"""Calculate the approximate entropy (ApEn) of a waveform, or of a window around every point.
+
+    Parameters
+    ----------
+    waveform : 1D float array
+        The data
+    m : int, optional
+        The template (embedding) length.  Default is 2.
+    r : float, optional
+        The matching tolerance.  If None (the default), use rfac times the standard deviation
+        of the data (of each window, in windowed mode).
+    rfac : float, optional
+        Tolerance, as a fraction of the standard deviation, used when r is None.  Default is 0.2.
+    windowpts : int, optional
+        If set, calculate the entropy of a window of this many points centered on each point
+        of the waveform, truncated at the ends.  windowpts should be odd.  With a fixed r, the
+        template matches are counted once and shared between windows, so the cost grows as
+        the number of points times windowpts.  When each window has its own tolerance (r is
+        None), every window compares all of its templates, so the cost grows as the number of
+        points times windowpts squared, and windowpts is limited to MAXENTROPYWINDOWPTS.
+        Default is None.
+    blocksize : int, optional
+        Maximum number of template pairs to compare at once.  Waveforms (or windows) too long
+        for this are done with a KD tree instead.  Default is 1000000.
+    debug : bool, optional
+        Print the windows and their entropies in windowed mode.  Default is False.
+
+    Returns
+    -------
+    apen : float or 1D float array
+        Phi_m - Phi_m+1, as defined in Pincus, S. M. "Approximate entropy as a measure of system
+        complexity", PNAS 88, 2297-2301 (1991).  In windowed mode, an array with the value for
+        each point.
+
+    Raises
+    ------
+    ValueError
+        If r is None and windowpts is larger than MAXENTROPYWINDOWPTS.
+    """
+    return _entropy(waveform, m, r, rfac, windowpts, "approximate", blocksize, debug)
+
+
+def sampleentropy(waveform, m=2, r=None, rfac=0.2, windowpts=None, blocksize=1000000, debug=False):
+    r"""Calculate the sample entropy (SampEn) of a waveform, or of a window around every point.
+
+    Parameters
+    ----------
+    waveform : 1D float array
+        The data
+    m : int, optional
+        The template (embedding) length.  Default is 2.
+    r : float, optional
+        The matching tolerance.  If None (the default), use rfac times the standard deviation
+        of the data (of each window, in windowed mode).
+    rfac : float, optional
+        Tolerance, as a fraction of the standard deviation, used when r is None.  Default is 0.2.
+    windowpts : int, optional
+        If set, calculate the entropy of a window of this many points centered on each point
+        of the waveform, truncated at the ends.  windowpts should be odd.  With a fixed r, the
+        template matches are counted once and shared between windows, so the cost grows as
+        the number of points times windowpts.  When each window has its own tolerance (r is
+        None), every window compares all of its templates, so the cost grows as the number of
+        points times windowpts squared, and windowpts is limited to MAXENTROPYWINDOWPTS.
+        Default is None.
+    blocksize : int, optional
+        Maximum number of template pairs to compare at once.  Waveforms (or windows) too long
+        for this are done with a KD tree instead.  Default is 1000000.
+    debug : bool, optional
+        Print the windows and their entropies in windowed mode.  Default is False.
+
+    Returns
+    -------
+    sampen : float or 1D float array
+        -log(A / B), where B and A are the numbers of matching template pairs of length m and
+        m + 1, excluding self matches, as defined in Richman, J. S. and Moorman, J. R.
+        "Physiological time-series analysis using approximate entropy and sample entropy",
+        Am J Physiol Heart Circ Physiol 278, H2039-H2049 (2000).  This is inf if no template
+        pairs of length m + 1 match.  In windowed mode, an array with the value for each point.
+
+    Raises
+    ------
+    ValueError
+        If r is None and windowpts is larger than MAXENTROPYWINDOWPTS.
+    """
+    return _entropy(waveform, m, r, rfac, windowpts, "sample", blocksize, debug)
@@ -24,9 +24,14 @@
 
 
 import multiprocessing as mp
+import resource
 import threading as thread
+import time
+import traceback
 import queue as thrQueue
 
+import numpy as np
+
 import rapidtide.util as tide_util
 
 
@@ -34,8 +39,139 @@ def maxcpus():
     return mp.cpu_count() - 1
 
 
+def numpy2shared(inarray, thetype):
+    thesize = inarray.size
+    theshape = inarray.shape
+    inarray_shared = mp.RawArray(
+        np.ctypeslib.as_ctypes_type(np.dtype(thetype)), thesize
+    )
+    outarray = np.frombuffer(inarray_shared, dtype=thetype, count=thesize)
+    outarray.shape = theshape
+    outarray[...] = inarray
+    return outarray, inarray_shared, theshape
+
+
+def allocshared(theshape, thetype):
+    thesize = int(1)
+    for element in theshape:
+        thesize *= int(element)
+    outarray_shared = mp.RawArray(
+        np.ctypeslib.as_ctypes_type(np.dtype(thetype)), thesize
+    )
+    outarray = np.frombuffer(outarray_shared, dtype=thetype, count=thesize)
+    outarray.shape = theshape
+    return outarray, outarray_shared, theshape
+
+
+def allocfile(thefilename, theshape, thetype):
+    r"""Allocate a zero filled array that lives in a file on disk rather than in memory.
+
+    The array is a shared, writable memory map, so worker processes forked after it is made
+    see (and can write to) the same data, and the operating system only keeps the parts that
+    are being worked on in RAM.
+
+    Parameters
+    ----------
+    thefilename : str
+        Name of the file backing the array.  It is created (or overwritten).
+    theshape : tuple
+        Shape of the array
+    thetype : dtype
+        Data type of the array
+
+    Returns
+    -------
+    outarray : numpy memmap
+        The array
+    """
+    return np.memmap(thefilename, dtype=thetype, mode="w+", shape=tuple(theshape))
+
+
+def _isfilebacked(thearray):
+    return isinstance(thearray, np.memmap) and thearray.mode in ("r+", "w+")
+
+
+def _isshared(thearray):
+    # True if forked workers write into the same memory as the parent - file backed arrays, and
+    # arrays (or views of them) made by allocshared or numpy2shared
+    if _isfilebacked(thearray):
+        return True
+    thebase = thearray
+    while thebase is not None:
+        if hasattr(thebase, "_wrapper"):
+            # a multiprocessing RawArray
+            return True
+        thebase = getattr(thebase, "base", None)
+    return False
+
+
+def _runchunk(procfunc, args, numinchunk):
+    # process a chunk in a worker, and measure the resources it used.  If the chunk fails, the
+    # traceback is sent back in place of the result, so the parent can stop the run.
+    startcpu = time.process_time()
+    theerror = None
+    try:
+        ret = procfunc(*args)
+    except Exception:
+        ret = None
+        theerror = traceback.format_exc()
+    return (
+        numinchunk,
+        ret,
+        time.process_time() - startcpu,
+        tide_util.maxrsskb(resource.getrusage(resource.RUSAGE_SELF)),
+        theerror,
+    )
+
+
+def _getresult(outQ, workers, pollinterval=1.0):
+    # wait for the next result, checking on the workers while waiting - a worker that is killed (by
+    # the OOM killer, or a crash in compiled code) never reports back, so waiting on the queue alone
+    # would block forever
+    while True:
+        try:
+            return outQ.get(timeout=pollinterval)
+        except thrQueue.Empty:
+            pass
+        thedead = [
+            w
+            for w in workers
+            if (not w.is_alive()) and (getattr(w, "exitcode", None) not in (None, 0))
+        ]
+        if len(thedead) == 0 and any([w.is_alive() for w in workers]):
+            continue
+        # check once more for a result that arrived just before the last worker finished
+        try:
+            return outQ.get(timeout=pollinterval)
+        except thrQueue.Empty:
+            pass
+        if len(thedead) > 0:
+            raise RuntimeError(
+                str(len(thedead))
+                + " of "
+                + str(len(workers))
+                + " worker processes died (exit codes "
+                + ", ".join([str(w.exitcode) for w in thedead])
+                + ") before returning their results"
+            )
+        raise RuntimeError("all of the workers exited before returning their results")
+
+
+def _process_chunks(procfunc, indexlist, inQ, outQ):
+    while True:
+        # get a new chunk
+        val = inQ.get()
+
+        # this is the 'TERM' signal
+        if val is None:
+            break
+
+        # process the chunk and report back how many items were done
+        outQ.put(_runchunk(procfunc, (indexlist[val[0] : val[1]],), val[1] - val[0]))
+
+
 def _process_data(
-    data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chunksize=10000
+    data_in, inQ, outQ, workers, showprogressbar=True, reportstep=1000, chunksize=10000
 ):
     # send pos/data to workers
     data_out = []
@@ -57,7 +193,7 @@ def _process_data(
         # retrieve the chunk
         numreturned = 0
         while True:
-            ret = outQ.get()
+            ret = _getresult(outQ, workers)
             if ret is not None:
                 data_out.append(ret)
             numreturned += 1
@@ -78,7 +214,7 @@ def _process_data(
 
     # retrieve the remainder
     while True:
-        ret = outQ.get()
+        ret = _getresult(outQ, workers)
         if ret is not None:
             data_out.append(ret)
         numreturned += 1
@@ -128,17 +264,464 @@ def run_multiproc(
         elif maskarray[d] > 0:
             data_in.append(d)
     print("processing", len(data_in), procunit + " with", n_workers, "processes")
-    data_out = _process_data(
-        data_in, inQ, outQ, showprogressbar=showprogressbar, chunksize=chunksize
+    try:
+        data_out = _process_data(
+            data_in, inQ, outQ, workers, showprogressbar=showprogressbar, chunksize=chunksize
+        )
+    finally:
+        # shut down workers
+        for i in range(n_workers):
+            inQ.put(None)
+        for w in workers:
+            w.terminate()
+            w.join()
+
+    return data_out
+
+
+def _makechunks(inputshape, maskarray, nprocs, procbyvoxel, chunksize):
+    if procbyvoxel:
+        indexaxis = 0
+        procunit = "voxels"
+    else:
+        indexaxis = 1
+        procunit = "timepoints"
+    if maskarray is None:
+        indexlist = np.arange(inputshape[indexaxis])
+    else:
+        indexlist = np.where(np.asarray(maskarray)[: inputshape[indexaxis]] > 0)[0]
+    totalnum = len(indexlist)
+    thechunksize = int(
+        np.max([1, np.min([chunksize, np.ceil(totalnum / (4 * nprocs))])])
+    )
+    chunks = [
+        (start, np.min([start + thechunksize, totalnum]))
+        for start in range(0, totalnum, thechunksize)
+    ]
+    print(
+        "processing", totalnum, procunit + " in", len(chunks), "chunks with", nprocs, "processes"
     )
+    return indexlist, chunks
 
-    # shut down workers
-    for i in range(n_workers):
+
+def _collectchunks(outQ, workers, numchunks, totalnum, showprogressbar=True):
+    data_out = []
+    numdone = 0
+    if showprogressbar:
+        tide_util.progressbar(0, totalnum, label="Percent complete")
+    theerrors = []
+    for i in range(numchunks):
+        numinchunk, ret, cputime, maxrss, theerror = _getresult(outQ, workers)
+        tide_util.recordworkerusage(cputime, maxrss)
+        if theerror is not None:
+            theerrors.append(theerror)
+        elif ret is not None:
+            data_out.append(ret)
+        numdone += numinchunk
+        if showprogressbar:
+            tide_util.progressbar(numdone, totalnum, label="Percent complete")
+    print()
+
+    # every chunk has been collected, so the queues are empty and a pool can still be shut down
+    # cleanly, but the outputs are incomplete - stop here
+    if len(theerrors) > 0:
+        raise RuntimeError(
+            str(len(theerrors))
+            + " of "
+            + str(numchunks)
+            + " chunks failed in the worker processes.  The first failure was:\n"
+            + theerrors[0]
+        )
+    return data_out
+
+
+def run_multiproc_chunked(
+    procfunc,
+    inputshape,
+    maskarray,
+    nprocs=1,
+    procbyvoxel=True,
+    showprogressbar=True,
+    chunksize=1000,
+):
+    r"""Process items in contiguous chunks with a pool of worker processes.
+
+    Rather than sending each item index through a queue and sending the results back,
+    each worker is handed a range of item indices and calls procfunc on them.  procfunc
+    should write its results directly into shared arrays (see allocshared and numpy2shared),
+    and may return a small summary value for the chunk.
+
+    Parameters
+    ----------
+    procfunc : function
+        Function taking a 1D array of item indices.  It is inherited by the workers when they
+        are forked, so it can be a closure over the (shared) input and output arrays.
+    inputshape : tuple
+        Shape of the input data
+    maskarray : 1D array
+        Only items where maskarray is greater than 0 are processed.  If None, all items
+        are processed.
+    nprocs : int, optional
+        Number of worker processes.  Default is 1.
+    procbyvoxel : bool, optional
+        If True, items are along the first axis of inputshape, otherwise the second.
+        Default is True.
+    showprogressbar : bool, optional
+        Show a progress bar.  Default is True.
+    chunksize : int, optional
+        Largest number of items to put in a chunk.  Chunks are also limited so that each worker
+        gets several of them, to balance the load.  Default is 1000.
+
+    Returns
+    -------
+    data_out : list
+        The values returned by procfunc for each chunk, in order of completion.
+
+    Raises
+    ------
+    RuntimeError
+        If procfunc raised an exception in any worker (the message holds the worker's traceback),
+        or if a worker process died before returning its results.
+    """
+    indexlist, chunks = _makechunks(inputshape, maskarray, nprocs, procbyvoxel, chunksize)
+
+    # queue the work, then start the workers
+    inQ = mp.Queue()
+    outQ = mp.Queue()
+    for thechunk in chunks:
+        inQ.put(thechunk)
+    for i in range(nprocs):
         inQ.put(None)
+    workers = [
+        mp.Process(target=_process_chunks, args=(procfunc, indexlist, inQ, outQ))
+        for i in range(nprocs)
+    ]
     for w in workers:
-        w.terminate()
-        w.join()
+        w.start()
+
+    # collect the chunk summaries, then shut down workers
+    try:
+        data_out = _collectchunks(
+            outQ, workers, len(chunks), len(indexlist), showprogressbar=showprogressbar
+        )
+    except RuntimeError:
+        # if a worker died, the others would go on working through the queue - stop them
+        for w in workers:
+            w.terminate()
+        raise
+    finally:
+        for w in workers:
+            w.join()
+
+    return data_out
+
+
+# arrays attached to a workerpool - the workers inherit this when they are forked
+_poolarrays = {}
+
+
+def _getarrayaddress(thearray):
+    return thearray.__array_interface__["data"][0]
+
+
+def _resolvearrays(arraydescs):
+    # rebuild the arrays (or views of them) described by workerpool.findarray
+    thearrays = {}
+    for key, thedesc in arraydescs.items():
+        if thedesc is None:
+            thearrays[key] = None
+        else:
+            name, offset, theshape, thestrides = thedesc
+            thebase = _poolarrays[name]
+            thearrays[key] = np.ndarray(
+                theshape, dtype=thebase.dtype, buffer=thebase, offset=offset, strides=thestrides
+            )
+    return thearrays
+
+
+def _poolworker(jobQ, inQ, outQ):
+    currentjob = None
+    while True:
+        # get a new chunk
+        val = inQ.get()
+
+        # this is the 'TERM' signal
+        if val is None:
+            break
+
+        # pick up the description of the job this chunk belongs to
+        jobid, start, end = val
+        while currentjob is None or currentjob[0] != jobid:
+            currentjob = jobQ.get()
+            stagefunc, thearrays, params, indexlist = (
+                currentjob[1],
+                _resolvearrays(currentjob[2]),
+                currentjob[3],
+                currentjob[4],
+            )
+
+        # process the chunk and report back how many items were done
+        outQ.put(_runchunk(stagefunc, (indexlist[start:end], thearrays, params), end - start))
+
+
+class workerpool:
+    r"""A set of worker processes that is started once and reused for every pass.
+
+    Large arrays are attached to the pool, so the workers inherit them through shared memory
+    rather than getting a fresh copy of the parent for every stage.  Arrays that are only needed
+    by later stages can be attached after the pool is started - the workers are restarted (so
+    they see the new arrays) before the next stage runs.
+    Stages are module level functions with the signature stagefunc(items, arrays, params),
+    where arrays maps names to attached arrays (or views of them) and params holds the small,
+    picklable arguments for the stage.
+    """
+
+    def __init__(self, nprocs):
+        self.nprocs = nprocs
+        self.arrays = {}
+        self.workers = []
+        self.jobQs = []
+        self.inQ = None
+        self.outQ = None
+        self.numjobs = 0
+        self.started = False
+        self.restartneeded = False
+
+    def attach(self, name, thearray):
+        r"""Move an array into shared memory so the workers can see it.
+
+        Parameters
+        ----------
+        name : str
+            Name of the array
+        thearray : numpy array
+            The data.  It is copied, so the returned array should be used from then on.  Writable
+            file backed arrays (see allocfile) and arrays already in shared memory (see allocshared)
+            are visible to forked processes, so they are attached as they are, without a copy.
+
+        Returns
+        -------
+        sharedarray : numpy array
+            The shared copy of thearray
+        """
+        if self.started:
+            # the running workers were forked before this array existed
+            self.restartneeded = True
+        if _isshared(thearray):
+            sharedarray = thearray
+        else:
+            sharedarray, dummy, dummy = numpy2shared(thearray, thearray.dtype)
+        self.arrays[name] = sharedarray
+        _poolarrays[name] = sharedarray
+        return sharedarray
+
+    def findarray(self, thearray):
+        r"""Find an attached array that thearray is (or is a view into).
+
+        Returns
+        -------
+        thedesc : tuple or None
+            (name, offset, shape, strides) if thearray lives in an attached array, otherwise None
+        """
+        theaddress = _getarrayaddress(thearray)
+        for name, thebase in self.arrays.items():
+            offset = theaddress - _getarrayaddress(thebase)
+            if (thearray.dtype == thebase.dtype) and (0 <= offset < thebase.nbytes):
+                return (name, offset, thearray.shape, thearray.strides)
+        return None
+
+    def start(self):
+        self.inQ = mp.Queue()
+        self.outQ = mp.Queue()
+        self.jobQs = [mp.Queue() for i in range(self.nprocs)]
+        self.workers = [
+            mp.Process(target=_poolworker, args=(self.jobQs[i], self.inQ, self.outQ))
+            for i in range(self.nprocs)
+        ]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+        self.started = True
+        self.restartneeded = False
+        print("started a pool of", self.nprocs, "worker processes")
+
+    def _stopworkers(self):
+        for i in range(self.nprocs):
+            self.inQ.put(None)
+        for w in self.workers:
+            w.join()
+        self.started = False
+
+    def run(
+        self,
+        stagefunc,
+        arraydescs,
+        params,
+        inputshape,
+        maskarray,
+        procbyvoxel=True,
+        showprogressbar=True,
+        chunksize=1000,
+    ):
+        if self.restartneeded:
+            # pick up the arrays attached since the workers were started
+            self._stopworkers()
+            self.start()
+        indexlist, chunks = _makechunks(
+            inputshape, maskarray, self.nprocs, procbyvoxel, chunksize
+        )
+        self.numjobs += 1
+        for thejobQ in self.jobQs:
+            thejobQ.put((self.numjobs, stagefunc, arraydescs, params, indexlist))
+        for start, end in chunks:
+            self.inQ.put((self.numjobs, start, end))
+        try:
+            return _collectchunks(
+                self.outQ,
+                self.workers,
+                len(chunks),
+                len(indexlist),
+                showprogressbar=showprogressbar,
+            )
+        except RuntimeError:
+            if not all([w.is_alive() for w in self.workers]):
+                # a worker died, so chunks may still be queued and the pool can't be used again
+                self.terminate()
+            raise
+
+    def terminate(self):
+        r"""Stop the workers without waiting for queued work to finish."""
+        for w in self.workers:
+            w.terminate()
+            w.join()
+        self.started = False
+
+    def shutdown(self):
+        if self.started:
+            self._stopworkers()
+        for name in self.arrays.keys():
+            _poolarrays.pop(name, None)
+        self.arrays = {}
+
+
+def run_multiproc_stage(
+    stagefunc,
+    inputs,
+    outputs,
+    params,
+    inputshape,
+    maskarray,
+    nprocs=1,
+    pool=None,
+    procbyvoxel=True,
+    showprogressbar=True,
+    chunksize=1000,
+):
+    r"""Run one processing stage, using a workerpool if possible.
+
+    Parameters
+    ----------
+    stagefunc : function
+        Module level function stagefunc(items, arrays, params, showprogressbar=False) that
+        processes the items in the 1D index array items, writes its results into the output
+        arrays, and returns a small summary value.
+    inputs : dict
+        Arrays the stage reads (None values are allowed)
+    outputs : dict
+        Arrays the stage writes.  Without a pool, outputs that are not file backed or already in
+        shared memory (see allocshared) are copied to shared memory for the stage and back after it.
+    params : dict
+        Everything else the stage needs
+    inputshape : tuple
+        Shape of the input data
+    maskarray : 1D array
+        Only items where maskarray is greater than 0 are processed.  If None, all items
+        are processed.
+    nprocs : int, optional
+        Number of worker processes.  Default is 1.
+    pool : workerpool, optional
+        A running pool.  It is used if all of the input and output arrays are attached to it;
+        otherwise a set of workers is forked just for this stage.  Default is None.
+    procbyvoxel : bool, optional
+        If True, items are along the first axis of inputshape, otherwise the second.
+        Default is True.
+    showprogressbar : bool, optional
+        Show a progress bar.  Default is True.
+    chunksize : int, optional
+        Largest number of items to put in a chunk.  Default is 1000.
+
+    Returns
+    -------
+    data_out : list
+        The values returned by stagefunc for each chunk.
+
+    Raises
+    ------
+    RuntimeError
+        If stagefunc raised an exception in any worker (the message holds the worker's traceback),
+        or if a worker process died before returning its results.
+    """
+    thearrays = dict(inputs)
+    thearrays.update(outputs)
+    if nprocs <= 1:
+        if procbyvoxel:
+            indexaxis = 0
+        else:
+            indexaxis = 1
+        if maskarray is None:
+            indexlist = np.arange(inputshape[indexaxis])
+        else:
+            indexlist = np.where(np.asarray(maskarray)[: inputshape[indexaxis]] > 0)[0]
+        return [stagefunc(indexlist, thearrays, params, showprogressbar=showprogressbar)]
+
+    if pool is not None and pool.started:
+        arraydescs = {}
+        for key, thearray in thearrays.items():
+            if thearray is None:
+                arraydescs[key] = None
+            else:
+                arraydescs[key] = pool.findarray(thearray)
+                if arraydescs[key] is None:
+                    break
+        else:
+            return pool.run(
+                stagefunc,
+                arraydescs,
+                params,
+                inputshape,
+                maskarray,
+                procbyvoxel=procbyvoxel,
+                showprogressbar=showprogressbar,
+                chunksize=chunksize,
+            )
+
+    # no pool to use - fork workers that write into shared copies of the outputs (outputs that are
+    # file backed or already in shared memory are written in place)
+    sharedarrays = dict(inputs)
+    copiedkeys = []
+    for key, thearray in outputs.items():
+        if _isshared(thearray):
+            sharedarrays[key] = thearray
+        else:
+            sharedarrays[key] = numpy2shared(thearray, thearray.dtype)[0]
+            copiedkeys.append(key)
+
+    def stage_proc(items):
+        return stagefunc(items, sharedarrays, params)
+
+    data_out = run_multiproc_chunked(
+        stage_proc,
+        inputshape,
+        maskarray,
+        nprocs=nprocs,
+        procbyvoxel=procbyvoxel,
+        showprogressbar=showprogressbar,
+        chunksize=chunksize,
+    )
 
+    # copy the data back out
+    for key in copiedkeys:
+        outputs[key][...] = sharedarrays[key]
     return data_out
 
 
@@ -164,7 +747,7 @@ def run_multithread(
             data_in.append(d)
     print("processing", len(data_in), "voxels with", n_workers, "threads")
     data_out = _process_data(
-        data_in, inQ, outQ, showprogressbar=showprogressbar, chunksize=chunksize
+        data_in, inQ, outQ, workers, showprogressbar=showprogressbar, chunksize=chunksize
     )
 
     # shut down workers
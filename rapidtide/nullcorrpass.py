@@ -23,12 +23,28 @@
 #
 
 
+import hashlib
+import os
+
 import numpy as np
+from scipy import fftpack
+
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.util as tide_util
 
 import rapidtide.corrpass as tide_corrpass
 import rapidtide.corrfit as tide_corrfit
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.miscmath as tide_math
+
+
+def _shuffle(indata, seed, iteration):
+    # each shuffle depends only on the seed and its own iteration number, so the distribution
+    # does not depend on how the iterations are split up between processes
+    if seed is None:
+        return np.random.permutation(indata)
+    return np.random.default_rng([seed, iteration]).permutation(indata)
 
 
 def _procOneNullCorrelationx(
@@ -41,11 +57,12 @@ def _procOneNullCorrelationx(
     lagmininpts,
     lagmaxinpts,
     optiondict,
+    seed=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
     # make a shuffled copy of the regressors
-    shuffleddata = np.random.permutation(indata)
+    shuffleddata = _shuffle(indata, seed, iteration)
 
     # crosscorrelate with original
     thexcorr, dummy = tide_corrpass.onecorrelation(
@@ -76,95 +93,304 @@ def _procOneNullCorrelationx(
     return maxval
 
 
-def getNullDistributionDatax(
+def _procNullCorrelationBlock(
+    iterations,
     indata,
-    corrscale,
     ncprefilter,
     oversampfreq,
+    corrscale,
     corrorigin,
     lagmininpts,
     lagmaxinpts,
+    reffft,
+    fftlen,
     optiondict,
+    seed,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
-    inputshape = np.asarray([optiondict["numestreps"]])
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def nullCorrelation_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
+    # shuffle, filter, and normalize a whole block of surrogate timecourses at once
+    shuffledblock = np.zeros((len(iterations), len(indata)), dtype=rt_floattype)
+    for i, iteration in enumerate(iterations):
+        shuffledblock[i, :] = _shuffle(indata, seed, iteration)
+    filteredblock = ncprefilter.apply(oversampfreq, shuffledblock)
+    preppedblock = tide_math.getcorrnormalizer(
+        len(indata),
+        prewindow=optiondict["usewindowfunc"],
+        detrendorder=optiondict["detrendorder"],
+        windowfunc=optiondict["windowfunc"],
+        dtype=filteredblock.dtype,
+    ).apply(filteredblock, inplace=True)
+
+    # correlate them all against the original in one pair of transforms
+    numpoints = np.shape(preppedblock)[1]
+    thexcorrs = tide_filt.inverserealfft(
+        tide_filt.realfft(preppedblock, n=fftlen, axis=1) * reffft, n=fftlen, axis=1
+    )[:, : 2 * numpoints - 1][:, corrorigin - lagmininpts : corrorigin + lagmaxinpts]
+    thecorrscale = corrscale[corrorigin - lagmininpts : corrorigin + lagmaxinpts]
+
+    # fit the peaks
+    if (optiondict["findmaxtype"] == "gauss") and not optiondict["fixdelay"]:
+        maxvals = tide_fit.findmaxlag_gauss_block(
+            thecorrscale,
+            thexcorrs,
+            optiondict["lagmin"],
+            optiondict["lagmax"],
+            optiondict["widthlimit"],
+            absmaxsigma=optiondict["absmaxsigma"],
+            edgebufferfrac=optiondict["edgebufferfrac"],
+            threshval=0.0,
+            uthreshval=optiondict["uthreshval"],
+            refine=optiondict["gaussrefine"],
+            refinetype=optiondict["peakfitrefine"],
+            fititers=optiondict["peakfititers"],
+            bipolar=optiondict["bipolar"],
+            searchfrac=optiondict["searchfrac"],
+            fastgauss=optiondict["fastgauss"],
+            enforcethresh=optiondict["enforcethresh"],
+            zerooutbadfit=True,
+            lagmod=optiondict["lagmod"],
+            hardlimit=optiondict["hardlimit"],
+        )[2]
+    else:
+        maxvals = np.zeros(len(iterations), dtype=rt_floattype)
+        for i in range(len(iterations)):
+            maxvals[i] = tide_corrfit.onecorrfitx(
+                thexcorrs[i, :],
+                thecorrscale,
+                optiondict,
+                zerooutbadfit=True,
+                disablethresholds=True,
+                rt_floatset=rt_floatset,
+                rt_floattype=rt_floattype,
+            )[2]
+    return np.asarray(maxvals, dtype=rt_floattype)
 
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
 
-                    # process and send the data
-                    outQ.put(
-                        _procOneNullCorrelationx(
-                            val,
-                            indata,
-                            ncprefilter,
-                            oversampfreq,
-                            corrscale,
-                            corrorigin,
-                            lagmininpts,
-                            lagmaxinpts,
-                            optiondict,
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
+def _nullcachename(
+    indata,
+    corrscale,
+    ncprefilter,
+    oversampfreq,
+    corrorigin,
+    lagmininpts,
+    lagmaxinpts,
+    optiondict,
+    seed,
+    rt_floattype,
+):
+    # the name of the cache file for a distribution is a hash of everything it depends on
+    thehash = hashlib.sha1()
+    thehash.update(np.ascontiguousarray(indata, dtype=np.float64).tobytes())
+    thehash.update(
+        np.ascontiguousarray(
+            corrscale[corrorigin - lagmininpts : corrorigin + lagmaxinpts],
+            dtype=np.float64,
+        ).tobytes()
+    )
+    thesettings = [
+        oversampfreq,
+        corrorigin,
+        lagmininpts,
+        lagmaxinpts,
+        seed,
+        str(rt_floattype),
+        ncprefilter.gettype(),
+        ncprefilter.getfreqlimits(),
+        ncprefilter.getpadtime(),
+        ncprefilter.usebutterworth,
+        ncprefilter.usetrapfftfilt,
+    ]
+    for thekey in [
+        "numestreps",
+        "usewindowfunc",
+        "detrendorder",
+        "windowfunc",
+        "corrweighting",
+        "findmaxtype",
+        "fixdelay",
+        "fixeddelayvalue",
+        "lagmin",
+        "lagmax",
+        "widthlimit",
+        "absmaxsigma",
+        "edgebufferfrac",
+        "uthreshval",
+        "gaussrefine",
+        "peakfitrefine",
+        "peakfititers",
+        "bipolar",
+        "searchfrac",
+        "fastgauss",
+        "enforcethresh",
+        "lagmod",
+        "hardlimit",
+    ]:
+        thesettings.append((thekey, optiondict.get(thekey, None)))
+    thehash.update(repr(thesettings).encode())
+    return os.path.join(
+        optiondict["nullcachedir"], "nulldist_" + thehash.hexdigest() + ".npy"
+    )
 
-                except Exception as e:
-                    print("error!", e)
-                    break
 
-        data_out = tide_multiproc.run_multiproc(
-            nullCorrelation_consumer,
-            inputshape,
-            None,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
+def _nullcorrelationstage(iterations, arrays, params, showprogressbar=False):
+    if params["blocksize"] > 0:
+        maxvals = np.zeros(len(iterations), dtype=params["rt_floattype"])
+        for blockstart in range(0, len(iterations), params["blocksize"]):
+            blockend = np.min([blockstart + params["blocksize"], len(iterations)])
+            if showprogressbar:
+                tide_util.progressbar(blockend, len(iterations), label="Percent complete")
+            maxvals[blockstart:blockend] = _procNullCorrelationBlock(
+                iterations[blockstart:blockend],
+                params["indata"],
+                params["ncprefilter"],
+                params["oversampfreq"],
+                params["corrscale"],
+                params["corrorigin"],
+                params["lagmininpts"],
+                params["lagmaxinpts"],
+                params["reffft"],
+                params["fftlen"],
+                params["optiondict"],
+                params["seed"],
+                rt_floatset=params["rt_floatset"],
+                rt_floattype=params["rt_floattype"],
+            )
+        return iterations, maxvals
+    maxvals = np.zeros(len(iterations), dtype=params["rt_floattype"])
+    for i, iteration in enumerate(iterations):
+        maxvals[i] = _procOneNullCorrelationx(
+            iteration,
+            params["indata"],
+            params["ncprefilter"],
+            params["oversampfreq"],
+            params["corrscale"],
+            params["corrorigin"],
+            params["lagmininpts"],
+            params["lagmaxinpts"],
+            params["optiondict"],
+            seed=params["seed"],
+            rt_floatset=params["rt_floatset"],
+            rt_floattype=params["rt_floattype"],
         )
+        if showprogressbar:
+            tide_util.progressbar(i + 1, len(iterations), label="Percent complete")
+    return iterations, maxvals
 
-        # unpack the data
-        corrlist = np.asarray(data_out, dtype=rt_floattype)
-    else:
-        corrlist = np.zeros((optiondict["numestreps"]), dtype=rt_floattype)
-
-        for i in range(0, optiondict["numestreps"]):
-            # make a shuffled copy of the regressors
-            shuffleddata = np.random.permutation(indata)
-
-            # crosscorrelate with original, fit, and return the maximum value, and add it to the list
-            thexcorr = _procOneNullCorrelationx(
-                i,
-                indata,
-                ncprefilter,
-                oversampfreq,
-                corrscale,
-                corrorigin,
-                lagmininpts,
-                lagmaxinpts,
-                optiondict,
-                rt_floatset=rt_floatset,
-                rt_floattype=rt_floattype,
-            )
-            corrlist[i] = thexcorr
 
-            # progress
-            if optiondict["showprogressbar"]:
-                tide_util.progressbar(
-                    i + 1, optiondict["numestreps"], label="Percent complete"
-                )
+def getNullDistributionDatax(
+    indata,
+    corrscale,
+    ncprefilter,
+    oversampfreq,
+    corrorigin,
+    lagmininpts,
+    lagmaxinpts,
+    optiondict,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+    pool=None,
+):
+    r"""Estimate the distribution of peak correlation values for a regressor and shuffled copies of itself.
+
+    Parameters
+    ----------
+    indata : 1D float array
+        The (prepared) reference regressor
+    corrscale : 1D float array
+        The time lags of the full correlation function
+    ncprefilter : noncausalfilter
+        The filter applied to each shuffled regressor
+    oversampfreq : float
+        Sample frequency of indata
+    corrorigin, lagmininpts, lagmaxinpts : int
+        Location of zero lag in the correlation function, and the range of points around it to fit
+    optiondict : dict
+        The run options.  Uses numestreps (the number of shuffles), nullblocksize (the number of
+        shuffles to correlate at once - 0 does one at a time), nullseed (if not None, the seed
+        for the shuffles, which makes the distribution reproducible regardless of the number of
+        processes), and nullcachedir (if not None and nullseed is set, distributions are saved in
+        this directory and reused when the regressor, seed, and options match), as well as the
+        correlation and peak fitting options.
+    rt_floatset, rt_floattype : optional
+        The internal floating point type
+    pool : workerpool, optional
+        Worker pool to use if multiprocessing.  Default is None.
+
+    Returns
+    -------
+    corrlist : 1D float array
+        The peak correlation value for each shuffle
+    """
+    if optiondict["nullseed"] is None:
+        theseed = np.random.randint(0, 2 ** 31 - 1)
+    else:
+        theseed = int(optiondict["nullseed"])
+
+    # see if we have done this before
+    cachefile = None
+    if (optiondict["nullcachedir"] is not None) and (optiondict["nullseed"] is not None):
+        cachefile = _nullcachename(
+            indata,
+            corrscale,
+            ncprefilter,
+            oversampfreq,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            optiondict,
+            theseed,
+            rt_floattype,
+        )
+        if os.path.isfile(cachefile):
+            print("reading null distribution from", cachefile)
+            return np.load(cachefile).astype(rt_floattype)
 
+    inputshape = np.asarray([optiondict["numestreps"]])
+    params = {
+        "indata": indata,
+        "ncprefilter": ncprefilter,
+        "oversampfreq": oversampfreq,
+        "corrscale": corrscale,
+        "corrorigin": corrorigin,
+        "lagmininpts": lagmininpts,
+        "lagmaxinpts": lagmaxinpts,
+        "optiondict": optiondict,
+        "seed": theseed,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+        "blocksize": 0,
+    }
+
+    # set up the batched version if we can use it
+    if optiondict["nullblocksize"] > 0 and optiondict["corrweighting"] == "none":
+        params["fftlen"] = fftpack.next_fast_len(2 * len(indata) - 1)
+        params["reffft"] = tide_filt.realfft(
+            np.asarray(indata, dtype=rt_floattype)[::-1], n=params["fftlen"]
+        )
+        params["blocksize"] = optiondict["nullblocksize"]
+
+    data_out = tide_multiproc.run_multiproc_stage(
+        _nullcorrelationstage,
+        {},
+        {},
+        params,
+        inputshape,
+        None,
+        nprocs=optiondict["nprocs"],
+        pool=pool,
+        showprogressbar=optiondict["showprogressbar"],
+        chunksize=optiondict["mp_chunksize"],
+    )
+    if optiondict["nprocs"] <= 1:
         # jump to line after progress bar
         print()
 
+    # unpack the data
+    corrlist = np.zeros((optiondict["numestreps"]), dtype=rt_floattype)
+    for iterations, maxvals in data_out:
+        corrlist[iterations] = maxvals
+
     # return the distribution data
     numnonzero = len(np.where(corrlist != 0.0)[0])
     print(
@@ -175,6 +401,10 @@ def getNullDistributionDatax(
         100.0 * numnonzero / len(corrlist),
         "%)",
     )
+    if cachefile is not None:
+        if not os.path.isdir(optiondict["nullcachedir"]):
+            os.makedirs(optiondict["nullcachedir"])
+        np.save(cachefile, corrlist)
     return corrlist
 
 
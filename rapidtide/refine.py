@@ -33,10 +33,9 @@ import rapidtide.fit as tide_fit
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.resample as tide_resample
 
-from sklearn.decomposition import FastICA, PCA
 import numpy as np
-from scipy.stats.stats import pearsonr
-from scipy.signal import welch
+
+signal = tide_util.lazymodule("scipy.signal")
 
 
 def _procOneVoxelTimeShift(
@@ -100,7 +99,7 @@ def _procOneVoxelTimeShift(
         outtc = 1.0 * shiftedtc
         outweights = 1.0 * weights
     if psdfilter:
-        freqs, psd = welch(
+        freqs, psd = signal.welch(
             tide_math.corrnormalize(shiftedtc, True, True),
             fmritr,
             scaling="spectrum",
@@ -113,6 +112,248 @@ def _procOneVoxelTimeShift(
         return vox, outtc, outweights, None
 
 
+def _procVoxelBlockTimeShift(
+    fmritcs,
+    lagstrengths,
+    R2vals,
+    lagtimes,
+    padtrs,
+    fmritr,
+    theprefilter,
+    fmrifreq,
+    refineprenorm="mean",
+    lagmaxthresh=5.0,
+    refineweighting="R",
+    detrendorder=1,
+    offsettime=0.0,
+    filterbeforePCA=False,
+    psdfilter=False,
+):
+    # block version of _procOneVoxelTimeShift - each row of fmritcs is a voxel.  The shifted
+    # timecourses keep the precision of fmritcs, but the normalizations are done in double.
+    thedtype = np.result_type(fmritcs.dtype, np.float32)
+    if refineprenorm == "mean":
+        thedivisors = np.mean(fmritcs, axis=1, dtype=np.float64)
+    elif refineprenorm == "var":
+        thedivisors = np.var(fmritcs, axis=1, dtype=np.float64)
+    elif refineprenorm == "std":
+        thedivisors = np.std(fmritcs, axis=1, dtype=np.float64)
+    elif refineprenorm == "invlag":
+        thedivisors = np.where(lagtimes < lagmaxthresh, lagmaxthresh - lagtimes, 0.0)
+    else:
+        thedivisors = np.ones(np.shape(fmritcs)[0], dtype=np.float64)
+    normfacs = np.zeros(np.shape(thedivisors), dtype=np.float64)
+    nonzero = np.where(thedivisors != 0.0)
+    normfacs[nonzero] = 1.0 / thedivisors[nonzero]
+
+    if refineweighting == "R":
+        theweights = lagstrengths
+    elif refineweighting == "R2":
+        theweights = R2vals
+    else:
+        theweights = np.ones(np.shape(fmritcs)[0], dtype=np.float64)
+    normtcs = fmritcs * (normfacs * theweights).astype(thedtype)[:, None]
+    if detrendorder > 0:
+        normtcs = tide_fit.detrend(normtcs, order=detrendorder, demean=True).astype(thedtype)
+    shifttrs = -(-offsettime + lagtimes) / fmritr  # lagtime is in seconds
+    shiftedtcs, weights = tide_resample.timeshiftblock(normtcs, shifttrs, padtrs)
+    if filterbeforePCA:
+        outtcs = theprefilter.apply(fmrifreq, shiftedtcs)
+        outweights = theprefilter.apply(fmrifreq, weights)
+    else:
+        outtcs = shiftedtcs
+        outweights = weights
+    psds = []
+    if psdfilter:
+        for i in range(np.shape(shiftedtcs)[0]):
+            freqs, psd = signal.welch(
+                tide_math.corrnormalize(shiftedtcs[i, :], True, True),
+                fmritr,
+                scaling="spectrum",
+                window="hamming",
+                return_onesided=False,
+                nperseg=np.shape(shiftedtcs)[1],
+            )
+            psds.append(np.sqrt(psd))
+    return outtcs, outweights, psds
+
+
+def _timeshiftstage(voxels, arrays, params, showprogressbar=False):
+    fmridata = arrays["fmridata"]
+    lagstrengths = arrays["lagstrengths"]
+    R2 = arrays["R2"]
+    lagtimes = arrays["lagtimes"]
+    shiftedtcs = arrays["shiftedtcs"]
+    weights = arrays["weights"]
+    optiondict = params["optiondict"]
+    reportstep = 1000
+    blocksize = params["blocksize"]
+    psdlist = []
+    if blocksize > 0:
+        for blockstart in range(0, len(voxels), blocksize):
+            blockend = np.min([blockstart + blocksize, len(voxels)])
+            thevoxels = np.asarray(voxels[blockstart:blockend])
+            if showprogressbar:
+                tide_util.progressbar(
+                    blockend, len(voxels), label="Percent complete (timeshifting)"
+                )
+            shiftedtcs[thevoxels, :], weights[
+                thevoxels, :
+            ], thepsds = _procVoxelBlockTimeShift(
+                fmridata[thevoxels, :],
+                lagstrengths[thevoxels],
+                R2[thevoxels],
+                lagtimes[thevoxels],
+                params["padtrs"],
+                params["fmritr"],
+                params["theprefilter"],
+                optiondict["fmrifreq"],
+                refineprenorm=optiondict["refineprenorm"],
+                lagmaxthresh=optiondict["lagmaxthresh"],
+                refineweighting=optiondict["refineweighting"],
+                detrendorder=optiondict["detrendorder"],
+                offsettime=optiondict["offsettime"],
+                filterbeforePCA=optiondict["filterbeforePCA"],
+                psdfilter=optiondict["psdfilter"],
+            )
+            psdlist += thepsds
+        return psdlist
+    for i, vox in enumerate(voxels):
+        if (i % reportstep == 0 or i == len(voxels) - 1) and showprogressbar:
+            tide_util.progressbar(
+                i + 1, len(voxels), label="Percent complete (timeshifting)"
+            )
+        retvals = _procOneVoxelTimeShift(
+            vox,
+            fmridata[vox, :],
+            lagstrengths[vox],
+            R2[vox],
+            lagtimes[vox],
+            params["padtrs"],
+            params["fmritr"],
+            params["theprefilter"],
+            optiondict["fmrifreq"],
+            refineprenorm=optiondict["refineprenorm"],
+            lagmaxthresh=optiondict["lagmaxthresh"],
+            refineweighting=optiondict["refineweighting"],
+            detrendorder=optiondict["detrendorder"],
+            offsettime=optiondict["offsettime"],
+            filterbeforePCA=optiondict["filterbeforePCA"],
+            psdfilter=optiondict["psdfilter"],
+            rt_floatset=params["rt_floatset"],
+            rt_floattype=params["rt_floattype"],
+        )
+        shiftedtcs[retvals[0], :] = retvals[1]
+        weights[retvals[0], :] = retvals[2]
+        if optiondict["psdfilter"]:
+            psdlist.append(retvals[3])
+    return psdlist
+
+
+def _blocksum(thearray, rowlist, blocksize):
+    # the sum of the rows of thearray in rowlist, gathered a block at a time rather than all at
+    # once.  The running total goes in as the first row of each block, so the rows are added in
+    # exactly the same order as np.sum(thearray[rowlist], axis=0).
+    thesum = np.zeros(np.shape(thearray)[1], dtype=thearray.dtype)
+    for blockstart in range(0, len(rowlist), blocksize):
+        thesum = np.sum(
+            np.concatenate(
+                (thesum[None, :], thearray[rowlist[blockstart : blockstart + blocksize]])
+            ),
+            axis=0,
+        )
+    return thesum
+
+
+def _blockcovariance(thearray, rowlist, blocksize):
+    # the (biased) covariance between timepoints over the rows of thearray in rowlist,
+    # accumulated a block at a time.  The rows are offset by the mean of the first block to keep
+    # the accumulated sums small.  Needs a float64 T x T cross product and one blocksize x T
+    # block, however many rows there are.
+    numpoints = np.shape(thearray)[1]
+    theoffset = np.mean(thearray[rowlist[:blocksize]], axis=0, dtype=np.float64)
+    thesum = np.zeros(numpoints, dtype=np.float64)
+    thecrossprod = np.zeros((numpoints, numpoints), dtype=np.float64)
+    for blockstart in range(0, len(rowlist), blocksize):
+        theblock = (
+            np.asarray(thearray[rowlist[blockstart : blockstart + blocksize]], dtype=np.float64)
+            - theoffset[None, :]
+        )
+        thesum += np.sum(theblock, axis=0)
+        thecrossprod += np.dot(np.transpose(theblock), theblock)
+    themean = thesum / len(rowlist)
+    return thecrossprod / len(rowlist) - np.outer(themean, themean)
+
+
+def _firstcomponent(thearray, rowlist, blocksize, unitvariance=False):
+    r"""First principal component of the rows of thearray in rowlist, without copying them out.
+
+    The component is the leading eigenvector of the timepoint covariance matrix, which is
+    accumulated from blocks of rows, so memory use is O(T^2) in the number of timepoints T (8 * T^2
+    bytes for the covariance, so about 8 MB for 1000 timepoints) rather than growing with the
+    number of voxels.  This only wins while T is small compared to the number of voxels: once
+    2 * T exceeds the number of float32 rows used, the covariance is bigger than copying the
+    rows out would have been.
+
+    This gives the same answer as PCA(n_components=1).fit(thearray[rowlist]).components_[0], up
+    to sign.  With unitvariance=True, the component is scaled to give the same answer as
+    FastICA(n_components=1) (which, with a single component, is the whitened first principal
+    component).
+
+    Parameters
+    ----------
+    thearray : 2D float array
+        Voxel timecourses, one per row
+    rowlist : 1D int array
+        The rows to use
+    blocksize : int
+        Number of rows to read at a time
+    unitvariance : bool, optional
+        Scale the component the way FastICA does.  Default is False.
+
+    Returns
+    -------
+    thecomponent : 1D float array
+    """
+    eigvals, eigvecs = np.linalg.eigh(_blockcovariance(thearray, rowlist, blocksize))
+    thecomponent = eigvecs[:, -1]
+    if unitvariance:
+        thecomponent = thecomponent / np.sqrt(eigvals[-1])
+    return thecomponent
+
+
+def _dispersionaverages(shiftedtcs, lagtimes, voxellist, laglist, lagstep, blocksize):
+    # the average timecourse of the voxels in each lag bin (lower < lag < upper), built in one
+    # pass over the voxels rather than one pass per bin
+    numbins = len(laglist)
+    laglowers = laglist - lagstep / 2.0
+    laguppers = laglist + lagstep / 2.0
+    binsums = np.zeros((numbins, np.shape(shiftedtcs)[1]), dtype=np.float64)
+    bincounts = np.zeros(numbins, dtype=np.int64)
+    for blockstart in range(0, len(voxellist), blocksize):
+        thevoxels = voxellist[blockstart : blockstart + blocksize]
+        theselags = lagtimes[thevoxels]
+        theblock = shiftedtcs[thevoxels]
+        nearestbin = np.floor((theselags - laglowers[0]) / lagstep).astype(np.int64)
+        # bin edges are computed from each bin's own center, so check the neighboring bins too
+        for offset in [-1, 0, 1]:
+            thebins = nearestbin + offset
+            inbin = np.where((thebins >= 0) & (thebins < numbins))[0]
+            inbin = inbin[
+                (laglowers[thebins[inbin]] < theselags[inbin])
+                & (theselags[inbin] < laguppers[thebins[inbin]])
+            ]
+            if len(inbin) > 0:
+                membership = np.zeros((numbins, len(thevoxels)), dtype=np.float64)
+                membership[thebins[inbin], inbin] = 1.0
+                binsums += np.dot(membership, theblock)
+                bincounts += np.bincount(thebins[inbin], minlength=numbins)
+    binaverages = np.zeros_like(binsums)
+    hasvoxels = np.where(bincounts > 0)[0]
+    binaverages[hasvoxels, :] = binsums[hasvoxels, :] / bincounts[hasvoxels, None]
+    return binaverages, bincounts
+
+
 def refineregressor(
     fmridata,
     fmritr,
@@ -130,6 +371,7 @@ def refineregressor(
     excludemask=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
+    pool=None,
 ):
     """
 
@@ -167,6 +409,8 @@ def refineregressor(
         Function to coerce variable types
     rt_floattype : {'float32', 'float64'}
         Data type for internal variables
+    pool : workerpool, optional
+        Persistent pool of worker processes to use when multiprocessing.  Default is None.
 
     Returns
     -------
@@ -213,102 +457,39 @@ def refineregressor(
     else:
         shiftmask = refinemask
     volumetotal = np.sum(shiftmask)
-    reportstep = 1000
 
     # timeshift the valid voxels
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def timeshift_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    outQ.put(
-                        _procOneVoxelTimeShift(
-                            val,
-                            fmridata[val, :],
-                            lagstrengths[val],
-                            R2[val],
-                            lagtimes[val],
-                            padtrs,
-                            fmritr,
-                            theprefilter,
-                            optiondict["fmrifreq"],
-                            refineprenorm=optiondict["refineprenorm"],
-                            lagmaxthresh=optiondict["lagmaxthresh"],
-                            refineweighting=optiondict["refineweighting"],
-                            detrendorder=optiondict["detrendorder"],
-                            offsettime=optiondict["offsettime"],
-                            filterbeforePCA=optiondict["filterbeforePCA"],
-                            psdfilter=optiondict["psdfilter"],
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
-
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            timeshift_consumer,
-            inputshape,
-            shiftmask,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
-        )
-
-        # unpack the data
-        psdlist = []
-        for voxel in data_out:
-            shiftedtcs[voxel[0], :] = voxel[1]
-            weights[voxel[0], :] = voxel[2]
-            if optiondict["psdfilter"]:
-                psdlist.append(voxel[3])
-        del data_out
-
-    else:
-        psdlist = []
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and optiondict[
-                "showprogressbar"
-            ]:
-                tide_util.progressbar(
-                    vox + 1, inputshape[0], label="Percent complete (timeshifting)"
-                )
-            if shiftmask[vox] > 0:
-                retvals = _procOneVoxelTimeShift(
-                    vox,
-                    fmridata[vox, :],
-                    lagstrengths[vox],
-                    R2[vox],
-                    lagtimes[vox],
-                    padtrs,
-                    fmritr,
-                    theprefilter,
-                    optiondict["fmrifreq"],
-                    refineprenorm=optiondict["refineprenorm"],
-                    lagmaxthresh=optiondict["lagmaxthresh"],
-                    refineweighting=optiondict["refineweighting"],
-                    detrendorder=optiondict["detrendorder"],
-                    offsettime=optiondict["offsettime"],
-                    filterbeforePCA=optiondict["filterbeforePCA"],
-                    psdfilter=optiondict["psdfilter"],
-                    rt_floatset=rt_floatset,
-                    rt_floattype=rt_floattype,
-                )
-                shiftedtcs[retvals[0], :] = retvals[1]
-                weights[retvals[0], :] = retvals[2]
-                if optiondict["psdfilter"]:
-                    psdlist.append(retvals[3])
-        print()
+    params = {
+        "padtrs": padtrs,
+        "fmritr": fmritr,
+        "theprefilter": theprefilter,
+        "optiondict": optiondict,
+        "blocksize": optiondict["refineblocksize"],
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+    data_out = tide_multiproc.run_multiproc_stage(
+        _timeshiftstage,
+        {
+            "fmridata": fmridata,
+            "lagstrengths": lagstrengths,
+            "R2": R2,
+            "lagtimes": lagtimes,
+        },
+        {"shiftedtcs": shiftedtcs, "weights": weights},
+        params,
+        inputshape,
+        shiftmask,
+        nprocs=optiondict["nprocs"],
+        pool=pool,
+        showprogressbar=optiondict["showprogressbar"],
+        chunksize=optiondict["mp_chunksize"],
+    )
+    psdlist = []
+    for thechunklist in data_out:
+        psdlist += thechunklist
+    del data_out
+    print()
 
     if optiondict["psdfilter"]:
         print(len(psdlist))
@@ -318,18 +499,19 @@ def refineregressor(
         stdpsd = np.std(np.asarray(psdlist, dtype=rt_floattype), axis=0)
         snr = np.nan_to_num(averagepsd / stdpsd)
 
-    # now generate the refined timecourse(s)
+    # now generate the refined timecourse(s).  The voxels are read from shiftedtcs a block at a
+    # time, so the refinement never needs a copy of all of them.
+    if optiondict["refineblocksize"] > 0:
+        reductionblocksize = optiondict["refineblocksize"]
+    else:
+        reductionblocksize = 1000
     validlist = np.where(refinemask > 0)[0]
-    refinevoxels = shiftedtcs[validlist]
-    refineweights = weights[validlist]
-    weightsum = np.sum(refineweights, axis=0) / volumetotal
-    averagedata = np.sum(refinevoxels, axis=0) / volumetotal
+    weightsum = _blocksum(weights, validlist, reductionblocksize) / volumetotal
+    averagedata = _blocksum(shiftedtcs, validlist, reductionblocksize) / volumetotal
     if optiondict["shiftall"]:
         invalidlist = np.where((1 - ampmask) > 0)[0]
-        discardvoxels = shiftedtcs[invalidlist]
-        discardweights = weights[invalidlist]
-        discardweightsum = np.sum(discardweights, axis=0) / volumetotal
-        averagediscard = np.sum(discardvoxels, axis=0) / volumetotal
+        discardweightsum = _blocksum(weights, invalidlist, reductionblocksize) / volumetotal
+        averagediscard = _blocksum(shiftedtcs, invalidlist, reductionblocksize) / volumetotal
     if optiondict["dodispersioncalc"]:
         print("splitting regressors by time lag for phase delay estimation")
         laglist = np.arange(
@@ -348,26 +530,28 @@ def refineregressor(
         dispersioncalcspecphase = np.zeros(
             (np.shape(laglist)[0], fftlen), dtype=rt_floattype
         )
+        binaverages, bincounts = _dispersionaverages(
+            shiftedtcs,
+            lagtimes,
+            np.where(locationmask * ampmask)[0],
+            laglist,
+            optiondict["dispersioncalc_step"],
+            reductionblocksize,
+        )
         for lagnum in range(0, np.shape(laglist)[0]):
             lower = laglist[lagnum] - optiondict["dispersioncalc_step"] / 2.0
             upper = laglist[lagnum] + optiondict["dispersioncalc_step"] / 2.0
-            inlagrange = np.where(
-                locationmask
-                * ampmask
-                * np.where(lower < lagtimes, np.int16(1), np.int16(0))
-                * np.where(lagtimes < upper, np.int16(1), np.int16(0))
-            )[0]
             print(
                 "    summing",
-                np.shape(inlagrange)[0],
+                bincounts[lagnum],
                 "regressors with lags from",
                 lower,
                 "to",
                 upper,
             )
-            if np.shape(inlagrange)[0] > 0:
+            if bincounts[lagnum] > 0:
                 dispersioncalcout[lagnum, :] = tide_math.corrnormalize(
-                    np.mean(shiftedtcs[inlagrange], axis=0),
+                    binaverages[lagnum, :],
                     prewindow=False,
                     detrendorder=optiondict["detrendorder"],
                     windowfunc=optiondict["windowfunc"],
@@ -375,7 +559,6 @@ def refineregressor(
                 freqs, dispersioncalcspecmag[lagnum, :], dispersioncalcspecphase[
                     lagnum, :
                 ] = tide_math.polarfft(dispersioncalcout[lagnum, :], 1.0 / fmritr)
-            inlagrange = None
         tide_io.writenpvecs(
             dispersioncalcout,
             optiondict["outputname"]
@@ -405,19 +588,14 @@ def refineregressor(
             + ".txt",
         )
 
-    if optiondict["estimatePCAdims"]:
-        pcacomponents = "mle"
-    else:
-        pcacomponents = 1
-    icacomponents = 1
-
     if optiondict["refinetype"] == "ica":
+        # scipy.stats is slow to import, so only load it when it is needed
+        from scipy.stats import pearsonr
+
         print("performing ica refinement")
-        thefit = FastICA(n_components=icacomponents).fit(
-            refinevoxels
-        )  # Reconstruct signals
-        print("Using first of ", len(thefit.components_), " components")
-        icadata = thefit.components_[0]
+        icadata = _firstcomponent(
+            shiftedtcs, validlist, reductionblocksize, unitvariance=True
+        ).astype(rt_floattype)
         filteredavg = tide_math.corrnormalize(
             theprefilter.apply(optiondict["fmrifreq"], averagedata),
             prewindow=True,
@@ -435,10 +613,21 @@ def refineregressor(
         else:
             outputdata = -1.0 * icadata
     elif optiondict["refinetype"] == "pca":
+        from scipy.stats import pearsonr
+
         print("performing pca refinement")
-        thefit = PCA(n_components=pcacomponents).fit(refinevoxels)
-        print("Using first of ", len(thefit.components_), " components")
-        pcadata = thefit.components_[0]
+        if optiondict["estimatePCAdims"]:
+            # estimating the dimensionality needs the full decomposition, so this path still
+            # copies the whole voxel by time matrix into memory rather than using _firstcomponent
+            from sklearn.decomposition import PCA
+
+            thefit = PCA(n_components="mle").fit(shiftedtcs[validlist])
+            print("Using first of ", len(thefit.components_), " components")
+            pcadata = thefit.components_[0]
+        else:
+            pcadata = _firstcomponent(shiftedtcs, validlist, reductionblocksize).astype(
+                rt_floattype
+            )
         filteredavg = tide_math.corrnormalize(
             theprefilter.apply(optiondict["fmrifreq"], averagedata),
             prewindow=True,
@@ -24,61 +24,28 @@ import time
 
 import numpy as np
 import scipy as sp
-from scipy import fftpack, signal
-import pylab as pl
 import sys
 import bisect
 
 import rapidtide.util as tide_util
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
+import rapidtide.multiproc as tide_multiproc
+
+signal = tide_util.lazymodule("scipy.signal")
+sparse = tide_util.lazymodule("scipy.sparse")
+pl = tide_util.lazymodule("pylab")
 
 # ---------------------------------------- Global constants -------------------------------------------
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
-
-    return resdec
+pyfftwexists = tide_util.pyfftwexists
+fftpack = tide_util.fftpack
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- Resampling and time shifting functions -------------------------------------------
@@ -115,9 +82,230 @@ class congrid:
         outindices = ((newtimeaxis - self.hiresstart) // self.hiresstep).astype(int)
 """
 
-congridyvals = {}
-congridyvals["kernel"] = "kaiser"
-congridyvals["width"] = 3.0
+class congridkernel:
+    """
+    Precomputed convolution gridding kernel for a fixed target axis, kernel type and width.
+
+    The kernel is tabulated once for every sample offset from the nearest grid point, quantized to 1/resolution
+    of a bin, so gridding a sample is a table lookup.  The table is never modified after construction, so a
+    single instance can be shared between threads and (after forking) worker processes.
+
+    Parameters
+    ----------
+    xaxis: array-like
+        The target axis for resampling.  Must be evenly spaced.
+    width: float
+        The width of the gridding kernel in target bins
+    kernel: {'old', 'gauss', 'kaiser'}, optional
+        The type of convolution gridding kernel.  Default is 'kaiser'.
+    cyclic: bool, optional
+        When True (default), locations past either end of the x axis wrap around to the other end
+    resolution: int, optional
+        The number of kernel offsets tabulated per bin.  Default is 1000.
+    debug: bool, optional
+        When True, output additional information about the gridding process
+
+    Notes
+    -----
+    See  IEEE TRANSACTIONS ON MEDICAL IMAGING. VOL. IO.NO. 3, SEPTEMBER 1991
+
+    """
+
+    optsigma = np.array([0.4241, 0.4927, 0.4839, 0.5063, 0.5516, 0.5695, 0.5682, 0.5974])
+    optbeta = np.array([1.9980, 2.3934, 3.3800, 4.2054, 4.9107, 5.7567, 6.6291, 7.4302])
+
+    def __init__(self, xaxis, width, kernel="kaiser", cyclic=True, resolution=1000, debug=False):
+        self.xaxis = np.asarray(xaxis, dtype=np.float64)
+        self.xlen = len(self.xaxis)
+        self.xstart = self.xaxis[0]
+        self.xend = self.xaxis[-1]
+        self.xstep = self.xaxis[1] - self.xaxis[0]
+        self.width = width * 1.0
+        self.kernel = kernel
+        self.cyclic = cyclic
+        self.resolution = int(resolution)
+        self.halfres = self.resolution // 2
+        self.debug = debug
+
+        # choose the smoothing kernel based on the width
+        if kernel != "old":
+            if not (1.5 <= width <= 5.0) or (np.fmod(width, 0.5) > 0.0):
+                print("congrid: width is", width)
+                print(
+                    "congrid: width must be a half-integral value between 1.5 and 5.0 inclusive"
+                )
+                sys.exit()
+            kernelindex = int((width - 1.5) // 0.5)
+
+        # tabulate the kernel for every quantized offset from -0.5 to 0.5 bins
+        offsets = (np.arange(self.resolution + 1) - self.halfres) / self.resolution
+        if kernel == "old":
+            if debug:
+                print("gridding with old kernel")
+            widthinpts = int(np.round(width * 4.6 / self.xstep))
+            widthinpts -= widthinpts % 2 - 1
+            self.startoffsets = np.zeros(len(offsets), dtype=int) - widthinpts // 2
+            self.numpts = np.zeros(len(offsets), dtype=int) + widthinpts
+            xvals = (
+                np.linspace(
+                    -self.xstep * (widthinpts // 2),
+                    self.xstep * (widthinpts // 2),
+                    num=widthinpts,
+                    endpoint=True,
+                )[None, :]
+                + offsets[:, None]
+            )
+            self.table = tide_fit.gauss_eval(xvals, np.array([1.0, 0.0, width]))
+        else:
+            self.startoffsets = np.ceil(offsets - width / 2.0).astype(int)
+            self.numpts = np.floor(offsets + width / 2.0).astype(int) - self.startoffsets + 1
+            stencil = self.startoffsets[:, None] + np.arange(np.max(self.numpts))[None, :]
+            valid = np.arange(np.max(self.numpts))[None, :] < self.numpts[:, None]
+            xvals = np.where(valid, stencil + offsets[:, None], 0.0)
+            if kernel == "gauss":
+                self.table = tide_fit.gauss_eval(
+                    xvals, np.array([1.0, 0.0, self.optsigma[kernelindex]])
+                )
+            elif kernel == "kaiser":
+                self.table = tide_fit.kaiserbessel_eval(
+                    xvals, np.array([self.optbeta[kernelindex], width / 2.0])
+                )
+            else:
+                print("illegal kernel value in congrid - exiting")
+                sys.exit()
+            self.table = np.where(valid, self.table, 0.0)
+        self.table.setflags(write=False)
+
+    def locate(self, locs):
+        """
+        Find the closest grid point to each location and the quantized offset from it.
+
+        Parameters
+        ----------
+        locs: array-like
+            The locations, in x-axis units, of the samples to be gridded
+
+        Returns
+        -------
+        centers: array-like
+            The index of the grid point closest to each location
+        offsetindices: array-like
+            The row of the kernel table to use for each location
+
+        """
+        locs = np.atleast_1d(np.asarray(locs, dtype=np.float64))
+        if not self.cyclic:
+            outofrange = np.where(
+                (locs < self.xstart - self.xstep / 2.0) | (locs > self.xend + self.xstep / 2.0)
+            )[0]
+            if len(outofrange) > 0:
+                print("loc", locs[outofrange], "not in range", self.xstart, self.xend)
+        centers = np.round(
+            (np.clip(locs, self.xstart, self.xend) - self.xstart) / self.xstep, 0
+        ).astype(int)
+        quantoffsets = np.fmod(
+            np.rint((locs - self.xaxis[centers]) / self.xstep * self.resolution), self.resolution
+        ).astype(int)
+        if self.cyclic:
+            wrapdown = np.where((centers == self.xlen - 1) & (quantoffsets > self.halfres))[0]
+            centers[wrapdown] = 0
+            quantoffsets[wrapdown] -= self.resolution
+            wrapup = np.where((centers == 0) & (quantoffsets < -self.halfres))[0]
+            centers[wrapup] = self.xlen - 1
+            quantoffsets[wrapup] += self.resolution
+        badlocs = np.where(np.fabs(quantoffsets) > self.halfres)[0]
+        if len(badlocs) > 0:
+            print(
+                "(loc, xstep, center, offset):",
+                locs[badlocs[0]],
+                self.xstep,
+                centers[badlocs[0]],
+                quantoffsets[badlocs[0]] / self.resolution,
+            )
+            print("xaxis:", self.xaxis)
+            sys.exit()
+        return centers, quantoffsets + self.halfres
+
+    def grid(self, loc, val):
+        """
+        Perform a convolution gridding operation on a single sample.
+
+        Parameters
+        ----------
+        loc: float
+            The location, in x-axis units, of the sample to be gridded
+        val: float
+            The value to be gridded
+
+        Returns
+        -------
+        vals: array-like
+            The input value, convolved with the gridding kernel, projected on to x axis points
+        weights: array-like
+            The values of convolution kernel, projected on to x axis points (used for normalization)
+        indices: array-like
+            The indices along the x axis where the vals and weights fall.
+
+        """
+        # scalar version of locate, since this is called once per sample
+        if not self.cyclic and (
+            loc < self.xstart - self.xstep / 2.0 or loc > self.xend + self.xstep / 2.0
+        ):
+            print("loc", loc, "not in range", self.xstart, self.xend)
+        center = int(round((min(max(loc, self.xstart), self.xend) - self.xstart) / self.xstep))
+        quantoffset = int(round((loc - self.xaxis[center]) / self.xstep * self.resolution))
+        if abs(quantoffset) >= self.resolution:
+            quantoffset = int(np.fmod(quantoffset, self.resolution))
+        if self.cyclic:
+            if center == self.xlen - 1 and quantoffset > self.halfres:
+                center = 0
+                quantoffset -= self.resolution
+            if center == 0 and quantoffset < -self.halfres:
+                center = self.xlen - 1
+                quantoffset += self.resolution
+        if abs(quantoffset) > self.halfres:
+            print("(loc, xstep, center, offset):", loc, self.xstep, center, quantoffset / self.resolution)
+            print("xaxis:", self.xaxis)
+            sys.exit()
+        offsetindex = quantoffset + self.halfres
+        numpts = self.numpts[offsetindex]
+        startpt = center + self.startoffsets[offsetindex]
+        indices = np.remainder(np.arange(startpt, startpt + numpts), self.xlen)
+        yvals = self.table[offsetindex, :numpts]
+        if self.debug:
+            print("center, offset, indices, yvals", center, offsetindex, indices, yvals)
+        return val * yvals, yvals, indices
+
+    def gridmatrix(self, locs):
+        """
+        Build the gridding operator for a whole set of sample locations at once.  Row i of the returned matrix
+        holds the kernel weights that grid returns for a unit value at locs[i], so gridding many timecourses
+        sampled at the same locations reduces to a single sparse matrix product.
+
+        Parameters
+        ----------
+        locs: array-like
+            The locations, in x-axis units, of the samples to be gridded
+
+        Returns
+        -------
+        gridmatrix: scipy.sparse.csr_matrix
+            A (len(locs), len(xaxis)) matrix of gridding weights.  For data of shape (numlocs, numvoxels),
+            gridmatrix.T.dot(data) gives the gridded values and gridmatrix.sum(axis=0) the normalization weights.
+
+        """
+        centers, offsetindices = self.locate(locs)
+        stencil = np.arange(self.table.shape[1])[None, :]
+        indices = (centers + self.startoffsets[offsetindices])[:, None] + stencil
+        valid = stencil < self.numpts[offsetindices][:, None]
+        rows = np.broadcast_to(np.arange(len(centers))[:, None], indices.shape)
+        return sparse.csr_matrix(
+            (
+                self.table[offsetindices, :][valid],
+                (rows[valid], np.remainder(indices[valid], self.xlen)),
+            ),
+            shape=(len(centers), self.xlen),
+        )
 
 
 def congrid(xaxis, loc, val, width, kernel="kaiser", cyclic=True, debug=False):
@@ -150,117 +338,47 @@ def congrid(xaxis, loc, val, width, kernel="kaiser", cyclic=True, debug=False):
 
     Notes
     -----
+    This is the slow path - it builds a new congridkernel, tabulating the kernel, on every call.  Callers
+    gridding more than a few samples should construct a congridkernel once, hold on to it, and call its grid
+    or gridmatrix methods directly.
+
     See  IEEE TRANSACTIONS ON MEDICAL IMAGING. VOL. IO.NO. 3, SEPTEMBER 1991
 
     """
-    global congridyvals
-
-    if (congridyvals["kernel"] != kernel) or (congridyvals["width"] != width):
-        if congridyvals["kernel"] != kernel:
-            print(congridyvals["kernel"], "!=", kernel)
-        if congridyvals["width"] != width:
-            print(congridyvals["width"], "!=", width)
-        print("(re)initializing congridyvals")
-        congridyvals = {}
-        congridyvals["kernel"] = kernel
-        congridyvals["width"] = width * 1.0
-    optsigma = np.array(
-        [0.4241, 0.4927, 0.4839, 0.5063, 0.5516, 0.5695, 0.5682, 0.5974]
-    )
-    optbeta = np.array([1.9980, 2.3934, 3.3800, 4.2054, 4.9107, 5.7567, 6.6291, 7.4302])
-    xstep = xaxis[1] - xaxis[0]
-    if (loc < xaxis[0] - xstep / 2.0 or loc > xaxis[-1] + xstep / 2.0) and not cyclic:
-        print("loc", loc, "not in range", xaxis[0], xaxis[-1])
-
-    # choose the smoothing kernel based on the width
-    if kernel != "old":
-        if not (1.5 <= width <= 5.0) or (np.fmod(width, 0.5) > 0.0):
-            print("congrid: width is", width)
-            print(
-                "congrid: width must be a half-integral value between 1.5 and 5.0 inclusive"
-            )
-            sys.exit()
-        else:
-            kernelindex = int((width - 1.5) // 0.5)
+    return congridkernel(xaxis, width, kernel=kernel, cyclic=cyclic, debug=debug).grid(loc, val)
 
-    # find the closest grid point to the target location, calculate relative offsets from this point
-    center = tide_util.valtoindex(xaxis, loc)
-    offset = np.fmod(
-        np.round((loc - xaxis[center]) / xstep, 3), 1.0
-    )  # will vary from -0.5 to 0.5
-    if cyclic:
-        if center == len(xaxis) - 1 and offset > 0.5:
-            center = 0
-            offset -= 1.0
-        if center == 0 and offset < -0.5:
-            center = len(xaxis) - 1
-            offset += 1.0
-    if not (-0.5 <= offset <= 0.5):
-        print("(loc, xstep, center, offset):", loc, xstep, center, offset)
-        print("xaxis:", xaxis)
-        sys.exit()
-    offsetkey = str(offset)
 
-    if kernel == "old":
-        if debug:
-            print("gridding with old kernel")
-        widthinpts = int(np.round(width * 4.6 / xstep))
-        widthinpts -= widthinpts % 2 - 1
-        try:
-            yvals = congridyvals[offsetkey]
-        except KeyError:
-            if debug:
-                print("new key:", offsetkey)
-            xvals = (
-                np.linspace(
-                    -xstep * (widthinpts // 2),
-                    xstep * (widthinpts // 2),
-                    num=widthinpts,
-                    endpoint=True,
-                )
-                + offset
-            )
-            congridyvals[offsetkey] = tide_fit.gauss_eval(
-                xvals, np.array([1.0, 0.0, width])
-            )
-            yvals = congridyvals[offsetkey]
-        startpt = int(center - widthinpts // 2)
-        indices = list(range(startpt, startpt + widthinpts))
-        indices = np.remainder(indices, len(xaxis))
-        if debug:
-            print("center, offset, indices, yvals", center, offset, indices, yvals)
-        return val * yvals, yvals, indices
-    else:
-        offsetinpts = center + offset
-        startpt = int(np.ceil(offsetinpts - width / 2.0))
-        endpt = int(np.floor(offsetinpts + width / 2.0))
-        indices = np.remainder(list(range(startpt, endpt + 1)), len(xaxis))
-        try:
-            yvals = congridyvals[offsetkey]
-        except KeyError:
-            if debug:
-                print("new key:", offsetkey)
-            xvals = indices - center + offset
-            if kernel == "gauss":
-                sigma = optsigma[kernelindex]
-                congridyvals[offsetkey] = tide_fit.gauss_eval(
-                    xvals, np.array([1.0, 0.0, sigma])
-                )
-            elif kernel == "kaiser":
-                beta = optbeta[kernelindex]
-                congridyvals[offsetkey] = tide_fit.kaiserbessel_eval(
-                    xvals, np.array([beta, width / 2.0])
-                )
-            else:
-                print("illegal kernel value in congrid - exiting")
-                sys.exit()
-            yvals = congridyvals[offsetkey]
-            if debug:
-                print("xvals, yvals", xvals, yvals)
-        if debug:
-            print("center, offset, indices, yvals", center, offset, indices, yvals)
-        return val * yvals, yvals, indices
+def congridmatrix(xaxis, locs, width, kernel="kaiser", cyclic=True, debug=False):
+    """
+    Build the convolution gridding operator for a whole set of sample locations at once.
 
+    Parameters
+    ----------
+    xaxis: array-like
+        The target axis for resampling
+    locs: array-like
+        The locations, in x-axis units, of the samples to be gridded
+    width: float
+        The width of the gridding kernel in target bins
+    kernel: {'old', 'gauss', 'kaiser'}, optional
+        The type of convolution gridding kernel.  Default is 'kaiser'.
+    cyclic: bool, optional
+        When True (default), locations past either end of the x axis wrap around to the other end
+    debug: bool, optional
+        When True, output additional information about the gridding process
+
+    Returns
+    -------
+    gridmatrix: scipy.sparse.csr_matrix
+        A (len(locs), len(xaxis)) matrix of gridding weights - see congridkernel.gridmatrix
+
+    Notes
+    -----
+    This builds a new congridkernel on every call.  Callers that grid several sets of locations onto the
+    same axis should hold a congridkernel and call its gridmatrix method.
+
+    """
+    return congridkernel(xaxis, width, kernel=kernel, cyclic=cyclic, debug=debug).gridmatrix(locs)
 
 class fastresampler:
     def __init__(
@@ -416,6 +534,165 @@ def doresample(orig_x, orig_y, new_x, method="cubic", padlen=0):
         return None
 
 
+def resamplingmatrix(orig_x, new_x, method="cubic"):
+    """Returns the matrix that maps data sampled on orig_x onto new_x using doresample.
+
+    All of the interpolation methods in doresample are linear in the data, so the resampling
+    can be precomputed once and then applied to a block of timecourses with a single matrix
+    product (resampled = data @ thematrix.T).
+
+    Parameters
+    ----------
+    orig_x
+    new_x
+    method
+
+    Returns
+    -------
+    thematrix : 2D float array
+        Array of shape (len(new_x), len(orig_x))
+    """
+    numorig = len(orig_x)
+    thematrix = np.zeros((len(new_x), numorig), dtype=np.float64)
+    impulse = np.zeros(numorig, dtype=np.float64)
+    for i in range(numorig):
+        impulse[i] = 1.0
+        thematrix[:, i] = doresample(orig_x, impulse, new_x, method=method)
+        impulse[i] = 0.0
+    return thematrix
+
+
+def sparseresamplingmatrix(orig_x, new_x, method="cubic"):
+    r"""Build a sparse matrix that resamples timecourses sampled at orig_x onto new_x.
+
+    The spline interpolation kernels fall off exponentially, so dropping the negligible tails
+    leaves a banded matrix that is much faster to apply than the full one.  Build it once and
+    pass it to resampletimecourses when resampling a dataset a block at a time.
+
+    Parameters
+    ----------
+    orig_x : 1D float array
+        The (evenly spaced) input sample times
+    new_x : 1D float array
+        The output sample times
+    method : str, optional
+        Interpolation method (see doresample).  Default is "cubic".
+
+    Returns
+    -------
+    resampmatrix : scipy.sparse.csr_matrix
+        A (len(new_x), len(orig_x)) matrix - resampmatrix.dot(timecourse) gives the resampled timecourse
+    """
+    resampmatrix = resamplingmatrix(
+        np.asarray(orig_x, dtype=np.float64), np.asarray(new_x, dtype=np.float64), method=method
+    )
+    resampmatrix[np.fabs(resampmatrix) < 1e-14 * np.max(np.fabs(resampmatrix))] = 0.0
+    return sparse.csr_matrix(resampmatrix)
+
+
+def _resampletimecoursestage(voxels, arrays, params, showprogressbar=False):
+    inputdata = arrays["inputdata"]
+    outputdata = arrays["outputdata"]
+    blocksize = params["blocksize"]
+    # voxels is always a contiguous range here
+    for blockstart in range(0, len(voxels), blocksize):
+        blockend = np.min([blockstart + blocksize, len(voxels)])
+        startvox = voxels[blockstart]
+        endvox = voxels[blockend - 1] + 1
+        if showprogressbar:
+            tide_util.progressbar(blockend, len(voxels), label="Percent complete")
+        theblock = np.asarray(inputdata[startvox:endvox, :], dtype=np.float64)
+        if params["transferfunc"] is not None:
+            theblock = tide_filt.transferfuncfilt(theblock, params["transferfunc"])
+        outputdata[startvox:endvox, :] = np.transpose(
+            params["resampmatrix"].dot(np.transpose(theblock))
+        )
+    return len(voxels)
+
+
+def resampletimecourses(
+    inputdata,
+    orig_x,
+    new_x,
+    outputdata=None,
+    method="cubic",
+    transferfunc=None,
+    resampmatrix=None,
+    blocksize=1000,
+    nprocs=1,
+    pool=None,
+    showprogressbar=True,
+    chunksize=10000,
+):
+    r"""Resample every row of a 2D array of timecourses from orig_x onto new_x.
+
+    Gives the same result as filtering each timecourse with transferfuncfilt and then calling
+    doresample on it, but the filter is applied to a whole block of timecourses with one FFT,
+    and the interpolation is a single (sparse) matrix product per block.
+
+    Parameters
+    ----------
+    inputdata : 2D float array
+        The timecourses, one per row, sampled at orig_x
+    orig_x : 1D float array
+        The (evenly spaced) input sample times
+    new_x : 1D float array
+        The output sample times
+    outputdata : 2D float array, optional
+        Array of shape (numtimecourses, len(new_x)) to put the result in.  If None, a new
+        double precision array is allocated.
+    method : str, optional
+        Interpolation method (see doresample).  Default is "cubic".
+    transferfunc : 1D float array, optional
+        If not None, filter each timecourse with this transfer function before resampling
+        (e.g. an antialiasing filter from tide_filt.getlpfftfunc).  Default is None.
+    resampmatrix : scipy.sparse matrix, optional
+        The resampling matrix from sparseresamplingmatrix(orig_x, new_x, method).  Pass it when
+        resampling a dataset in several pieces, so it is only built once.  If None (the default),
+        it is built here.
+    blocksize : int, optional
+        Number of timecourses to process at once.  Default is 1000.
+    nprocs : int, optional
+        Number of worker processes.  Default is 1.
+    pool : workerpool, optional
+        A running pool to use.  Default is None.
+    showprogressbar : bool, optional
+        Show a progress bar.  Default is True.
+    chunksize : int, optional
+        Largest number of timecourses to hand to a worker at once.  Default is 10000.
+
+    Returns
+    -------
+    outputdata : 2D float array
+        The resampled timecourses
+    """
+    if outputdata is None:
+        outputdata = np.zeros((np.shape(inputdata)[0], len(new_x)), dtype=np.float64)
+
+    if resampmatrix is None:
+        resampmatrix = sparseresamplingmatrix(orig_x, new_x, method=method)
+
+    params = {
+        "resampmatrix": resampmatrix,
+        "transferfunc": transferfunc,
+        "blocksize": blocksize,
+    }
+
+    tide_multiproc.run_multiproc_stage(
+        _resampletimecoursestage,
+        {"inputdata": inputdata},
+        {"outputdata": outputdata},
+        params,
+        np.shape(inputdata),
+        None,
+        nprocs=nprocs,
+        pool=pool,
+        showprogressbar=showprogressbar,
+        chunksize=chunksize,
+    )
+    return outputdata
+
+
 def arbresample(
     inputdata,
     init_freq,
@@ -699,12 +976,16 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
         print("timesshift: thelen, padtrs, thepaddedlen=", thelen, padtrs, thepaddedlen)
     imag = 1.0j
 
+    # work in the precision of the input (single precision input stays single precision)
+    thedtype = np.result_type(np.asarray(inputtc).dtype, np.float32)
+    thecomplextype = np.result_type(thedtype, np.complex64)
+
     # initialize variables
     preshifted_y = np.zeros(
-        thepaddedlen, dtype="float"
+        thepaddedlen, dtype=thedtype
     )  # initialize the working buffer (with pad)
     weights = np.zeros(
-        thepaddedlen, dtype="float"
+        thepaddedlen, dtype=thedtype
     )  # initialize the weight buffer (with pad)
 
     # now do the math
@@ -712,9 +993,10 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
         :
     ]  # copy initial data into shift buffer
     weights[padtrs : padtrs + thelen] = 1.0  # put in the weight vector
-    revtc = inputtc[::-1]  # reflect data around ends to
-    preshifted_y[0:padtrs] = revtc[-padtrs:]  # eliminate discontinuities
-    preshifted_y[padtrs + thelen :] = revtc[0:padtrs]
+    if padtrs > 0:
+        revtc = inputtc[::-1]  # reflect data around ends to
+        preshifted_y[0:padtrs] = revtc[-padtrs:]  # eliminate discontinuities
+        preshifted_y[padtrs + thelen :] = revtc[0:padtrs]
 
     # finish initializations
     fftlen = np.shape(preshifted_y)[0]
@@ -724,7 +1006,7 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
     if len(initargvec) > fftlen:
         initargvec = initargvec[:fftlen]
     argvec = np.roll(initargvec * shifttrs, -int(fftlen // 2))
-    modvec = np.cos(argvec) - imag * np.sin(argvec)
+    modvec = (np.cos(argvec) - imag * np.sin(argvec)).astype(thecomplextype)
 
     # process the data (fft->modulate->ifft->filter)
     fftdata = fftpack.fft(preshifted_y)  # do the actual shifting
@@ -759,3 +1041,87 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
         shifted_y,
         shifted_weights,
     ]
+
+
+def _timeshiftweightfft(thelen, padtrs, userfft, thedtype=np.float64):
+    # the transform of the weight vector - the same for every row, so it is done once per block
+    weights = np.zeros(thelen + 2 * padtrs, dtype=thedtype)
+    weights[padtrs : padtrs + thelen] = 1.0
+    if userfft:
+        return tide_filt.realfft(weights)
+    else:
+        return fftpack.fft(weights)
+
+
+def timeshiftblock(inputtcs, shifttrs, padtrs, debug=False):
+    r"""Shift a block of timecourses by a different amount each, with the same result as timeshift.
+
+    Parameters
+    ----------
+    inputtcs : 2D numpy array
+        The timecourses to shift, one per row.  Single precision input is shifted (and
+        returned) in single precision.
+    shifttrs : 1D numpy array
+        The shift for each row, in TRs
+    padtrs : int
+        Number of points of reflected padding to add to each end before shifting
+    debug : bool, optional
+        Print additional information
+
+    Returns
+    -------
+    shiftedtcs : 2D numpy array
+        The shifted timecourses
+    shiftedweights : 2D numpy array
+        The shifted weight vector for each row
+    """
+    thelen = np.shape(inputtcs)[1]
+    thepaddedlen = thelen + 2 * padtrs
+    if debug:
+        print("timeshiftblock: thelen, padtrs, thepaddedlen=", thelen, padtrs, thepaddedlen)
+
+    thedtype = np.result_type(inputtcs.dtype, np.float32)
+    thecomplextype = np.result_type(thedtype, np.complex64)
+
+    # pad every row with reflected copies of its ends
+    preshifted_y = np.zeros((np.shape(inputtcs)[0], thepaddedlen), dtype=thedtype)
+    preshifted_y[:, padtrs : padtrs + thelen] = inputtcs
+    if padtrs > 0:
+        revtcs = inputtcs[:, ::-1]
+        preshifted_y[:, 0:padtrs] = revtcs[:, -padtrs:]
+        preshifted_y[:, padtrs + thelen :] = revtcs[:, 0:padtrs]
+
+    # build the same phase ramp as timeshift, one row per shift
+    initargvec = np.arange(0.0, 2.0 * np.pi, 2.0 * np.pi / float(thepaddedlen)) - np.pi
+    if len(initargvec) > thepaddedlen:
+        initargvec = initargvec[:thepaddedlen]
+    baseargvec = np.roll(initargvec, -int(thepaddedlen // 2))
+
+    if thepaddedlen % 2 == 0:
+        # for even lengths the ramp is conjugate symmetric (and the Nyquist term only keeps
+        # its real part either way), so real transforms give exactly the same answer
+        numfreqs = thepaddedlen // 2 + 1
+        argvecs = np.outer(shifttrs, baseargvec[:numfreqs])
+        modvecs = (np.cos(argvecs) - 1.0j * np.sin(argvecs)).astype(thecomplextype)
+        shifted_y = tide_filt.inverserealfft(
+            modvecs * tide_filt.realfft(preshifted_y, axis=1), n=thepaddedlen, axis=1
+        )
+        shifted_weights = tide_filt.inverserealfft(
+            modvecs * _timeshiftweightfft(thelen, padtrs, True, thedtype=thedtype)[None, :],
+            n=thepaddedlen,
+            axis=1,
+        )
+    else:
+        # the ramp timeshift uses for odd lengths is not conjugate symmetric, so stay complex
+        argvecs = np.outer(shifttrs, baseargvec)
+        modvecs = (np.cos(argvecs) - 1.0j * np.sin(argvecs)).astype(thecomplextype)
+        shifted_y = fftpack.ifft(modvecs * fftpack.fft(preshifted_y, axis=1), axis=1).real
+        shifted_weights = fftpack.ifft(
+            modvecs
+            * _timeshiftweightfft(thelen, padtrs, False, thedtype=thedtype)[None, :],
+            axis=1,
+        ).real
+    return (
+        shifted_y[:, padtrs : padtrs + thelen],
+        shifted_weights[:, padtrs : padtrs + thelen],
+    )
@@ -22,12 +22,13 @@
 
 import numpy as np
 import scipy as sp
-import pylab as pl
-
-from scipy.stats import johnsonsb
 
 import rapidtide.io as tide_io
 import rapidtide.fit as tide_fit
+import rapidtide.util as tide_util
+
+pl = tide_util.lazymodule("pylab")
+ndimage = tide_util.lazymodule("scipy.ndimage")
 
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
@@ -35,64 +36,13 @@ MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-
-donotusenumba = False
-
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
-
-    return resdec
+memprofilerexists = tide_util.memprofilerexists
+nibabelexists = tide_util.nibabelexists
+pyfftwexists = tide_util.pyfftwexists
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_util.disablenumba()
 
 
 # --------------------------- probability functions -------------------------------------------------
@@ -129,6 +79,8 @@ def fitjsbpdf(thehist, histlen, thedata, displayplots=False, nozero=False):
     -------
 
     """
+    from scipy.stats import johnsonsb
+
     thestore = np.zeros((2, histlen), dtype="float64")
     thestore[0, :] = thehist[1][:-1]
     thestore[1, :] = thehist[0][:] / (1.0 * len(thedata))
@@ -180,6 +132,8 @@ def getjohnsonppf(percentile, params, zeroterm):
     -------
 
     """
+    from scipy.stats import johnsonsb
+
     johnsonfunc = johnsonsb(params[0], params[1], params[2], params[3])
     corrfac = 1.0 - zeroterm
 
@@ -473,6 +427,109 @@ def symmetrize(a, antisymmetric=False, zerodiagonal=False):
         return intermediate
 
 
+def _rollingsums(thearray, windowpts):
+    # the sum of thearray over a window of windowpts points centered on each point, with the window
+    # truncated at the ends of the array
+    numpoints = len(thearray)
+    thecumsum = np.concatenate(([0.0], np.cumsum(thearray)))
+    thepoints = np.arange(numpoints)
+    startpts = np.clip(thepoints - windowpts // 2, 0, numpoints)
+    endpts = np.clip(thepoints + windowpts // 2 + 1, 0, numpoints)
+    return thecumsum[endpts] - thecumsum[startpts]
+
+
+def _rollingmoments(waveform, windowpts):
+    # the second, third, and fourth central moments of waveform over a centered sliding window,
+    # computed from running sums of powers in O(N) time.  Skewness and kurtosis are scale and shift
+    # invariant, so the data is standardized first to keep the running sums well conditioned.  Points
+    # that are not finite are left out.
+    waveform = np.asarray(waveform, dtype=np.float64)
+    valid = np.isfinite(waveform)
+    thedata = np.where(valid, waveform, 0.0)
+    if np.any(valid):
+        thedata[valid] -= np.mean(thedata[valid])
+        thestd = np.std(thedata[valid])
+        if thestd > 0.0:
+            thedata /= thestd
+    numvalid = _rollingsums(valid.astype(np.float64), windowpts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        s1 = _rollingsums(thedata, windowpts) / numvalid
+        s2 = _rollingsums(thedata ** 2, windowpts) / numvalid
+        s3 = _rollingsums(thedata ** 3, windowpts) / numvalid
+        s4 = _rollingsums(thedata ** 4, windowpts) / numvalid
+    m2 = s2 - s1 ** 2
+    m3 = s3 - 3.0 * s1 * s2 + 2.0 * s1 ** 3
+    m4 = s4 - 4.0 * s1 * s3 + 6.0 * s1 ** 2 * s2 - 3.0 * s1 ** 4
+
+    # a window is constant (or empty) if its largest and smallest valid values are the same - this is
+    # checked directly, since the running sums will not give exactly zero variance
+    themax = ndimage.maximum_filter1d(
+        np.where(valid, waveform, -np.inf), size=windowpts, mode="nearest"
+    )
+    themin = ndimage.minimum_filter1d(
+        np.where(valid, waveform, np.inf), size=windowpts, mode="nearest"
+    )
+    m2[np.where(themax <= themin)] = np.nan
+    return m2, m3, m4
+
+
+def rollingskew(waveform, windowpts):
+    r"""Calculate the skewness of a waveform over a window centered on every point.
+
+    Gives the same result as calling scipy.stats.skew (biased, with nan_policy="omit") on
+    the slice of waveform around each point, but takes O(N) time regardless of window size.
+
+    Parameters
+    ----------
+    waveform : 1D float array
+        The data
+    windowpts : int
+        The width of the window in points.  This should be odd - the window extends
+        windowpts // 2 points on either side of the center point, and is truncated at the
+        ends of the waveform.
+
+    Returns
+    -------
+    skewness : 1D float array
+        The skewness in the window around each point.  NaN where the window is constant.
+    """
+    m2, m3, m4 = _rollingmoments(waveform, windowpts)
+    with np.errstate(invalid="ignore"):
+        return m3 / m2 ** 1.5
+
+
+def rollingkurtosis(waveform, windowpts, fisher=True):
+    r"""Calculate the kurtosis of a waveform over a window centered on every point.
+
+    Gives the same result as calling scipy.stats.kurtosis (biased) on the slice of waveform
+    around each point, but takes O(N) time regardless of window size.
+
+    Parameters
+    ----------
+    waveform : 1D float array
+        The data
+    windowpts : int
+        The width of the window in points.  This should be odd - the window extends
+        windowpts // 2 points on either side of the center point, and is truncated at the
+        ends of the waveform.
+    fisher : bool, optional
+        If True, return the excess kurtosis (normal data gives 0.0), otherwise Pearson's
+        definition (normal data gives 3.0).  Default is True.
+
+    Returns
+    -------
+    kurtosis : 1D float array
+        The kurtosis in the window around each point.  NaN where the window is constant.
+    """
+    m2, m3, m4 = _rollingmoments(waveform, windowpts)
+    with np.errstate(invalid="ignore"):
+        thekurtosis = m4 / m2 ** 2
+    if fisher:
+        return thekurtosis - 3.0
+    else:
+        return thekurtosis
+
+
 # Find the image intensity value which thefrac of the non-zero voxels in the image exceed
 def getfracval(datamat, thefrac, numbins=200):
     """
@@ -498,6 +555,45 @@ def getfracval(datamat, thefrac, numbins=200):
     return 0.0
 
 
+def getfracvalchunked(chunkfunc, thefrac, numbins=200):
+    """Same as getfracval, but for data that is too big to hold in memory at once.
+
+    Parameters
+    ----------
+    chunkfunc: function
+        A function that returns a new iterator over the pieces of the data each time it is called.
+        It is called twice.
+    thefrac: float
+        The fraction of the data that should be below the returned value
+    numbins: int
+        The number of histogram bins
+
+    Returns
+    -------
+    fracval: float
+        The value getfracval would return if given all of the data at once
+    """
+    themax = None
+    themin = None
+    for thechunk in chunkfunc():
+        if themax is None:
+            themax = thechunk.max()
+            themin = thechunk.min()
+        else:
+            themax = np.max([themax, thechunk.max()])
+            themin = np.min([themin, thechunk.min()])
+    meanhist = np.zeros(numbins, dtype=np.int64)
+    for thechunk in chunkfunc():
+        (chunkhist, bins) = np.histogram(thechunk, bins=numbins, range=(themin, themax))
+        meanhist += chunkhist
+    cummeanhist = np.cumsum(meanhist)
+    target = cummeanhist[numbins - 1] * thefrac
+    for i in range(0, numbins):
+        if cummeanhist[i] >= target:
+            return bins[i]
+    return 0.0
+
+
 def makepmask(rvals, pval, sighistfit, onesided=True):
     """
 
@@ -576,6 +672,8 @@ def getfracvalsfromfit_old(histfit, thefracs, numbins=2000, displayplots=False):
     -------
 
     """
+    from scipy.stats import johnsonsb
+
     themax = 1.0
     themin = 0.0
     bins = np.arange(themin, themax, (themax - themin) / numbins)
@@ -621,6 +719,8 @@ def getfracvalsfromfit(histfit, thefracs, numbins=2000, displayplots=True):
     -------
 
     """
+    from scipy.stats import johnsonsb
+
     # print('entering getfracvalsfromfit: histfit=',histfit, ' thefracs=', thefracs)
     thedist = johnsonsb(histfit[0], histfit[1], histfit[2], histfit[3])
     # print('froze the distribution')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import rapidtide.benchmark as tide_bench
+import rapidtide.io as tide_io
+
+
+def test_makesyntheticdata(debug=False):
+    fmridata, regressor_x, regressor_y, truelags = tide_bench.makesyntheticdata(
+        50, 100, tr=2.0, lagmin=-3.0, lagmax=4.0, seed=1
+    )
+    assert fmridata.shape == (50, 100)
+    assert np.min(truelags) >= -3.0
+    assert np.max(truelags) <= 4.0
+    assert regressor_x[0] < -4.0
+    assert regressor_x[-1] > 200.0 + 4.0
+    if debug:
+        print(np.mean(fmridata), np.std(fmridata))
+    np.testing.assert_allclose(np.mean(fmridata), 1000.0, rtol=1e-3)
+
+    # the same seed gives the same data
+    fmridata2, dummy, dummy, truelags2 = tide_bench.makesyntheticdata(
+        50, 100, tr=2.0, lagmin=-3.0, lagmax=4.0, seed=1
+    )
+    np.testing.assert_array_equal(fmridata, fmridata2)
+    np.testing.assert_array_equal(truelags, truelags2)
+
+
+def test_benchmark(debug=False):
+    results = tide_bench.runbenchmarks(
+        voxelcounts=(100,), timepointcounts=(150,), nproclist=(1, 2), repeats=2, verbose=debug
+    )
+    records = results["results"]
+    assert len(records) == 2 * len(tide_bench.STAGES)
+    for therecord in records:
+        if debug:
+            print(therecord)
+        assert therecord["stage"] in tide_bench.STAGES
+        assert len(therecord["times"]) == 2
+        assert therecord["best"] == min(therecord["times"])
+        if therecord["stage"] == "nulldistribution":
+            assert therecord["items"] == tide_bench.defaultoptions()["numestreps"]
+        else:
+            assert therecord["items"] == 100
+        if therecord["stage"] == "fitcorr":
+            # the known delays should be recovered
+            assert therecord["lagerror"] < 0.2
+
+    # only the requested stages are timed
+    records = tide_bench.benchmarkcase(100, 150, stages=["glmpass"])
+    assert [therecord["stage"] for therecord in records] == ["glmpass"]
+
+    # the results survive a round trip through json, and can be compared
+    tempdir = tempfile.mkdtemp()
+    try:
+        thefile = os.path.join(tempdir, "bench.json")
+        tide_bench.writebenchmarks(results, thefile)
+        readback = tide_io.readdictfromjson(thefile)
+        comparison = tide_bench.comparebenchmarks(readback, results)
+        assert len(comparison) == len(results["results"])
+        for thecomparison in comparison:
+            assert thecomparison[-1] == 1.0
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main():
+    test_makesyntheticdata(debug=True)
+    test_benchmark(debug=True)
+
+
+if __name__ == "__main__":
+    main()
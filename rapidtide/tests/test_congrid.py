@@ -4,7 +4,7 @@
 import numpy as np
 import scipy as sp
 
-from rapidtide.resample import congrid
+from rapidtide.resample import congrid, congridmatrix, congridkernel
 from rapidtide.filter import dolpfiltfilt
 
 # from rapidtide.tests.utils import
@@ -98,8 +98,85 @@ def test_congrid(debug=False):
         plt.show()
 
 
+def test_congridmatrix(debug=False):
+    np.random.seed(2468)
+    gridlen = 32
+    gridaxis = sp.linspace(-np.pi, np.pi, num=gridlen, endpoint=False)
+    gridstep = gridaxis[1] - gridaxis[0]
+    for gridkernel, congridbins in [("kaiser", 3.0), ("gauss", 1.5), ("kaiser", 5.0)]:
+        # away from the ends, each row matches what congrid returns for a unit value
+        locs = np.random.uniform(gridaxis[4], gridaxis[-5], size=200)
+        gridmatrix = congridmatrix(gridaxis, locs, congridbins, kernel=gridkernel).toarray()
+        assert gridmatrix.shape == (len(locs), gridlen)
+        for i in range(len(locs)):
+            thevals, theweights, theindices = congrid(
+                gridaxis, locs[i], 1.0, congridbins, kernel=gridkernel
+            )
+            therow = np.zeros((gridlen), dtype=float)
+            for j in range(len(theindices)):
+                therow[theindices[j]] += theweights[j]
+            if debug:
+                print(gridkernel, congridbins, locs[i], np.max(np.fabs(therow - gridmatrix[i, :])))
+            np.testing.assert_allclose(gridmatrix[i, :], therow, atol=1e-12)
+
+        # near the ends, the kernel wraps around without losing any weight
+        interiorsums = np.sum(gridmatrix, axis=1)
+        edgelocs = np.pi - gridstep * (locs - locs.min()) / (locs.max() - locs.min())
+        edgematrix = congridmatrix(gridaxis, edgelocs, congridbins, kernel=gridkernel).toarray()
+        assert np.min(np.sum(edgematrix, axis=1)) > 0.9 * np.min(interiorsums)
+
+        # gridding many timecourses at once is a single matrix product
+        data = np.random.normal(size=(len(locs), 10))
+        gridded = congridmatrix(gridaxis, locs, congridbins, kernel=gridkernel).T.dot(data)
+        np.testing.assert_allclose(gridded, np.dot(gridmatrix.T, data), atol=1e-10)
+
+
+def test_congridkernel(debug=False):
+    np.random.seed(1357)
+    gridlen = 32
+    gridaxis = sp.linspace(-np.pi, np.pi, num=gridlen, endpoint=False)
+    gridstep = gridaxis[1] - gridaxis[0]
+    thekernel = congridkernel(gridaxis, 3.0, kernel="kaiser")
+
+    # the table is shared, so it must not be writable
+    assert not thekernel.table.flags.writeable
+
+    # offsets are quantized to the table resolution
+    center = 10
+    for offset in [-0.4567, -0.2504, 0.0, 0.1234, 0.4999]:
+        thevals, theweights, theindices = thekernel.grid(gridaxis[center] + offset * gridstep, 2.0)
+        quantoffset = np.round(offset, 3)
+        startpt = int(np.ceil(center + quantoffset - 1.5))
+        endpt = int(np.floor(center + quantoffset + 1.5))
+        if debug:
+            print(offset, theindices, theweights)
+        np.testing.assert_array_equal(theindices, np.arange(startpt, endpt + 1))
+        np.testing.assert_allclose(thevals, 2.0 * theweights)
+        xvals = np.arange(startpt, endpt + 1) - center + quantoffset
+        np.testing.assert_allclose(
+            theweights,
+            np.where(
+                np.fabs(xvals) <= 1.5,
+                sp.special.i0(4.2054 * np.sqrt(np.fabs(1.0 - np.square(xvals / 1.5)))) / 1.5,
+                0.0,
+            ),
+            atol=1e-12,
+        )
+
+    # single samples and the matrix form agree everywhere, including across the wrap
+    locs = np.random.uniform(-np.pi, np.pi, size=500)
+    gridmatrix = thekernel.gridmatrix(locs).toarray()
+    for i in range(len(locs)):
+        thevals, theweights, theindices = thekernel.grid(locs[i], 1.0)
+        therow = np.zeros((gridlen), dtype=float)
+        np.add.at(therow, theindices, theweights)
+        np.testing.assert_allclose(gridmatrix[i, :], therow, atol=1e-12)
+
+
 def main():
     test_congrid(debug=True)
+    test_congridmatrix(debug=True)
+    test_congridkernel(debug=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.correlate as tide_corr
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.miscmath as tide_math
+
+
+def refcorrnormalize(thedata, prewindow, detrendorder, windowfunc):
+    # one timecourse at a time, with each step done separately
+    if detrendorder > 0:
+        intervec = tide_math.stdnormalize(
+            tide_fit.detrend(thedata, order=detrendorder, demean=True)
+        )
+    else:
+        intervec = tide_math.stdnormalize(thedata)
+    if prewindow:
+        intervec = tide_filt.windowfunction(len(thedata), type=windowfunc) * intervec
+    return tide_math.stdnormalize(intervec) / np.sqrt(len(thedata))
+
+
+def test_corrnormalize(debug=False):
+    rng = np.random.RandomState(12345)
+    numpoints = 300
+    theblock = rng.normal(size=(50, numpoints)) + np.linspace(0.0, 5.0, numpoints)
+    theblock[7, :] = 0.0
+
+    for windowfunc in ["hamming", "hann", "blackmanharris"]:
+        for prewindow in [True, False]:
+            for detrendorder in [0, 1, 3]:
+                thereference = np.zeros_like(theblock)
+                for i in range(theblock.shape[0]):
+                    thereference[i, :] = refcorrnormalize(
+                        theblock[i, :], prewindow, detrendorder, windowfunc
+                    )
+                theplan = tide_math.getcorrnormalizer(
+                    numpoints,
+                    prewindow=prewindow,
+                    detrendorder=detrendorder,
+                    windowfunc=windowfunc,
+                )
+                assert theplan is tide_math.getcorrnormalizer(
+                    numpoints,
+                    prewindow=prewindow,
+                    detrendorder=detrendorder,
+                    windowfunc=windowfunc,
+                )
+
+                # a single timecourse, through the plan and through corrnormalize
+                np.testing.assert_allclose(
+                    theplan.apply(theblock[3, :]), thereference[3, :], atol=1e-12
+                )
+                np.testing.assert_allclose(
+                    tide_math.corrnormalize(
+                        theblock[3, :],
+                        prewindow=prewindow,
+                        detrendorder=detrendorder,
+                        windowfunc=windowfunc,
+                    ),
+                    thereference[3, :],
+                    atol=1e-12,
+                )
+
+                # a whole block, in place
+                inplaceblock = theblock.copy()
+                theresult = theplan.apply(inplaceblock, inplace=True)
+                assert theresult is inplaceblock
+                np.testing.assert_allclose(inplaceblock, thereference, atol=1e-12)
+
+                # single precision stays single precision
+                singleblock = theblock.astype(np.float32)
+                tide_math.getcorrnormalizer(
+                    numpoints,
+                    prewindow=prewindow,
+                    detrendorder=detrendorder,
+                    windowfunc=windowfunc,
+                    dtype=np.float32,
+                ).apply(singleblock, inplace=True)
+                assert singleblock.dtype == np.float32
+                if debug:
+                    print(
+                        windowfunc,
+                        prewindow,
+                        detrendorder,
+                        np.max(np.fabs(singleblock - thereference)),
+                    )
+                np.testing.assert_allclose(singleblock, thereference, atol=1e-5)
+
+    # the sliding window correlation matches normalizing each window separately
+    data1 = theblock[0, :]
+    data2 = 0.5 * theblock[0, :] + theblock[1, :]
+    times, corrpertime, ppertime = tide_corr.shorttermcorr_1D(
+        data1, data2, 1.0, 40.0, samplestep=5, prewindow=True, detrendorder=1
+    )
+    for segnum, i in enumerate(range(20, numpoints - 20, 5)):
+        seg1 = refcorrnormalize(data1[i - 20 : i + 20], True, 1, "hamming")
+        seg2 = refcorrnormalize(data2[i - 20 : i + 20], True, 1, "hamming")
+        assert times[segnum] == i
+        np.testing.assert_allclose(
+            corrpertime[segnum], np.corrcoef(seg1, seg2)[0, 1], atol=1e-12
+        )
+
+
+def main():
+    test_corrnormalize(debug=True)
+
+
+if __name__ == "__main__":
+    main()
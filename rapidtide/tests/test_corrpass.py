@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.corrpass as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.miscmath as tide_math
+import rapidtide.resample as tide_resample
+
+
+def test_corrpass(debug=False):
+    np.random.seed(12345)
+    tr = 1.0
+    numpoints = 200
+    numvoxels = 57
+    oversampfactor = 2
+    fmri_x = np.arange(0.0, numpoints) * tr
+    os_fmri_x = np.arange(0.0, numpoints * oversampfactor) * tr / oversampfactor
+    oversampfreq = oversampfactor / tr
+
+    # make a smooth random regressor and a set of noisy, shifted copies of it
+    theprefilter = tide_filt.noncausalfilter(filtertype="lfo")
+    regressor = theprefilter.apply(1.0 / tr, np.random.normal(size=numpoints))
+    fmridata = np.zeros((numvoxels, numpoints), dtype=np.float64)
+    for vox in range(numvoxels):
+        fmridata[vox, :] = (
+            100.0
+            + np.roll(regressor, vox % 7 - 3)
+            + 0.5 * np.random.normal(size=numpoints)
+        )
+
+    os_regressor = tide_resample.doresample(fmri_x, regressor, os_fmri_x)
+    referencetc = tide_math.corrnormalize(
+        theprefilter.apply(oversampfreq, os_regressor),
+        prewindow=True,
+        detrendorder=1,
+        windowfunc="hamming",
+    )
+
+    corrorigin = numpoints * oversampfactor - 1
+    lagmininpts = 20
+    lagmaxinpts = 20
+    optiondict = {
+        "oversampfactor": oversampfactor,
+        "interptype": "univariate",
+        "usewindowfunc": True,
+        "detrendorder": 1,
+        "windowfunc": "hamming",
+        "corrweighting": "none",
+        "nprocs": 1,
+        "mp_chunksize": 50000,
+        "showprogressbar": False,
+    }
+
+    results = {}
+    for blocksize, nprocs in [(0, 1), (10, 1), (1000, 1), (0, 2), (10, 2)]:
+        optiondict["corrblocksize"] = blocksize
+        optiondict["nprocs"] = nprocs
+        corrout = np.zeros((numvoxels, lagmininpts + lagmaxinpts), dtype=np.float64)
+        meanval = np.zeros(numvoxels, dtype=np.float64)
+        volumetotal, theglobalmaxlist = tide_corrpass.correlationpass(
+            fmridata,
+            None,
+            referencetc,
+            fmri_x,
+            os_fmri_x,
+            tr,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            corrout,
+            meanval,
+            theprefilter,
+            optiondict,
+        )
+        assert volumetotal == numvoxels
+        results[(blocksize, nprocs)] = (corrout, meanval, theglobalmaxlist)
+
+    reference = results[(0, 1)]
+    for thekey in [(10, 1), (1000, 1), (0, 2), (10, 2)]:
+        if debug:
+            print(thekey, np.max(np.fabs(results[thekey][0] - reference[0])))
+        np.testing.assert_allclose(results[thekey][0], reference[0], atol=1e-6)
+        np.testing.assert_allclose(results[thekey][1], reference[1], atol=1e-6)
+        assert list(results[thekey][2]) == list(reference[2])
+
+
+def main():
+    test_corrpass(debug=True)
+
+
+if __name__ == "__main__":
+    main()
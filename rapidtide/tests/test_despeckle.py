@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import copy
+
+import numpy as np
+
+import rapidtide.benchmark as tide_bench
+import rapidtide.corrfit as tide_corrfit
+
+
+def refit(s, optiondict, initiallags):
+    return tide_corrfit.fitcorrx(
+        s["genlagtc"],
+        s["initial_fmri_x"],
+        s["lagtc"],
+        1,
+        s["corrscale"][s["corrorigin"] - s["lagmininpts"] : s["corrorigin"] + s["lagmaxinpts"]],
+        s["lagmask"],
+        s["failimage"],
+        s["lagtimes"],
+        s["lagstrengths"],
+        s["lagsigma"],
+        s["corrout"],
+        s["meanval"],
+        s["gaussout"],
+        s["windowout"],
+        s["R2"],
+        optiondict,
+        initiallags=initiallags,
+    )
+
+
+def test_despeckle(debug=False):
+    numvoxels = 500
+    fmridata, regressor_x, regressor_y, truelags = tide_bench.makesyntheticdata(
+        numvoxels, 200, seed=12345
+    )
+    optiondict = tide_bench.defaultoptions()
+    s = tide_bench._setup(fmridata, regressor_x, regressor_y, 1.0, optiondict)
+    tide_bench._runcorrelationpass(s)
+    tide_bench._runfitcorr(s)
+
+    # refit a few voxels starting from a perturbed lag
+    rng = np.random.RandomState(31415)
+    flagged = np.sort(rng.choice(numvoxels, 20, replace=False))
+    initiallags = np.full(numvoxels, -1000000.0)
+    initiallags[flagged] = s["lagtimes"][flagged] + rng.uniform(-2.0, 2.0, len(flagged))
+
+    # the answer for the flagged voxels, fit directly
+    thetimes, thestrengths = tide_corrfit._procVoxelBlockFitcorrx(
+        s["corrout"][flagged, :],
+        s["corrscale"][s["corrorigin"] - s["lagmininpts"] : s["corrorigin"] + s["lagmaxinpts"]],
+        s["genlagtc"],
+        s["initial_fmri_x"],
+        optiondict,
+        initiallags=initiallags[flagged],
+    )[2:4]
+
+    before = copy.deepcopy(s)
+    unflagged = np.setdiff1d(np.arange(numvoxels), flagged)
+    for nprocs in [1, 2]:
+        for blocksize in [1000, 0]:
+            s = copy.deepcopy(before)
+            theoptions = copy.deepcopy(optiondict)
+            theoptions["nprocs"] = nprocs
+            theoptions["fitblocksize"] = blocksize
+            theoptions["mp_chunksize"] = 5
+            refit(s, theoptions, initiallags)
+            if debug:
+                print(nprocs, blocksize, np.max(np.fabs(s["lagtimes"][flagged] - thetimes)))
+
+            # only the flagged voxels change, and they get the same answer in every configuration
+            for themap in ["lagtimes", "lagstrengths", "lagsigma", "R2", "lagmask", "lagtc"]:
+                np.testing.assert_array_equal(s[themap][unflagged], before[themap][unflagged])
+            np.testing.assert_allclose(s["lagtimes"][flagged], thetimes, atol=1e-6)
+            np.testing.assert_allclose(s["lagstrengths"][flagged], thestrengths, atol=1e-6)
+
+
+def main():
+    test_despeckle(debug=True)
+
+
+if __name__ == "__main__":
+    main()
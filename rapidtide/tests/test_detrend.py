@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.fit as tide_fit
+
+
+def polyfitdetrend(inputdata, order=1, demean=False):
+    # the original, one timecourse at a time version
+    thetimepoints = np.arange(0.0, len(inputdata), 1.0) - len(inputdata) / 2.0
+    thecoffs = np.polyfit(thetimepoints, inputdata, order)
+    return inputdata - tide_fit.trendgen(thetimepoints, thecoffs, demean)
+
+
+def test_detrend(debug=False):
+    np.random.seed(12345)
+    for numpoints in [10, 301, 5000]:
+        thetimecourses = 1000.0 + np.random.normal(size=(5, numpoints))
+        thetimecourses += np.outer(np.random.normal(size=5), np.arange(numpoints) / numpoints)
+        for order in [0, 1, 2, 3]:
+            for demean in [False, True]:
+                blockresult = tide_fit.detrend(thetimecourses, order=order, demean=demean)
+                for i in range(5):
+                    thereference = polyfitdetrend(thetimecourses[i, :], order=order, demean=demean)
+                    if debug:
+                        print(
+                            numpoints,
+                            order,
+                            demean,
+                            np.max(np.fabs(blockresult[i, :] - thereference)),
+                        )
+                    np.testing.assert_allclose(
+                        tide_fit.detrend(thetimecourses[i, :], order=order, demean=demean),
+                        thereference,
+                        atol=1e-8,
+                    )
+                    np.testing.assert_allclose(blockresult[i, :], thereference, atol=1e-8)
+
+
+def main():
+    test_detrend(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.miscmath as tide_math
+
+
+def refentropies(waveform, m, r):
+    # direct implementation of the definitions, comparing every pair of templates
+    numpoints = len(waveform)
+
+    def _matches(thelength, numtemplates):
+        templates = np.array([waveform[i : i + thelength] for i in range(numtemplates)])
+        return np.sum(
+            np.max(np.fabs(templates[:, None, :] - templates[None, :, :]), axis=2) <= r, axis=1
+        )
+
+    phi_m = np.mean(np.log(_matches(m, numpoints - m + 1) / (numpoints - m + 1.0)))
+    phi_m1 = np.mean(np.log(_matches(m + 1, numpoints - m) / (numpoints - m + 0.0)))
+    B = np.sum(_matches(m, numpoints - m) - 1)
+    A = np.sum(_matches(m + 1, numpoints - m) - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return phi_m - phi_m1, -np.log(A / B)
+
+
+def test_entropy(debug=False):
+    rng = np.random.RandomState(12345)
+    waveform = np.sin(np.arange(400) / 3.0) + 0.5 * rng.normal(size=400)
+
+    for m in [1, 2, 3]:
+        r = 0.2 * np.std(waveform)
+        refapen, refsampen = refentropies(waveform, m, r)
+        # the pairwise comparison, and the KD tree that is used for long waveforms
+        for blocksize in [1000000, 1000]:
+            apen = tide_math.approximateentropy(waveform, m=m, blocksize=blocksize)
+            sampen = tide_math.sampleentropy(waveform, m=m, r=r, blocksize=blocksize)
+            if debug:
+                print(m, blocksize, apen, refapen, sampen, refsampen)
+            np.testing.assert_allclose(apen, refapen, rtol=1e-12)
+            np.testing.assert_allclose(sampen, refsampen, rtol=1e-12)
+
+    # windowed mode gives the entropy of the (truncated) window around each point - with all the
+    # windows in one block, several blocks, and windows too big for a block, which use the KD tree
+    windowpts = 25
+    for blocksize in [1000000, 2000, 500]:
+        apen = tide_math.approximateentropy(waveform, windowpts=windowpts, blocksize=blocksize)
+        sampen = tide_math.sampleentropy(waveform, windowpts=windowpts, blocksize=blocksize)
+        for i in range(len(waveform)):
+            thewindow = waveform[np.max([0, i - 12]) : np.min([i + 13, len(waveform)])]
+            refapen, refsampen = refentropies(thewindow, 2, 0.2 * np.std(thewindow))
+            np.testing.assert_allclose(apen[i], refapen, rtol=1e-12)
+            np.testing.assert_allclose(sampen[i], refsampen, rtol=1e-12)
+
+    # with a fixed tolerance, the matches are shared between windows - check several template
+    # lengths, an even window, and blocks smaller than one window
+    r = 0.2 * np.std(waveform)
+    for m in [1, 2, 3]:
+        for windowpts, blocksize in [(25, 1000000), (24, 1000000), (25, 30)]:
+            apen = tide_math.approximateentropy(
+                waveform, m=m, r=r, windowpts=windowpts, blocksize=blocksize
+            )
+            sampen = tide_math.sampleentropy(
+                waveform, m=m, r=r, windowpts=windowpts, blocksize=blocksize
+            )
+            halfwindow = windowpts // 2
+            for i in range(len(waveform)):
+                thewindow = waveform[
+                    np.max([0, i - halfwindow]) : np.min([i + halfwindow + 1, len(waveform)])
+                ]
+                refapen, refsampen = refentropies(thewindow, m, r)
+                if debug and (i % 100 == 0):
+                    print(m, windowpts, blocksize, i, apen[i], refapen, sampen[i], refsampen)
+                np.testing.assert_allclose(apen[i], refapen, rtol=1e-10)
+                np.testing.assert_allclose(sampen[i], refsampen, rtol=1e-10)
+
+    # a tolerance for each window is only allowed for short windows
+    try:
+        tide_math.approximateentropy(waveform, windowpts=tide_math.MAXENTROPYWINDOWPTS + 2)
+    except ValueError:
+        pass
+    else:
+        assert False, "windowpts was not limited"
+
+
+def main():
+    test_entropy(debug=True)
+
+
+if __name__ == "__main__":
+    main()
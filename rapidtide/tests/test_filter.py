@@ -6,7 +6,7 @@ import scipy as sp
 import matplotlib.pyplot as plt
 
 from rapidtide.util import valtoindex
-from rapidtide.filter import noncausalfilter
+from rapidtide.filter import noncausalfilter, arb_pass
 
 
 def spectralfilterprops(thefilter, debug=False):
@@ -198,8 +198,56 @@ def test_filterprops(display=False):
     eval_filterprops(sampletime=0.1, tclengthinsecs=1000.0, numruns=10, display=display)
 
 
+def test_filtercache(debug=False):
+    np.random.seed(12345)
+    Fs = 1.0 / 0.72
+    testlen = 400
+    for filtertype in ["lfo", "lfo_stop", "arb"]:
+        thefilter = noncausalfilter(filtertype)
+        if filtertype == "arb":
+            thefilter.setarb(0.01, 0.02, 0.08, 0.1)
+        lowerstop, lowerpass, upperpass, upperstop = thefilter.getfreqlimits()
+        for i in range(3):
+            thedata = np.random.normal(size=(4, testlen))
+            filtered = thefilter.apply(Fs, thedata)
+
+            # the cached transfer function must give the same answer as arb_pass, row by row
+            for j in range(thedata.shape[0]):
+                expected = arb_pass(
+                    Fs,
+                    thedata[j, :],
+                    lowerstop,
+                    lowerpass,
+                    upperpass,
+                    upperstop,
+                    padlen=int(thefilter.getpadtime() * Fs),
+                )
+                if filtertype.endswith("_stop"):
+                    expected = thedata[j, :] - expected
+                np.testing.assert_allclose(filtered[j, :], expected, atol=1e-12)
+                np.testing.assert_allclose(
+                    thefilter.apply(Fs, thedata[j, :]), filtered[j, :], atol=1e-12
+                )
+        if debug:
+            print(filtertype, len(thefilter.transferfuncs), "cached transfer functions")
+        assert len(thefilter.transferfuncs) <= 2
+
+    # changing the filter must not pick up a stale transfer function
+    thefilter = noncausalfilter("arb")
+    thefilter.setarb(0.01, 0.02, 0.08, 0.1)
+    thedata = np.random.normal(size=testlen)
+    first = thefilter.apply(Fs, thedata)
+    thefilter.setarb(0.05, 0.06, 0.2, 0.25)
+    second = thefilter.apply(Fs, thedata)
+    assert np.max(np.fabs(first - second)) > 0.1
+    np.testing.assert_allclose(
+        second, arb_pass(Fs, thedata, 0.05, 0.06, 0.2, 0.25, padlen=int(30.0 * Fs))
+    )
+
+
 def main():
     test_filterprops(display=True)
+    test_filtercache(debug=True)
 
 
 if __name__ == "__main__":
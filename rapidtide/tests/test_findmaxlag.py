@@ -2,6 +2,7 @@
 
 
 import os.path as op
+import warnings
 
 import numpy as np
 import pylab as plt
@@ -132,8 +133,84 @@ def test_findmaxlag(display=False, debug=False):
         plt.show()
 
 
+def test_findmaxlag_block(debug=False):
+    np.random.seed(2718)
+    numrows = 300
+    xvecs = np.arange(-30.0, 30.01, 0.5)
+    amps = np.random.uniform(-1.2, 1.3, numrows)
+    lags = np.random.uniform(-35.0, 35.0, numrows)
+    sigmas = np.random.uniform(0.3, 15.0, numrows)
+    yvecs = amps[:, None] * np.exp(
+        -((xvecs[None, :] - lags[:, None]) ** 2) / (2.0 * sigmas[:, None] ** 2)
+    ) + np.random.normal(scale=0.05, size=(numrows, len(xvecs)))
+    yvecs = yvecs.astype("float32")
+    guesses = np.random.uniform(-25.0, 25.0, numrows)
+
+    for bipolar in [False, True]:
+        for refine in [False, True]:
+            for useguess in [False, True]:
+                theargs = {
+                    "absmaxsigma": 10.0,
+                    "threshval": 0.1,
+                    "bipolar": bipolar,
+                    "refine": refine,
+                    "useguess": useguess,
+                    "zerooutbadfit": False,
+                }
+                blockyvecs = yvecs.copy()
+                thefilters = list(warnings.filters)
+                if useguess:
+                    blockresults = tide_fit.findmaxlag_gauss_block(
+                        xvecs, blockyvecs, -20, 20, 100.0, maxguess=guesses, **theargs
+                    )
+                else:
+                    blockresults = tide_fit.findmaxlag_gauss_block(
+                        xvecs, blockyvecs, -20, 20, 100.0, **theargs
+                    )
+                # the block fit must not change the warning filters of the caller
+                assert warnings.filters == thefilters
+                voxelyvecs = yvecs.copy()
+                voxelresults = []
+                for i in range(numrows):
+                    voxelresults.append(
+                        tide_fit.findmaxlag_gauss_rev(
+                            xvecs,
+                            voxelyvecs[i, :],
+                            -20,
+                            20,
+                            100.0,
+                            maxguess=guesses[i],
+                            **theargs
+                        )
+                    )
+                voxelresults = [
+                    np.asarray([theresult[j] for theresult in voxelresults])
+                    for j in range(8)
+                ]
+                if debug:
+                    print(bipolar, refine, useguess)
+
+                # indices, masks, failure codes, and window limits must match exactly
+                for j in [0, 4, 5, 6, 7]:
+                    np.testing.assert_array_equal(blockresults[j], voxelresults[j])
+                np.testing.assert_array_equal(blockyvecs, voxelyvecs)
+                if refine:
+                    # the fits themselves agree to within the convergence of the optimizers
+                    good = np.where(voxelresults[4] > 0)
+                    for j in [1, 2, 3]:
+                        np.testing.assert_allclose(
+                            blockresults[j][good], voxelresults[j][good], atol=1e-3
+                        )
+                else:
+                    for j in [1, 2, 3]:
+                        np.testing.assert_allclose(
+                            blockresults[j], voxelresults[j], atol=1e-10
+                        )
+
+
 def main():
     test_findmaxlag(display=True, debug=True)
+    test_findmaxlag_block(debug=True)
 
 
 if __name__ == "__main__":
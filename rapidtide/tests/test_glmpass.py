@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.glmpass as tide_glmpass
+
+
+def _runglm(fmridata, lagtc, procbyvoxel, blockmem, nprocs):
+    numspace, numtime = np.shape(fmridata)
+    if procbyvoxel:
+        numitems = numspace
+    else:
+        numitems = numtime
+    outputs = [np.zeros(numitems, dtype=np.float64) for i in range(5)]
+    datatoremove = np.zeros_like(fmridata)
+    filtereddata = np.zeros_like(fmridata)
+    itemstotal = tide_glmpass.glmpass(
+        numitems,
+        fmridata,
+        None,
+        lagtc,
+        outputs[0],
+        outputs[1],
+        outputs[2],
+        outputs[3],
+        outputs[4],
+        datatoremove,
+        filtereddata,
+        nprocs=nprocs,
+        procbyvoxel=procbyvoxel,
+        showprogressbar=False,
+        mp_chunksize=100,
+        blockmem=blockmem,
+    )
+    assert itemstotal == numitems
+    return outputs + [datatoremove, filtereddata]
+
+
+def test_glmpass(debug=False):
+    np.random.seed(54321)
+    numvoxels = 213
+    numpoints = 150
+    lagtc = np.random.normal(size=(numvoxels, numpoints))
+    lagtc[7, :] = 0.0
+    fmridata = (
+        1000.0
+        + np.random.uniform(0.5, 2.0, size=(numvoxels, 1)) * lagtc
+        + np.random.normal(size=(numvoxels, numpoints))
+    )
+
+    for procbyvoxel in [True, False]:
+        reference = _runglm(fmridata, lagtc, procbyvoxel, 0.0, 1)
+        # a tiny memory budget forces many small blocks
+        for blockmem, nprocs in [(0.01, 1), (256.0, 1), (0.01, 2)]:
+            results = _runglm(fmridata, lagtc, procbyvoxel, blockmem, nprocs)
+            for i in range(len(reference)):
+                if debug:
+                    print(
+                        procbyvoxel,
+                        blockmem,
+                        nprocs,
+                        i,
+                        np.nanmax(np.fabs(results[i] - reference[i])),
+                    )
+                np.testing.assert_allclose(
+                    results[i], reference[i], rtol=1e-6, atol=1e-8
+                )
+
+
+def main():
+    test_glmpass(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import sys
+
+import rapidtide
+import rapidtide.util as tide_util
+
+# these are slow to import, and only needed for plotting, machine learning, or reading particular file types
+HEAVYMODULES = ["keras", "matplotlib", "nibabel", "numba", "pandas", "pyfftw", "sklearn", "statsmodels"]
+
+COREMODULES = [
+    "rapidtide.io",
+    "rapidtide.util",
+    "rapidtide.filter",
+    "rapidtide.fit",
+    "rapidtide.resample",
+    "rapidtide.miscmath",
+    "rapidtide.stats",
+    "rapidtide.correlate",
+    "rapidtide.refine",
+]
+
+
+def importtime(modulename):
+    """Import a module in a fresh interpreter, returning the time it took and any heavy modules it pulled in."""
+    thecode = (
+        "import sys, time\n"
+        + "starttime = time.time()\n"
+        + "import "
+        + modulename
+        + "\n"
+        + "print(time.time() - starttime)\n"
+        + "print(' '.join([m for m in "
+        + str(HEAVYMODULES)
+        + " if m in sys.modules]))\n"
+    )
+    theenv = dict(os.environ)
+    theenv["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(rapidtide.__file__)))
+    theoutput = (
+        subprocess.check_output([sys.executable, "-c", thecode], env=theenv).decode().split("\n")
+    )
+    return float(theoutput[0]), theoutput[1].split()
+
+
+def test_importtime(debug=False):
+    for modulename in COREMODULES:
+        thetime, heavymodules = importtime(modulename)
+        if debug:
+            print(modulename.ljust(25), "{:.3f}".format(thetime), "seconds", heavymodules)
+        assert heavymodules == []
+
+
+def test_lazymodule(debug=False):
+    thecolorsys = tide_util.lazymodule("colorsys")
+    assert thecolorsys._module is None
+    assert thecolorsys.rgb_to_hsv(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert thecolorsys._module is not None
+
+
+def test_lazyfftpack(debug=False):
+    thefftpack = tide_util.lazyfftpack()
+    assert thefftpack._module is None
+    assert thefftpack.next_fast_len(1000) == 1000
+    if debug:
+        print("fftpack resolved to", thefftpack._module.__name__)
+    if tide_util.pyfftwexists:
+        assert thefftpack._module.__name__ == "pyfftw.interfaces.scipy_fftpack"
+    else:
+        assert thefftpack._module.__name__ == "scipy.fftpack"
+
+
+def main():
+    test_importtime(debug=True)
+    test_lazymodule(debug=True)
+    test_lazyfftpack(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import rapidtide.io as tide_io
+
+
+def test_io(debug=False):
+    np.random.seed(12345)
+    thedata = np.random.normal(size=(4, 1000))
+    tempdir = tempfile.mkdtemp()
+    try:
+        # write the columns with a blank line in the middle and at the end
+        textfilename = os.path.join(tempdir, "thedata.txt")
+        thelines = [" ".join(["{:.10f}".format(val) for val in thedata[:, i]]) for i in range(1000)]
+        with open(textfilename, "w") as thefile:
+            thefile.write("\n".join(thelines[:500]) + "\n\n" + "\n".join(thelines[500:]) + "\n\n")
+        with open(textfilename, "rb") as infile, gzip.open(textfilename + ".gz", "wb") as outfile:
+            shutil.copyfileobj(infile, outfile)
+
+        for thefilename in [textfilename, textfilename + ".gz"]:
+            allcols = tide_io.readvecs(thefilename)
+            if debug:
+                print(thefilename, allcols.shape, np.max(np.fabs(allcols - thedata)))
+            assert allcols.shape == (4, 1000)
+            assert allcols.flags["C_CONTIGUOUS"]
+            np.testing.assert_allclose(allcols, thedata, atol=1e-9)
+            somecols = tide_io.readvecs(thefilename, colspec="0,2-3")
+            np.testing.assert_array_equal(somecols, allcols[[0, 2, 3], :])
+
+        # a single column file
+        vecfilename = os.path.join(tempdir, "thevec.txt")
+        with open(vecfilename, "w") as thefile:
+            thefile.write("\n".join(["{:.10f}".format(val) for val in thedata[0, :]]) + "\n")
+        thevec = tide_io.readvec(vecfilename)
+        assert thevec.shape == (1000,)
+        np.testing.assert_allclose(thevec, thedata[0, :], atol=1e-9)
+
+        # an empty file gives an empty vector
+        emptyfilename = os.path.join(tempdir, "empty.txt")
+        open(emptyfilename, "w").close()
+        assert len(tide_io.readvec(emptyfilename)) == 0
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main():
+    test_io(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+import numpy as np
+import pytest
+
+import rapidtide.fit as tide_fit
+import rapidtide.util as tide_util
+
+
+def test_jitkernel(debug=False):
+    # the hot numeric routines are registered
+    thestatus = tide_util.jitkernelstatus()
+    if debug:
+        print(thestatus)
+    for thekernel in [
+        "rapidtide.fit.gauss_eval",
+        "rapidtide.fit.trapezoid_eval_loop",
+        "rapidtide.fit.risetime_eval_loop",
+        "rapidtide.util.valtoindex",
+    ]:
+        assert thekernel in thestatus
+
+    # kernels give the same answers however they end up being run
+    xvals = np.linspace(-5.0, 20.0, 251, endpoint=True)
+    trapparams = np.array([1.0, 2.0, 1.5, 3.0])
+    risetimeparams = np.array([1.0, 2.0, 1.5])
+    np.testing.assert_allclose(
+        tide_fit.trapezoid_eval_loop(xvals, 4.0, trapparams),
+        np.array([tide_fit.trapezoid_eval(x, 4.0, trapparams) for x in xvals]),
+    )
+    np.testing.assert_allclose(
+        tide_fit.risetime_eval_loop(xvals, risetimeparams),
+        np.array([tide_fit.risetime_eval(x, risetimeparams) for x in xvals]),
+    )
+    assert tide_util.valtoindex(xvals, 0.04) == 50
+    assert tide_util.valtoindex(xvals, 100.0) == len(xvals) - 1
+
+    # once used, every kernel reports whether it was compiled, and if not, why
+    thestatus = tide_util.jitkernelstatus()
+    for thekernel in ["rapidtide.fit.trapezoid_eval_loop", "rapidtide.util.valtoindex"]:
+        if debug:
+            print(thekernel, thestatus[thekernel])
+        if tide_util.numbaexists:
+            assert thestatus[thekernel].startswith("compiled") or thestatus[thekernel].startswith(
+                "python"
+            )
+        else:
+            assert thestatus[thekernel] == "python (numba not installed)"
+    assert tide_fit.gauss_eval.__name__ == "gauss_eval"
+
+    # argument types the compiled version can't type fall back to python, even after other types have
+    # compiled, and only they do
+    class fakecompileerror(Exception):
+        pass
+
+    def addone(x):
+        if isinstance(x, str):
+            raise TypeError("not a number")
+        return x + 1
+
+    compiledcalls = []
+
+    def compiledaddone(x):
+        compiledcalls.append(x)
+        if isinstance(x, float):
+            raise fakecompileerror("cannot type float\nmore detail")
+        if isinstance(x, str):
+            raise TypeError("not a number")
+        return x + 2
+
+    thekernel = tide_util.jitkernel(addone)
+    thekernel.compiled = compiledaddone
+    thekernel._dispatch = compiledaddone
+    thekernel.typingerror = fakecompileerror
+    thekernel.status = "compiled"
+    assert thekernel(1) == 3
+    assert thekernel.status == "compiled"
+    assert thekernel(1.0) == 2.0
+    assert thekernel.status == "compiled (python for some argument types: cannot type float)"
+    assert thekernel(2.0) == 3.0
+    assert thekernel(2) == 4
+    # the float that compiled code rejected once is not sent to it again
+    assert compiledcalls == [1, 1.0, 2]
+
+    # errors from running the compiled code are passed on, not rerun in python
+    try:
+        thekernel("a")
+    except TypeError:
+        pass
+    else:
+        assert False, "the error was not passed on"
+    assert compiledcalls == [1, 1.0, 2, "a"]
+
+
+@pytest.mark.skipif(not tide_util.numbaexists, reason="numba is not installed")
+def test_jitkernel_numba(debug=False):
+    def scaleinplace(thearray, scale):
+        for i in range(len(thearray)):
+            thearray[i] *= scale
+        return thearray
+
+    # a real numba compile, and a call with types numba can't handle
+    thekernel = tide_util.jitkernel(scaleinplace)
+    thearray = np.arange(5.0)
+    thekernel(thearray, 2.0)
+    if debug:
+        print(thekernel.status)
+    assert thekernel.status == "compiled"
+    np.testing.assert_allclose(thearray, 2.0 * np.arange(5.0))
+    assert list(thekernel(np.array(["a", "b"], dtype=object), 2)) == ["aa", "bb"]
+    assert thekernel.status.startswith("compiled (python for some argument types:")
+
+    # in place kernels that compile run once
+    thearray = np.arange(5.0)
+    thekernel(thearray, 3.0)
+    np.testing.assert_allclose(thearray, 3.0 * np.arange(5.0))
+
+    # a kernel that numba can't type on its first call runs in python from then on
+    def firstitem(thearray):
+        return thearray[0]
+
+    thekernel = tide_util.jitkernel(firstitem)
+    assert thekernel(np.array(["a", "b"], dtype=object)) == "a"
+    assert thekernel.status.startswith("python (compilation failed:")
+    assert thekernel(np.arange(3.0)) == 0.0
+
+
+def main():
+    test_jitkernel(debug=True)
+    if tide_util.numbaexists:
+        test_jitkernel_numba(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os.path as op
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+import rapidtide.io as tide_io
+
+
+def test_lazyload(debug=False):
+    np.random.seed(31415)
+    xsize, ysize, numslices, timepoints = 5, 6, 7, 20
+    thedata = np.random.normal(size=(xsize, ysize, numslices, timepoints)).astype(
+        "float32"
+    )
+    flatdata = thedata.reshape((xsize * ysize * numslices, timepoints))
+    voxels = np.random.choice(xsize * ysize * numslices, 50, replace=False)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for suffix in [".nii", ".nii.gz"]:
+            filename = op.join(tempdir, "lazytest" + suffix)
+            nib.save(nib.Nifti1Image(thedata, np.eye(4)), filename)
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
+                filename, lazy=True
+            )
+            if debug:
+                print(suffix, type(nim_data))
+            if suffix == ".nii":
+                assert isinstance(nim_data, np.memmap)
+
+            # pulling out voxels should match reshaping the full array
+            np.testing.assert_array_equal(
+                tide_io.readniftivoxels(nim_data, voxels, 2, 15),
+                flatdata[voxels, 2:15],
+            )
+            numchunks = 0
+            for thevoxels, thechunk in tide_io.niftichunks(nim_data, 1, 19):
+                np.testing.assert_array_equal(thechunk, flatdata[thevoxels, 1:19])
+                numchunks += 1
+            assert numchunks == numslices
+            del nim, nim_data
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_savevoxelstonifti(debug=False):
+    np.random.seed(27182)
+    nativeshape = (4, 5, 3, 9)
+    numspatiallocs = nativeshape[0] * nativeshape[1] * nativeshape[2]
+    voxels = np.sort(np.random.choice(numspatiallocs, 25, replace=False))
+    thedata = np.random.normal(size=(len(voxels), nativeshape[3])).astype("float32")
+    theheader = nib.Nifti1Image(
+        np.zeros(nativeshape, dtype="float32"), np.diag([2.0, 2.0, 3.0, 1.0])
+    ).header
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        outname = op.join(tempdir, "voxelout")
+        tide_io.savevoxelstonifti(
+            thedata, voxels, theheader, outname, nativeshape, blocksize=7
+        )
+        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
+            outname + ".nii"
+        )
+        expected = np.zeros((numspatiallocs, nativeshape[3]), dtype="float32")
+        expected[voxels, :] = thedata
+        if debug:
+            print(nim_data.shape, thesizes)
+        np.testing.assert_array_equal(
+            np.asarray(nim_data).reshape((numspatiallocs, nativeshape[3])), expected
+        )
+        np.testing.assert_allclose(nim.affine, np.diag([2.0, 2.0, 3.0, 1.0]))
+        del nim, nim_data
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main():
+    test_lazyload(debug=True)
+    test_savevoxelstonifti(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+import os
+import os.path as op
+import shutil
+import signal
+import tempfile
+
+import numpy as np
+
+import rapidtide.multiproc as tide_multiproc
+
+
+def test_multiproc_chunked(debug=False):
+    numitems = 1037
+    indata = np.random.normal(size=(numitems, 10))
+    themask = np.where(np.arange(numitems) % 3 == 0, 1, 0)
+
+    for nprocs in [1, 2, 3]:
+        outdata, dummy, dummy = tide_multiproc.allocshared((numitems,), np.float64)
+
+        def sum_proc(items):
+            outdata[items] = np.sum(indata[items, :], axis=1)
+            return len(items)
+
+        data_out = tide_multiproc.run_multiproc_chunked(
+            sum_proc,
+            np.shape(indata),
+            themask,
+            nprocs=nprocs,
+            showprogressbar=debug,
+            chunksize=50,
+        )
+        if debug:
+            print(nprocs, len(data_out), np.sum(data_out))
+
+        # every masked item must be done exactly once, and nothing else touched
+        assert np.sum(data_out) == np.sum(themask)
+        np.testing.assert_allclose(
+            outdata, np.where(themask > 0, np.sum(indata, axis=1), 0.0)
+        )
+
+
+def _rowsumstage(items, arrays, params, showprogressbar=False):
+    arrays["outdata"][items] = params["scale"] * np.sum(arrays["indata"][items, :], axis=1)
+    return len(items)
+
+
+def test_workerpool(debug=False):
+    numitems = 1037
+    themask = np.where(np.arange(numitems) % 3 == 0, 1, 0)
+    thepool = tide_multiproc.workerpool(3)
+    indata = thepool.attach("indata", np.random.normal(size=(numitems, 20)))
+    outdata = thepool.attach("outdata", np.zeros(numitems, dtype=np.float64))
+    thepool.start()
+
+    # run the same stage twice on the same workers, once on a view into an attached array
+    for scale, inview in [(1.0, indata), (2.0, indata[:, 5:])]:
+        outdata[:] = 0.0
+        data_out = tide_multiproc.run_multiproc_stage(
+            _rowsumstage,
+            {"indata": inview},
+            {"outdata": outdata},
+            {"scale": scale},
+            np.shape(inview),
+            themask,
+            nprocs=3,
+            pool=thepool,
+            showprogressbar=debug,
+            chunksize=50,
+        )
+        if debug:
+            print(scale, len(data_out), np.sum(data_out))
+        assert np.sum(data_out) == np.sum(themask)
+        np.testing.assert_allclose(
+            outdata, np.where(themask > 0, scale * np.sum(inview, axis=1), 0.0)
+        )
+
+    # an array attached after the pool is started is picked up by the next stage, and arrays that
+    # are already in shared memory are attached without a copy
+    lateout, dummy, dummy = tide_multiproc.allocshared((numitems,), np.float64)
+    assert thepool.attach("lateout", lateout) is lateout
+    tide_multiproc.run_multiproc_stage(
+        _rowsumstage,
+        {"indata": indata},
+        {"outdata": lateout},
+        {"scale": 3.0},
+        np.shape(indata),
+        themask,
+        nprocs=3,
+        pool=thepool,
+        showprogressbar=debug,
+        chunksize=50,
+    )
+    np.testing.assert_allclose(
+        lateout, np.where(themask > 0, 3.0 * np.sum(indata, axis=1), 0.0)
+    )
+    thepool.shutdown()
+
+
+def test_sharedoutputs(debug=False):
+    numitems = 1037
+    indata = np.random.normal(size=(numitems, 20))
+
+    # without a pool, outputs that are already shared are written in place, others are copied back
+    for shared in [True, False]:
+        if shared:
+            outdata, dummy, dummy = tide_multiproc.allocshared((numitems,), np.float64)
+        else:
+            outdata = np.zeros(numitems, dtype=np.float64)
+        assert tide_multiproc._isshared(outdata) == shared
+        assert tide_multiproc._isshared(outdata[10:]) == shared
+        tide_multiproc.run_multiproc_stage(
+            _rowsumstage,
+            {"indata": indata},
+            {"outdata": outdata},
+            {"scale": 1.0},
+            np.shape(indata),
+            None,
+            nprocs=2,
+            showprogressbar=debug,
+            chunksize=50,
+        )
+        np.testing.assert_allclose(outdata, np.sum(indata, axis=1))
+
+
+def _failingstage(items, arrays, params, showprogressbar=False):
+    if params["failat"] in items:
+        raise ValueError("bad item " + str(params["failat"]))
+    arrays["outdata"][items] = np.sum(arrays["indata"][items, :], axis=1)
+    return len(items)
+
+
+def test_workerfailure(debug=False):
+    numitems = 1037
+    indata = np.random.normal(size=(numitems, 20))
+
+    # a failing chunk stops the run, with or without a pool, and the pool can still be reused
+    for usepool in [False, True]:
+        thepool = None
+        if usepool:
+            thepool = tide_multiproc.workerpool(3)
+            indata = thepool.attach("indata", indata)
+            outdata = thepool.attach("outdata", np.zeros(numitems, dtype=np.float64))
+            thepool.start()
+        else:
+            outdata = np.zeros(numitems, dtype=np.float64)
+        for failat in [500, -1]:
+            try:
+                tide_multiproc.run_multiproc_stage(
+                    _failingstage,
+                    {"indata": indata},
+                    {"outdata": outdata},
+                    {"failat": failat},
+                    np.shape(indata),
+                    None,
+                    nprocs=3,
+                    pool=thepool,
+                    showprogressbar=debug,
+                    chunksize=50,
+                )
+            except RuntimeError as e:
+                if debug:
+                    print(usepool, e)
+                assert failat >= 0
+                assert "bad item 500" in str(e)
+            else:
+                assert failat < 0
+                np.testing.assert_allclose(outdata, np.sum(indata, axis=1))
+        if thepool is not None:
+            thepool.shutdown()
+
+
+def _killedstage(items, arrays, params, showprogressbar=False):
+    if params["failat"] in items:
+        # what the OOM killer does - no exception, no result
+        os.kill(os.getpid(), signal.SIGKILL)
+    arrays["outdata"][items] = np.sum(arrays["indata"][items, :], axis=1)
+    return len(items)
+
+
+def test_workerkilled(debug=False):
+    numitems = 1037
+    indata = np.random.normal(size=(numitems, 20))
+
+    # a worker that dies stops the run instead of leaving the parent waiting forever
+    for usepool in [False, True]:
+        thepool = None
+        if usepool:
+            thepool = tide_multiproc.workerpool(3)
+            indata = thepool.attach("indata", indata)
+            outdata = thepool.attach("outdata", np.zeros(numitems, dtype=np.float64))
+            thepool.start()
+        else:
+            outdata = np.zeros(numitems, dtype=np.float64)
+        try:
+            tide_multiproc.run_multiproc_stage(
+                _killedstage,
+                {"indata": indata},
+                {"outdata": outdata},
+                {"failat": 500},
+                np.shape(indata),
+                None,
+                nprocs=3,
+                pool=thepool,
+                showprogressbar=debug,
+                chunksize=50,
+            )
+        except RuntimeError as e:
+            if debug:
+                print(usepool, e)
+            assert "died" in str(e)
+        else:
+            assert False, "a killed worker was not detected"
+        if thepool is not None:
+            assert not thepool.started
+            thepool.shutdown()
+
+
+def test_allocfile(debug=False):
+    numitems = 1037
+    themask = np.where(np.arange(numitems) % 3 == 0, 1, 0)
+    indata = np.random.normal(size=(numitems, 20))
+    tempdir = tempfile.mkdtemp()
+    try:
+        # file backed outputs are written in place, with or without a pool
+        for usepool in [False, True]:
+            outdata = tide_multiproc.allocfile(
+                op.join(tempdir, "outdata.dat"), (numitems,), np.float64
+            )
+            thepool = None
+            if usepool:
+                thepool = tide_multiproc.workerpool(3)
+                indata_shared = thepool.attach("indata", indata)
+                assert thepool.attach("outdata", outdata) is outdata
+                thepool.start()
+            else:
+                indata_shared = indata
+            data_out = tide_multiproc.run_multiproc_stage(
+                _rowsumstage,
+                {"indata": indata_shared},
+                {"outdata": outdata},
+                {"scale": 1.0},
+                np.shape(indata),
+                themask,
+                nprocs=3,
+                pool=thepool,
+                showprogressbar=debug,
+                chunksize=50,
+            )
+            if thepool is not None:
+                thepool.shutdown()
+            if debug:
+                print(usepool, len(data_out), np.sum(data_out))
+            assert np.sum(data_out) == np.sum(themask)
+            np.testing.assert_allclose(
+                outdata, np.where(themask > 0, np.sum(indata, axis=1), 0.0)
+            )
+            del outdata
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_numpy2shared(debug=False):
+    for thetype in [np.float64, np.float32, np.uint16]:
+        inarray = np.arange(24).reshape((2, 3, 4)).astype(thetype)
+        outarray, dummy, theshape = tide_multiproc.numpy2shared(inarray, thetype)
+        assert outarray.dtype == np.dtype(thetype)
+        assert theshape == (2, 3, 4)
+        np.testing.assert_array_equal(outarray, inarray)
+
+
+def main():
+    test_multiproc_chunked(debug=True)
+    test_workerpool(debug=True)
+    test_sharedoutputs(debug=True)
+    test_workerfailure(debug=True)
+    test_workerkilled(debug=True)
+    test_allocfile(debug=True)
+    test_numpy2shared(debug=True)
+
+
+if __name__ == "__main__":
+    main()
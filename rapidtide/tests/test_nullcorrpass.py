@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.miscmath as tide_math
+import rapidtide.nullcorrpass as tide_nullcorr
+import rapidtide.resample as tide_resample
+
+
+def test_nullcorrpass(debug=False):
+    np.random.seed(12345)
+    tr = 1.0
+    numpoints = 200
+    oversampfactor = 2
+    fmri_x = np.arange(0.0, numpoints) * tr
+    os_fmri_x = np.arange(0.0, numpoints * oversampfactor) * tr / oversampfactor
+    oversampfreq = oversampfactor / tr
+
+    # make a smooth random regressor
+    theprefilter = tide_filt.noncausalfilter(filtertype="lfo")
+    regressor = theprefilter.apply(1.0 / tr, np.random.normal(size=numpoints))
+    os_regressor = tide_resample.doresample(fmri_x, regressor, os_fmri_x)
+    referencetc = tide_math.corrnormalize(
+        theprefilter.apply(oversampfreq, os_regressor),
+        prewindow=True,
+        detrendorder=1,
+        windowfunc="hamming",
+    )
+
+    corrorigin = numpoints * oversampfactor - 1
+    corrscale = (np.arange(0.0, 2 * numpoints * oversampfactor - 1) - corrorigin) / oversampfreq
+    lagmininpts = 40
+    lagmaxinpts = 40
+    optiondict = {
+        "numestreps": 200,
+        "usewindowfunc": True,
+        "detrendorder": 1,
+        "windowfunc": "hamming",
+        "corrweighting": "none",
+        "findmaxtype": "gauss",
+        "fixdelay": False,
+        "fixeddelayvalue": 0.0,
+        "lagmin": -20.0,
+        "lagmax": 20.0,
+        "widthlimit": 100.0,
+        "absmaxsigma": 100.0,
+        "edgebufferfrac": 0.0,
+        "lthreshval": 0.0,
+        "uthreshval": 1.0,
+        "gaussrefine": True,
+        "peakfitrefine": "gaussnewton",
+        "peakfititers": 30,
+        "bipolar": False,
+        "searchfrac": 0.5,
+        "fastgauss": False,
+        "enforcethresh": True,
+        "lagmod": 1000.0,
+        "hardlimit": True,
+        "debug": False,
+        "mp_chunksize": 50000,
+        "showprogressbar": False,
+        "nullseed": 31415,
+        "nullcachedir": None,
+    }
+
+    # with a seed, the distribution doesn't depend on the number of processes or the block size
+    results = {}
+    for blocksize, nprocs in [(0, 1), (0, 2), (50, 1), (50, 3)]:
+        optiondict["nullblocksize"] = blocksize
+        optiondict["nprocs"] = nprocs
+        results[(blocksize, nprocs)] = tide_nullcorr.getNullDistributionDatax(
+            referencetc,
+            corrscale,
+            theprefilter,
+            oversampfreq,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            optiondict,
+        )
+    reference = results[(0, 1)]
+    assert np.sum(reference > 0.0) > 0.9 * len(reference)
+    for thekey in [(0, 2), (50, 1), (50, 3)]:
+        if debug:
+            print(thekey, np.max(np.fabs(results[thekey] - reference)))
+        np.testing.assert_allclose(results[thekey], reference, atol=1e-5)
+    np.testing.assert_array_equal(results[(0, 2)], reference)
+    np.testing.assert_allclose(results[(50, 3)], results[(50, 1)], atol=1e-10)
+
+    # a second run with the same regressor and seed is read from the cache
+    tempdir = tempfile.mkdtemp()
+    try:
+        optiondict["nullcachedir"] = os.path.join(tempdir, "nullcache")
+        first = tide_nullcorr.getNullDistributionDatax(
+            referencetc,
+            corrscale,
+            theprefilter,
+            oversampfreq,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            optiondict,
+        )
+        assert len(os.listdir(optiondict["nullcachedir"])) == 1
+        np.save(
+            os.path.join(optiondict["nullcachedir"], os.listdir(optiondict["nullcachedir"])[0]),
+            first + 1.0,
+        )
+        second = tide_nullcorr.getNullDistributionDatax(
+            referencetc,
+            corrscale,
+            theprefilter,
+            oversampfreq,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            optiondict,
+        )
+        np.testing.assert_array_equal(second, first + 1.0)
+
+        # but not if the seed changes
+        optiondict["nullseed"] = 27182
+        third = tide_nullcorr.getNullDistributionDatax(
+            referencetc,
+            corrscale,
+            theprefilter,
+            oversampfreq,
+            corrorigin,
+            lagmininpts,
+            lagmaxinpts,
+            optiondict,
+        )
+        assert len(os.listdir(optiondict["nullcachedir"])) == 2
+        assert np.max(np.fabs(third - first)) > 0.0
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main():
+    test_nullcorrpass(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import rapidtide.multiproc as tide_multiproc
+import rapidtide.util as tide_util
+
+
+def _busystage(items, arrays, params, showprogressbar=False):
+    # burn some cpu in every item
+    for item in items:
+        arrays["output"][item] = np.sum(np.sqrt(np.arange(params["work"], dtype=np.float64)))
+    return len(items)
+
+
+def test_profiler(debug=False):
+    theprofiler = tide_util.profiler(name="test")
+    theprofiler.mark("Begin")
+    theprofiler.start("Pass 1", category="pass")
+    theprofiler.start("Sleep")
+    time.sleep(0.05)
+    theprofiler.end("Sleep", count=np.int64(10), unit="voxels")
+
+    # worker cpu time is counted when the work is done in other processes
+    output = np.zeros(40, dtype=np.float64)
+    with theprofiler.span("Busy", nprocs=2) as thespan:
+        data_out = tide_multiproc.run_multiproc_stage(
+            _busystage,
+            {},
+            {"output": output},
+            {"work": 200000},
+            (40, 1),
+            None,
+            nprocs=2,
+            showprogressbar=False,
+            chunksize=5,
+        )
+        thespan["count"] = int(np.sum(data_out))
+        thespan["unit"] = "voxels"
+    theprofiler.end("Pass 1")
+    theprofiler.start("Unfinished")
+
+    thesummary = theprofiler.summary()
+    if debug:
+        for theentry in thesummary:
+            print(theentry)
+    assert [theentry["fullname"] for theentry in thesummary] == [
+        "Pass 1",
+        "Pass 1: Sleep",
+        "Pass 1: Busy",
+    ]
+    passentry, sleepentry, busyentry = thesummary
+    assert passentry["depth"] == 0
+    assert sleepentry["depth"] == 1
+    assert sleepentry["walltime"] >= 0.05
+    assert sleepentry["cputime"] < sleepentry["walltime"]
+    assert sleepentry["count"] == 10
+    np.testing.assert_allclose(sleepentry["itemspersec"], 10 / sleepentry["walltime"])
+    assert busyentry["count"] == 40
+    assert busyentry["workercputime"] > 0.0
+    assert busyentry["workerpeakrss_mb"] > 0.0
+    assert passentry["walltime"] >= sleepentry["walltime"] + busyentry["walltime"]
+    assert np.all(output > 0.0)
+
+    # the old timing list format still works
+    thetimings = theprofiler.timings()
+    assert [theevent[0] for theevent in thetimings] == [
+        "Start",
+        "Begin",
+        "Pass 1 start",
+        "Pass 1: Sleep start",
+        "Pass 1: Sleep end",
+        "Pass 1: Busy start",
+        "Pass 1: Busy end",
+        "Pass 1 end",
+    ]
+    assert thetimings[4][2:] == [10, "voxels"]
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        jsonname = os.path.join(tempdir, "profile.json")
+        tracename = os.path.join(tempdir, "trace.json")
+        theprofiler.writejson(jsonname)
+        theprofiler.writechrometrace(tracename)
+        tide_util.proctiminginfo(thetimings, outputfile=os.path.join(tempdir, "timings.txt"))
+        with open(jsonname) as f:
+            theprofile = json.load(f)
+        assert len(theprofile["spans"]) == 3
+        assert theprofile["marks"][0]["name"] == "Begin"
+        with open(tracename) as f:
+            thetrace = json.load(f)
+        spanevents = [theevent for theevent in thetrace["traceEvents"] if theevent["ph"] == "X"]
+        assert [theevent["name"] for theevent in spanevents] == ["Pass 1", "Sleep", "Busy"]
+        np.testing.assert_allclose(spanevents[1]["dur"], 1.0e6 * sleepentry["walltime"])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_maxrsskb(debug=False):
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    class fakeusage:
+        ru_maxrss = 2048 * 1024
+
+    theplatform = sys.platform
+    try:
+        sys.platform = "darwin"
+        assert tide_util.maxrsskb(fakeusage()) == 2048
+        sys.platform = "linux"
+        assert tide_util.maxrsskb(fakeusage()) == 2048 * 1024
+    finally:
+        sys.platform = theplatform
+    themaxrss = tide_util.maxrsskb(resource.getrusage(resource.RUSAGE_SELF))
+    if debug:
+        print("peak RSS:", themaxrss, "kB")
+    # this process has imported numpy, so it's using somewhere between 1 MB and 1 TB
+    assert 1024 < themaxrss < 1024**3
+
+
+def main():
+    test_profiler(debug=True)
+    test_maxrsskb(debug=True)
+
+
+if __name__ == "__main__":
+    main()
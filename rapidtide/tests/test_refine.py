@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import warnings
+
+import numpy as np
+
+import rapidtide.refine as tide_refine
+
+
+def test_refine(debug=False):
+    rng = np.random.RandomState(12345)
+    numvoxels = 2000
+    numpoints = 150
+    thesignal = np.sin(np.arange(numpoints) / 5.0)
+    thedata = 1.0 + 0.02 * np.outer(rng.normal(size=numvoxels), thesignal)
+    thedata += 0.01 * rng.normal(size=(numvoxels, numpoints))
+    rowlist = np.sort(rng.choice(numvoxels, 1500, replace=False))
+
+    # block sums add the rows in the same order as a single sum
+    np.testing.assert_array_equal(
+        tide_refine._blocksum(thedata, rowlist, 128), np.sum(thedata[rowlist], axis=0)
+    )
+
+    # the first component matches PCA and FastICA, up to sign
+    from sklearn.decomposition import PCA, FastICA
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        pcacomp = PCA(n_components=1).fit(thedata[rowlist]).components_[0]
+        icacomp = FastICA(n_components=1, random_state=0).fit(thedata[rowlist]).components_[0]
+    for unitvariance, thereference in [(False, pcacomp), (True, icacomp)]:
+        thecomponent = tide_refine._firstcomponent(
+            thedata, rowlist, 128, unitvariance=unitvariance
+        )
+        thecomponent *= np.sign(np.dot(thecomponent, thereference))
+        if debug:
+            print(unitvariance, np.max(np.fabs(thecomponent - thereference)))
+        np.testing.assert_allclose(
+            thecomponent, thereference, atol=1e-8 * np.max(np.fabs(thereference))
+        )
+
+    # the lag bin averages match averaging each bin separately
+    lagtimes = rng.uniform(-5.0, 5.0, size=numvoxels)
+    laglist = np.arange(-4.0, 4.0, 1.2)
+    binaverages, bincounts = tide_refine._dispersionaverages(
+        thedata, lagtimes, rowlist, laglist, 1.2, 128
+    )
+    for lagnum in range(len(laglist)):
+        inlagrange = rowlist[
+            np.where(
+                (laglist[lagnum] - 0.6 < lagtimes[rowlist])
+                & (lagtimes[rowlist] < laglist[lagnum] + 0.6)
+            )[0]
+        ]
+        assert bincounts[lagnum] == len(inlagrange)
+        np.testing.assert_allclose(
+            binaverages[lagnum, :], np.mean(thedata[inlagrange], axis=0), rtol=1e-12
+        )
+
+
+def main():
+    test_refine(debug=True)
+
+
+if __name__ == "__main__":
+    main()
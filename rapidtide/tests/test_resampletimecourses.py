@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.resample as tide_resample
+
+
+def test_resampletimecourses(debug=False):
+    rng = np.random.RandomState(12345)
+    numvoxels = 300
+    inputtr = 2.0
+    orig_x = np.arange(0.0, 120) * inputtr
+    inputdata = np.sin(np.outer(rng.uniform(0.01, 0.2, numvoxels), orig_x)) + 0.2 * rng.normal(
+        size=(numvoxels, len(orig_x))
+    )
+
+    for outputtr in [0.72, 3.0]:
+        new_x = np.arange(0.0, orig_x[-1], outputtr)
+        if outputtr > inputtr:
+            transferfunc = tide_filt.getlpfftfunc(1.0 / inputtr, 1.0 / (2.5 * inputtr), orig_x)
+        else:
+            transferfunc = None
+
+        # the answer, one timecourse at a time
+        thereference = np.zeros((numvoxels, len(new_x)), dtype=np.float64)
+        for i in range(numvoxels):
+            if transferfunc is not None:
+                thetc = tide_filt.transferfuncfilt(inputdata[i, :], transferfunc)
+            else:
+                thetc = inputdata[i, :]
+            thereference[i, :] = tide_resample.doresample(orig_x, thetc, new_x)
+
+        for nprocs in [1, 2]:
+            for blocksize in [1000, 64]:
+                resampled = tide_resample.resampletimecourses(
+                    inputdata,
+                    orig_x,
+                    new_x,
+                    transferfunc=transferfunc,
+                    blocksize=blocksize,
+                    nprocs=nprocs,
+                    showprogressbar=False,
+                    chunksize=100,
+                )
+                if debug:
+                    print(outputtr, nprocs, blocksize, np.max(np.fabs(resampled - thereference)))
+                np.testing.assert_allclose(resampled, thereference, atol=1e-10)
+
+            # a matrix built once can be reused, and the output can be single precision
+            resampmatrix = tide_resample.sparseresamplingmatrix(orig_x, new_x)
+            for half in [slice(0, numvoxels // 2), slice(numvoxels // 2, numvoxels)]:
+                resampled = np.zeros((numvoxels // 2, len(new_x)), dtype=np.float32)
+                tide_resample.resampletimecourses(
+                    inputdata[half, :],
+                    orig_x,
+                    new_x,
+                    outputdata=resampled,
+                    transferfunc=transferfunc,
+                    resampmatrix=resampmatrix,
+                    nprocs=nprocs,
+                    showprogressbar=False,
+                    chunksize=100,
+                )
+                np.testing.assert_allclose(resampled, thereference[half, :], atol=1e-5)
+
+
+def main():
+    test_resampletimecourses(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import numpy as np
+from scipy.stats import kurtosis, skew
+
+import rapidtide.stats as tide_stats
+
+
+def test_rollingstats(debug=False):
+    rng = np.random.RandomState(12345)
+    numpoints = 3000
+    waveform = np.sin(np.arange(numpoints) / 7.0) + 0.3 * rng.normal(size=numpoints)
+    waveform[1000:1200] = 0.5
+    waveform[2500] = np.nan
+
+    for windowpts in [25, 101, 501]:
+        rollingskew = tide_stats.rollingskew(waveform, windowpts)
+        rollingkurtosis = tide_stats.rollingkurtosis(waveform, windowpts, fisher=False)
+        rollingexcess = tide_stats.rollingkurtosis(waveform, windowpts)
+        for i in list(range(0, numpoints, 7)) + [numpoints - 1]:
+            startpt = np.max([0, i - windowpts // 2])
+            endpt = np.min([i + windowpts // 2, numpoints])
+            thewindow = waveform[startpt : endpt + 1]
+            thewindow = thewindow[np.isfinite(thewindow)]
+            if np.max(thewindow) == np.min(thewindow):
+                # constant windows have no defined skewness or kurtosis
+                assert np.isnan(rollingskew[i])
+                assert np.isnan(rollingkurtosis[i])
+                continue
+            if debug and (i % 490 == 0):
+                print(windowpts, i, rollingskew[i], skew(thewindow))
+            np.testing.assert_allclose(rollingskew[i], skew(thewindow), atol=1e-7)
+            np.testing.assert_allclose(
+                rollingkurtosis[i], kurtosis(thewindow, fisher=False), atol=1e-6
+            )
+            np.testing.assert_allclose(rollingexcess[i], rollingkurtosis[i] - 3.0)
+
+
+def main():
+    test_rollingstats(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import numpy as np
+
+import rapidtide.benchmark as tide_bench
+import rapidtide.filter as tide_filt
+import rapidtide.resample as tide_resample
+
+
+def test_singleprecision(debug=False):
+    np.random.seed(12345)
+
+    # the transforms keep the precision of their input
+    thedata = np.random.normal(size=(10, 200))
+    assert tide_filt.realfft(thedata, n=512, axis=1).dtype == np.complex128
+    assert tide_filt.realfft(thedata.astype(np.float32), n=512, axis=1).dtype == np.complex64
+    roundtrip = tide_filt.inverserealfft(
+        tide_filt.realfft(thedata.astype(np.float32), axis=1), n=200, axis=1
+    )
+    assert roundtrip.dtype == np.float32
+    np.testing.assert_allclose(roundtrip, thedata, atol=1e-5)
+
+    # so does timeshiftblock, and single precision is close to double
+    shifttrs = np.random.uniform(-5.0, 5.0, size=10)
+    for padtrs in [30, 31]:
+        shifted, weights = tide_resample.timeshiftblock(thedata, shifttrs, padtrs)
+        shifted_sp, weights_sp = tide_resample.timeshiftblock(
+            thedata.astype(np.float32), shifttrs, padtrs
+        )
+        assert shifted_sp.dtype == np.float32
+        assert weights_sp.dtype == np.float32
+        if debug:
+            print(padtrs, np.max(np.fabs(shifted_sp - shifted)))
+        np.testing.assert_allclose(shifted_sp, shifted, atol=1e-4)
+        np.testing.assert_allclose(weights_sp, weights, atol=1e-5)
+
+    # a single precision run gets the same maps as a double precision one
+    report = tide_bench.precisionreport(numvoxels=200, timepoints=200)
+    if debug:
+        for themap, theresult in report["maps"].items():
+            print(themap, theresult["maxabsdiff"], theresult["tolerance"])
+    assert report["pass"]
+    assert report["maps"]["lagmask"]["mismatched"] == 0
+
+
+def main():
+    test_singleprecision(debug=True)
+
+
+if __name__ == "__main__":
+    main()
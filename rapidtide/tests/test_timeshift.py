@@ -4,7 +4,7 @@
 import numpy as np
 import pylab as plt
 
-from rapidtide.resample import timeshift
+from rapidtide.resample import timeshift, timeshiftblock
 from rapidtide.filter import dolpfiltfilt
 from rapidtide.tests.utils import mse
 
@@ -72,8 +72,40 @@ def test_timeshift(debug=False):
         plt.show()
 
 
+def test_timeshiftblock(debug=False):
+    np.random.seed(123)
+    # even and odd padded lengths take different paths, and no padding at all is allowed
+    for padtrs in [30, 0]:
+        for testlen in [200, 201]:
+            timecourses = np.random.normal(size=(20, testlen))
+            shifts = np.random.uniform(-15.0, 15.0, size=20)
+            blockshifted, blockweights = timeshiftblock(timecourses, shifts, padtrs)
+            for i in range(len(shifts)):
+                tcshifted, weights, alltc, allweights = timeshift(
+                    timecourses[i, :], shifts[i], padtrs
+                )
+                if debug:
+                    print(
+                        padtrs, testlen, i, np.max(np.fabs(blockshifted[i, :] - tcshifted))
+                    )
+                np.testing.assert_allclose(blockshifted[i, :], tcshifted, atol=1e-10)
+                np.testing.assert_allclose(blockweights[i, :], weights, atol=1e-10)
+
+    # without padding, a whole number shift is a circular shift
+    timecourses = np.random.normal(size=(3, 64))
+    blockshifted, blockweights = timeshiftblock(
+        timecourses, np.array([3.0, -5.0, 0.0]), 0
+    )
+    for i, theshift in enumerate([3, -5, 0]):
+        np.testing.assert_allclose(
+            blockshifted[i, :], np.roll(timecourses[i, :], theshift), atol=1e-10
+        )
+    np.testing.assert_allclose(blockweights, 1.0, atol=1e-10)
+
+
 def main():
     test_timeshift(debug=True)
+    test_timeshiftblock(debug=True)
 
 
 if __name__ == "__main__":
@@ -21,6 +21,10 @@
 
 
 import numpy as np
+import contextlib
+import functools
+import importlib
+import importlib.util
 import time
 import sys
 import bisect
@@ -35,37 +39,60 @@ MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
+# only check whether these are installed - they are imported where they are used, which keeps startup fast
+memprofilerexists = importlib.util.find_spec("memory_profiler") is not None
+numbaexists = importlib.util.find_spec("numba") is not None
+nibabelexists = importlib.util.find_spec("nibabel") is not None
+pyfftwexists = importlib.util.find_spec("pyfftw") is not None
 
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
+donotusenumba = False
 
-try:
-    from numba import jit
 
-    numbaexists = True
-except ImportError:
-    numbaexists = False
+class lazymodule:
+    """
+    Stand-in for a module that is only imported the first time one of its attributes is used.  Use this
+    for heavy dependencies (plotting, machine learning) that most calls into a module never touch.
 
-try:
-    import nibabel as nib
+    Parameters
+    ----------
+    modulename: str
+        The full name of the module, e.g. "matplotlib.pyplot"
+    """
 
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
+    def __init__(self, modulename):
+        self._modulename = modulename
+        self._module = None
 
-donotusenumba = False
+    def __getattr__(self, name):
+        if name in ("_modulename", "_module"):
+            raise AttributeError(name)
+        if self._module is None:
+            self._module = importlib.import_module(self._modulename)
+        return getattr(self._module, name)
 
-try:
-    import pyfftw
 
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
+class lazyfftpack(lazymodule):
+    """
+    Stand-in for scipy.fftpack that is only resolved the first time an FFT is done.  If pyfftw is installed,
+    its drop in replacement for scipy.fftpack is used instead, and its plan cache is enabled at that point.
+    """
+
+    def __init__(self):
+        super().__init__("scipy.fftpack")
+
+    def __getattr__(self, name):
+        if name in ("_modulename", "_module"):
+            raise AttributeError(name)
+        if self._module is None:
+            if pyfftwexists:
+                self._module = importlib.import_module("pyfftw.interfaces.scipy_fftpack")
+                importlib.import_module("pyfftw.interfaces.cache").enable()
+            else:
+                self._module = importlib.import_module(self._modulename)
+        return getattr(self._module, name)
+
+
+fftpack = lazyfftpack()
 
 
 def checkimports(optiondict):
@@ -112,24 +139,166 @@ def checkimports(optiondict):
     optiondict["donotusenumba"] = donotusenumba
 
 
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f)
+# ------------------------------------------ JIT kernel registry ---------------------------------------
+_jitkernels = {}
 
-    return resdec
 
+class jitkernel:
+    """
+    A numeric routine that is compiled with numba in nopython mode the first time it is called.
+
+    Compiled code is cached on disk (cache=True), so later runs load it instead of compiling again.  If
+    numba is not installed, has been disabled with disablenumba, or cannot compile the function in nopython
+    mode, the original python function is used instead - no silent fallback to object mode.  Once compiled,
+    calls go straight to the numba dispatcher.  If numba later fails to type a call with new argument
+    types, those argument types are run with the python function from then on (only kernels that have hit
+    this pay for checking the argument types), and the reason is recorded in the status.  Errors raised
+    while the compiled code runs are passed on, never retried in python.  Because compilation is deferred
+    to the first call, disablenumba takes effect as long as it is called before the kernel is first used.
+
+    Parameters
+    ----------
+    func: function
+        The function to compile
+    signatures: list, optional
+        Numba signatures to compile eagerly on first use.  If None (default), specializations are compiled
+        for the argument types seen.
+    aggressive: bool, optional
+        When True, only compile if aggressive optimization is enabled.  Default is False.
+    """
+
+    def __init__(self, func, signatures=None, aggressive=False):
+        self.func = func
+        self.signatures = signatures
+        self.aggressive = aggressive
+        self.name = func.__module__ + "." + func.__name__
+        self.compiled = None
+        self.status = "not used"
+        self.typingerror = ()
+        self.pythonargtypes = set()
+        self._dispatch = self._firstcall
+        functools.update_wrapper(self, func)
+
+    def _compile(self):
+        self.compiled = self.func
+        if not numbaexists:
+            self.status = "python (numba not installed)"
+        elif donotusenumba:
+            self.status = "python (numba disabled)"
+        elif self.aggressive and donotbeaggressive:
+            self.status = "python (aggressive optimization disabled)"
+        else:
+            from numba import njit
+
+            try:
+                from numba.core.errors import NumbaError, TypingError
+            except ImportError:
+                from numba.errors import NumbaError, TypingError
+            self.typingerror = TypingError
+            try:
+                self.compiled = njit(cache=True)(self.func)
+                if self.signatures is None:
+                    self.status = "pending"
+                else:
+                    # compile the given signatures now - other argument types are still compiled when seen
+                    for thesignature in self.signatures:
+                        self.compiled.compile(thesignature)
+                    self.status = "compiled"
+            except (NumbaError, RuntimeError) as err:
+                self.compiled = self.func
+                self.typingerror = ()
+                self.status = "python (compilation failed: " + str(err).splitlines()[0] + ")"
+
+    def _firstcall(self, *args, **kwargs):
+        self._compile()
+        self._dispatch = self.compiled
+        result = self.compiled(*args, **kwargs)
+        if self.status == "pending":
+            self.status = "compiled"
+        return result
+
+    @staticmethod
+    def _argtypes(args, kwargs):
+        # a cheap stand in for the numba type of the arguments
+        return tuple(
+            (type(arg), getattr(arg, "dtype", None), getattr(arg, "ndim", None))
+            for arg in list(args) + [kwargs[key] for key in sorted(kwargs.keys())]
+        )
+
+    def _checkedcall(self, *args, **kwargs):
+        # only used once some argument types have failed to compile
+        if self._argtypes(args, kwargs) in self.pythonargtypes:
+            return self.func(*args, **kwargs)
+        return self.compiled(*args, **kwargs)
+
+    def _typingfailed(self, err, args, kwargs):
+        # numba could not type these arguments, so the compiled code never ran
+        thereason = str(err).splitlines()[0]
+        if self.status == "pending":
+            # nothing has compiled yet
+            self.compiled = self.func
+            self._dispatch = self.func
+            self.typingerror = ()
+            self.status = "python (compilation failed: " + thereason + ")"
+        else:
+            self.pythonargtypes.add(self._argtypes(args, kwargs))
+            self._dispatch = self._checkedcall
+            self.status = "compiled (python for some argument types: " + thereason + ")"
+        return self.func(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self._dispatch(*args, **kwargs)
+        except self.typingerror as err:
+            return self._typingfailed(err, args, kwargs)
+
+
+def numbakernel(signatures=None, aggressive=False):
+    """
+    Decorator that registers a function as a jitkernel.
+
+    Parameters
+    ----------
+    signatures: list, optional
+        Numba signatures to compile.  If None (default), compile for the argument types seen.
+    aggressive: bool, optional
+        When True, only compile if aggressive optimization is enabled.  Default is False.
+
+    Returns
+    -------
+    resdec: function
+        The decorator
+    """
 
-def conditionaljit2():
     def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f)
+        thekernel = jitkernel(f, signatures=signatures, aggressive=aggressive)
+        _jitkernels[thekernel.name] = thekernel
+        return thekernel
 
     return resdec
 
 
+def jitkernelstatus():
+    """
+    Report how each registered kernel is being run.
+
+    Returns
+    -------
+    statusdict: dict
+        The status of every registered kernel ('not used', 'compiled', or 'python' with the reason, or
+        'compiled' with the reason some argument types are run in python), keyed by module and function name
+    """
+    return {thename: _jitkernels[thename].status for thename in sorted(_jitkernels.keys())}
+
+
+def conditionaljit():
+    return numbakernel()
+
+
+def conditionaljit2():
+    return numbakernel(aggressive=True)
+
+
 def disablenumba():
     global donotusenumba
     donotusenumba = True
@@ -300,6 +469,7 @@ def startendcheck(timepoints, startpoint, endpoint):
     return realstart, realend
 
 
+@numbakernel()
 def valtoindex(thearray, thevalue, evenspacing=True):
     """
 
@@ -319,7 +489,7 @@ def valtoindex(thearray, thevalue, evenspacing=True):
 
     """
     if evenspacing:
-        limval = np.max([thearray[0], np.min([thearray[-1], thevalue])])
+        limval = max(thearray[0], min(thearray[-1], thevalue))
         return int(np.round((limval - thearray[0]) / (thearray[1] - thearray[0]), 0))
     else:
         return (np.abs(thearray - thevalue)).argmin()
@@ -460,6 +630,314 @@ def proctiminginfo(thetimings, outputfile="", extraheader=None):
         tide_io.writevec(theinfolist, outputfile)
 
 
+# resource use reported back by worker processes (see rapidtide.multiproc)
+_workerusage = {"cputime": 0.0, "maxrss": 0}
+
+
+def recordworkerusage(cputime, maxrss):
+    r"""Add the resources used by a worker process on one chunk of work to the running totals.
+
+    Parameters
+    ----------
+    cputime : float
+        CPU time (user plus system) the worker spent on the chunk, in seconds
+    maxrss : int
+        The peak resident set size of the worker so far, in kilobytes
+    """
+    _workerusage["cputime"] += cputime
+    _workerusage["maxrss"] = max(_workerusage["maxrss"], maxrss)
+
+
+def maxrsskb(rcusage):
+    r"""The peak resident set size from a getrusage result, in kilobytes.
+
+    ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+
+    Parameters
+    ----------
+    rcusage : resource.struct_rusage
+        The result of resource.getrusage
+
+    Returns
+    -------
+    maxrss : float
+        The peak resident set size, in kilobytes
+    """
+    if sys.platform == "darwin":
+        return rcusage.ru_maxrss / 1024.0
+    return rcusage.ru_maxrss
+
+
+def _resourcesnapshot():
+    rcusage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "wall": time.perf_counter(),
+        "clock": time.time(),
+        "cputime": rcusage.ru_utime + rcusage.ru_stime,
+        "maxrss": maxrsskb(rcusage),
+        "workercputime": _workerusage["cputime"],
+        "workermaxrss": _workerusage["maxrss"],
+    }
+
+
+class profiler:
+    r"""Nested, timed spans covering the steps of a run.
+
+    Each span records its wall time, the CPU time used by this process and by any worker
+    processes (see rapidtide.multiproc), the peak resident set size of this process and of the
+    workers at the end of the span (both are high water marks for the run so far), and, if the
+    number of items processed is given, the processing rate.  Spans can be opened and closed with
+    start and end, or with the span context manager.  Marks are single points in time.
+
+    The results can be written to json, to a Chrome trace event file (load it in
+    chrome://tracing or https://ui.perfetto.dev), or converted to the list format used by
+    proctiminginfo.
+    """
+
+    def __init__(self, name="rapidtide"):
+        self.name = name
+        self.spans = []
+        self.marks = []
+        self.stack = []
+        self.origin = _resourcesnapshot()
+
+    def start(self, name, category="stage", nprocs=1):
+        r"""Open a span inside the innermost open span.
+
+        Parameters
+        ----------
+        name : str
+            Description of the step
+        category : str, optional
+            The kind of step (e.g. "pass", "stage", "io").  Default is "stage".
+        nprocs : int, optional
+            Number of worker processes the step uses, for working out worker utilization.
+            Default is 1.
+        """
+        if self.stack:
+            parent = self.stack[-1]
+        else:
+            parent = None
+        self.spans.append(
+            {
+                "name": name,
+                "category": category,
+                "depth": len(self.stack),
+                "parent": parent,
+                "nprocs": int(nprocs),
+                "begin": _resourcesnapshot(),
+                "finish": None,
+                "count": None,
+                "unit": None,
+            }
+        )
+        self.stack.append(len(self.spans) - 1)
+
+    def end(self, name=None, count=None, unit=None):
+        r"""Close the innermost open span.
+
+        Parameters
+        ----------
+        name : str, optional
+            If given, check that it matches the name of the span being closed.
+        count : int, optional
+            Number of items processed in the span
+        unit : str, optional
+            What the items are (e.g. "voxels")
+        """
+        if not self.stack:
+            print("profiler: no span to end")
+            return
+        thespan = self.spans[self.stack.pop()]
+        if (name is not None) and (name != thespan["name"]):
+            print("profiler: ending span", thespan["name"], "but expected", name)
+        thespan["finish"] = _resourcesnapshot()
+        if count is not None:
+            count = int(count)
+        thespan["count"] = count
+        thespan["unit"] = unit
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", nprocs=1):
+        r"""Context manager version of start and end.  The yielded span dictionary can be given a
+        "count" and "unit" inside the block.
+        """
+        self.start(name, category=category, nprocs=nprocs)
+        thespan = self.spans[-1]
+        try:
+            yield thespan
+        finally:
+            self.end(count=thespan["count"], unit=thespan["unit"])
+
+    def mark(self, name):
+        r"""Record a point in time.
+
+        Parameters
+        ----------
+        name : str
+            Description of the event
+        """
+        self.marks.append({"name": name, "clock": time.time(), "wall": time.perf_counter()})
+
+    def _fullname(self, index):
+        thenames = []
+        while index is not None:
+            thenames.insert(0, self.spans[index]["name"])
+            index = self.spans[index]["parent"]
+        return ": ".join(thenames)
+
+    def summary(self):
+        r"""Summarize the completed spans.
+
+        Returns
+        -------
+        spans : list of dict
+            One entry per completed span, in the order they were started, with the start time
+            (relative to the creation of the profiler) and duration in seconds, CPU time of this
+            process and of the workers in seconds, worker utilization (CPU time divided by wall
+            time times the number of processes), peak RSS in megabytes, and items per second.
+        """
+        thesummary = []
+        for index, thespan in enumerate(self.spans):
+            if thespan["finish"] is None:
+                continue
+            begin = thespan["begin"]
+            finish = thespan["finish"]
+            walltime = finish["wall"] - begin["wall"]
+            cputime = finish["cputime"] - begin["cputime"]
+            workercputime = finish["workercputime"] - begin["workercputime"]
+            if thespan["nprocs"] > 1:
+                utilization = workercputime / max(walltime * thespan["nprocs"], 1e-9)
+            else:
+                utilization = (cputime + workercputime) / max(walltime, 1e-9)
+            theentry = {
+                "name": thespan["name"],
+                "fullname": self._fullname(index),
+                "category": thespan["category"],
+                "depth": thespan["depth"],
+                "start": begin["wall"] - self.origin["wall"],
+                "walltime": walltime,
+                "cputime": cputime,
+                "workercputime": workercputime,
+                "nprocs": thespan["nprocs"],
+                "utilization": utilization,
+                "peakrss_mb": finish["maxrss"] / 1024.0,
+                "workerpeakrss_mb": finish["workermaxrss"] / 1024.0,
+                "count": thespan["count"],
+                "unit": thespan["unit"],
+            }
+            if thespan["count"] is not None:
+                theentry["itemspersec"] = thespan["count"] / max(walltime, 1e-9)
+            thesummary.append(theentry)
+        return thesummary
+
+    def timings(self):
+        r"""Convert the spans and marks to the [description, time, count, unit] list format used by
+        proctiminginfo.
+
+        Returns
+        -------
+        thetimings : list
+        """
+        theevents = [["Start", self.origin["clock"], None, None, -1]]
+        for index, thespan in enumerate(self.spans):
+            if thespan["finish"] is None:
+                continue
+            thename = self._fullname(index)
+            theevents.append([thename + " start", thespan["begin"]["clock"], None, None, index])
+            theevents.append(
+                [
+                    thename + " end",
+                    thespan["finish"]["clock"],
+                    thespan["count"],
+                    thespan["unit"],
+                    index,
+                ]
+            )
+        for themark in self.marks:
+            theevents.append([themark["name"], themark["clock"], None, None, len(self.spans)])
+        theevents.sort(key=lambda theevent: theevent[1])
+        return [theevent[:4] for theevent in theevents]
+
+    def writejson(self, filename):
+        r"""Write the span summary and marks to a json file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the json file (with extension)
+        """
+        tide_io.writedicttojson(
+            {
+                "name": self.name,
+                "starttime": time.strftime(
+                    "%Y%m%dT%H%M%S", time.localtime(self.origin["clock"])
+                ),
+                "spans": self.summary(),
+                "marks": [
+                    {"name": themark["name"], "time": themark["wall"] - self.origin["wall"]}
+                    for themark in self.marks
+                ],
+            },
+            filename,
+        )
+
+    def writechrometrace(self, filename):
+        r"""Write the spans and marks as a Chrome trace event file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the trace file (with extension)
+        """
+        pid = os.getpid()
+        traceevents = [
+            {"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": self.name}}
+        ]
+        for theentry in self.summary():
+            theargs = {}
+            for key in ["cputime", "workercputime", "nprocs", "utilization", "count", "unit"]:
+                theargs[key] = theentry[key]
+            if "itemspersec" in theentry:
+                theargs["itemspersec"] = theentry["itemspersec"]
+            traceevents.append(
+                {
+                    "name": theentry["name"],
+                    "cat": theentry["category"],
+                    "ph": "X",
+                    "ts": theentry["start"] * 1.0e6,
+                    "dur": theentry["walltime"] * 1.0e6,
+                    "pid": pid,
+                    "tid": 0,
+                    "args": theargs,
+                }
+            )
+            traceevents.append(
+                {
+                    "name": "peak RSS (MB)",
+                    "ph": "C",
+                    "ts": (theentry["start"] + theentry["walltime"]) * 1.0e6,
+                    "pid": pid,
+                    "args": {
+                        "main": theentry["peakrss_mb"],
+                        "workers": theentry["workerpeakrss_mb"],
+                    },
+                }
+            )
+        for themark in self.marks:
+            traceevents.append(
+                {
+                    "name": themark["name"],
+                    "ph": "i",
+                    "s": "p",
+                    "ts": (themark["wall"] - self.origin["wall"]) * 1.0e6,
+                    "pid": pid,
+                    "tid": 0,
+                }
+            )
+        tide_io.writedicttojson({"traceEvents": traceevents, "displayTimeUnit": "ms"}, filename)
+
+
 # --------------------------- testing functions -------------------------------------------------
 def comparemap(map1, map2, mask=None):
     if map1.shape != map2.shape:
@@ -48,6 +48,33 @@ def _procOneVoxelWiener(
     )
 
 
+def _wienerstage(voxels, arrays, params, showprogressbar=False):
+    fmri_data = arrays["fmri_data"]
+    lagtc = arrays["lagtc"]
+    meanvalue = arrays["meanvalue"]
+    rvalue = arrays["rvalue"]
+    r2value = arrays["r2value"]
+    fitcoff = arrays["fitcoff"]
+    fitNorm = arrays["fitNorm"]
+    datatoremove = arrays["datatoremove"]
+    filtereddata = arrays["filtereddata"]
+    addedskip = params["addedskip"]
+    reportstep = params["reportstep"]
+    for i, vox in enumerate(voxels):
+        if (i % reportstep == 0 or i == len(voxels) - 1) and showprogressbar:
+            tide_util.progressbar(i + 1, len(voxels), label="Percent complete")
+        dummy, meanvalue[vox], rvalue[vox], r2value[vox], fitcoff[vox], fitNorm[
+            vox
+        ], datatoremove[vox, :], filtereddata[vox, :] = _procOneVoxelWiener(
+            vox,
+            lagtc[vox, :],
+            fmri_data[vox, addedskip:].copy(),
+            rt_floatset=params["rt_floatset"],
+            rt_floattype=params["rt_floattype"],
+        )
+    return len(voxels)
+
+
 def wienerpass(
     numspatiallocs,
     reportstep,
@@ -64,74 +91,36 @@ def wienerpass(
     filtereddata,
     rt_floatset=np.float64,
     rt_floattype="float64",
+    pool=None,
 ):
     inputshape = np.shape(fmri_data)
-    themask = np.where(np.mean(fmri_data, axis=1) > threshval, 1, 0)
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def Wiener_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    outQ.put(
-                        _procOneVoxelWiener(
-                            val,
-                            lagtc[val, :],
-                            fmri_data[val, optiondict["addedskip"] :],
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
-
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            Wiener_consumer,
-            inputshape,
-            themask,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
-        )
-        # unpack the data
-        volumetotal = 0
-        for voxel in data_out:
-            meanvalue[voxel[0]] = voxel[1]
-            rvalue[voxel[0]] = voxel[2]
-            r2value[voxel[0]] = voxel[3]
-            fitcoff[voxel[0]] = voxel[4]
-            fitNorm[voxel[0]] = voxel[5]
-            datatoremove[voxel[0], :] = voxel[6]
-            filtereddata[voxel[0], :] = voxel[7]
-            volumetotal += 1
-        data_out = []
-    else:
-        volumetotal = 0
-        for vox in range(0, numspatiallocs):
-            if (vox % reportstep == 0 or vox == numspatiallocs - 1) and optiondict[
-                "showprogressbar"
-            ]:
-                tide_util.progressbar(vox + 1, numspatiallocs, label="Percent complete")
-            inittc = fmri_data[vox, optiondict["addedskip"] :].copy()
-            if np.mean(inittc) >= threshval:
-                dummy, meanvalue[vox], rvalue[vox], r2value[vox], fitcoff[vox], fitNorm[
-                    vox
-                ], datatoremove[vox], filtereddata[vox] = _procOneVoxelWiener(
-                    vox,
-                    lagtc[vox, :],
-                    inittc,
-                    rt_floatset=rt_floatset,
-                    t_floattype=rt_floattype,
-                )
-            volumetotal += 1
+    themask = np.where(np.mean(fmri_data, axis=1) > threshval, 1, 0)[:numspatiallocs]
+    params = {
+        "addedskip": optiondict["addedskip"],
+        "reportstep": reportstep,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+    data_out = tide_multiproc.run_multiproc_stage(
+        _wienerstage,
+        {"fmri_data": fmri_data, "lagtc": lagtc},
+        {
+            "meanvalue": meanvalue,
+            "rvalue": rvalue,
+            "r2value": r2value,
+            "fitcoff": fitcoff,
+            "fitNorm": fitNorm,
+            "datatoremove": datatoremove,
+            "filtereddata": filtereddata,
+        },
+        params,
+        inputshape,
+        themask,
+        nprocs=optiondict["nprocs"],
+        pool=pool,
+        showprogressbar=optiondict["showprogressbar"],
+        chunksize=optiondict["mp_chunksize"],
+    )
+    volumetotal = int(np.sum(data_out))
 
     return volumetotal
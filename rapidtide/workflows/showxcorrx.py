@@ -63,24 +63,17 @@ def _get_null_distribution(
     corrlist_pear = zeros(numreps, dtype="float")
     xcorr_x_trim = xcorr_x[searchstart : searchend + 1]
 
-    filteredindata = tide_math.corrnormalize(
-        thefilter.apply(Fs, indata),
-        prewindow=prewindow,
-        detrendorder=detrendorder,
-        windowfunc=windowfunc,
+    thenormalizer = tide_math.getcorrnormalizer(
+        len(indata), prewindow=prewindow, detrendorder=detrendorder, windowfunc=windowfunc
     )
+    filteredindata = thenormalizer.apply(thefilter.apply(Fs, indata))
     for i in range(numreps):
         # make a shuffled copy of the regressors
         shuffleddata = permutation(indata)
 
         # filter it
         filteredshuffleddata = np.nan_to_num(
-            tide_math.corrnormalize(
-                thefilter.apply(Fs, shuffleddata),
-                prewindow=prewindow,
-                detrendorder=detrendorder,
-                windowfunc=windowfunc,
-            )
+            thenormalizer.apply(thefilter.apply(Fs, shuffleddata), inplace=True)
         )
 
         # crosscorrelate with original